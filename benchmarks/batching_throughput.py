@@ -0,0 +1,83 @@
+"""
+Throughput vs. batch size for the inference-server BatchScheduler, on CPU.
+
+    python -m benchmarks.batching_throughput --requests 64 --batch-sizes 1 2 4 8 16
+    python -m benchmarks.batching_throughput --hf-model sshleifer/tiny-gpt2
+
+Without --hf-model a synthetic stand-in is used: every batch costs a fixed
+per-call overhead plus a small per-item cost, which is how a GPU forward pass
+behaves until it saturates.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.batch_scheduler import BatchScheduler, make_hf_batch_generator
+
+
+def make_stand_in(call_overhead_ms: float, per_item_ms: float):
+    def generate_batch(items: List[Tuple[str, int, float]]) -> List[Dict[str, Any]]:
+        time.sleep((call_overhead_ms + per_item_ms * len(items)) / 1000.0)
+        return [
+            {"text": f"echo: {prompt[:20]}", "prompt_tokens": len(prompt.split()), "completion_tokens": 2}
+            for prompt, _, _ in items
+        ]
+    return generate_batch
+
+
+def make_tiny_hf(model_id: str):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    return make_hf_batch_generator(model, tokenizer)
+
+
+async def run_once(generate_batch, n_requests: int, batch_size: int, max_wait_ms: float, max_tokens: int):
+    scheduler = BatchScheduler(generate_batch, max_batch_size=batch_size, max_wait_ms=max_wait_ms)
+    latencies = []
+
+    async def one(i: int):
+        start = time.perf_counter()
+        await scheduler.submit((f"Request {i}: tell me about batching.", max_tokens, 0.7), key=0.7)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "batch_size": batch_size,
+        "throughput_rps": round(n_requests / elapsed, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        **scheduler.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--call-overhead-ms", type=float, default=40)
+    parser.add_argument("--per-item-ms", type=float, default=2)
+    parser.add_argument("--hf-model", default=None, help="Tiny HF causal LM to run on CPU instead of the stand-in")
+    args = parser.parse_args()
+
+    if args.hf_model:
+        generate_batch = make_tiny_hf(args.hf_model)
+    else:
+        generate_batch = make_stand_in(args.call_overhead_ms, args.per_item_ms)
+
+    for batch_size in args.batch_sizes:
+        print(asyncio.run(run_once(generate_batch, args.requests, batch_size, args.max_wait_ms, args.max_tokens)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+LLM request latency and errors with one backend vs the multi-backend router.
+
+    python -m benchmarks.llm_routing --requests 400 --concurrency 8
+    python -m benchmarks.llm_routing --backends 4 --slow-every 10 --slow-ms 800 --error-every 15
+
+Starts local mock servers that inject faults: every --slow-every-th request is
+delayed by --slow-ms and every --error-every-th one fails with HTTP 503. The
+"single" run sends all requests to one such backend with retries and hedging
+off (the client before routing). The "routed" run spreads them over
+--backends such servers with retries, circuit breaker and hedging on; halfway
+through, one of its backends goes down entirely. Reports p50/p95/p99 of the
+full streamed answer, error rate, retries, hedges and per-backend load.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.llm_client import LLMClient
+from src.metrics import metrics
+from src.mock_llm_server import MockLLMServer
+
+MESSAGES = [{"role": "user", "content": "How should we size the connection pool for the inference service?"}]
+COUNTERS = ("llm_retries_total", "llm_hedges_total", "llm_hedge_wins_total", "llm_circuit_opened_total",
+            "llm_router_rejected_total")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def counter_totals() -> Dict[str, float]:
+    totals = dict.fromkeys(COUNTERS, 0.0)
+    for (name, _), value in list(metrics.counters.items()):
+        if name in totals:
+            totals[name] += value
+    return totals
+
+
+def run(servers: List[MockLLMServer], args, routed: bool) -> Dict:
+    client = LLMClient(",".join(s.base_url for s in servers))
+    if not routed:
+        client.router.max_retries = 0
+        client.router.hedge = False
+    before = counter_totals()
+    latencies, errors = [], 0
+
+    def one(i: int):
+        if routed and i == args.requests // 2:
+            servers[-1].error_every = 1
+        start = time.perf_counter()
+        try:
+            "".join(client.stream_chat_completion(MESSAGES))
+            return time.perf_counter() - start
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for latency in pool.map(one, range(args.requests)):
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+    elapsed = time.perf_counter() - start
+    after = counter_totals()
+
+    return {
+        "backends": len(servers),
+        "ok": len(latencies),
+        "error_rate": round(errors / args.requests, 4),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "throughput_rps": round(args.requests / elapsed, 1),
+        **{name.replace("llm_", "").replace("_total", ""): int(after[name] - before[name]) for name in COUNTERS},
+        "per_backend": [{"requests": b.requests, "failures": b.failures, "state": b.state}
+                        for b in client.router.backends],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--backends", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--tokens-per-second", type=float, default=2000)
+    parser.add_argument("--slow-every", type=int, default=25)
+    parser.add_argument("--slow-ms", type=float, default=500)
+    parser.add_argument("--error-every", type=int, default=20)
+    args = parser.parse_args()
+
+    def make_server() -> MockLLMServer:
+        return MockLLMServer(latency_ms=args.latency_ms, tokens_per_second=args.tokens_per_second,
+                             error_every=args.error_every, slow_every=args.slow_every,
+                             slow_ms=args.slow_ms).start()
+
+    single = [make_server()]
+    routed = [make_server() for _ in range(args.backends)]
+    try:
+        report = {"single": run(single, args, routed=False), "routed": run(routed, args, routed=True)}
+    finally:
+        for server in single + routed:
+            server.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Prefill cost of the static system prompts with and without the prefix KV cache.
+
+    python -m benchmarks.prefix_cache --hf-model hf-internal-testing/tiny-random-LlamaForCausalLM
+    python -m benchmarks.prefix_cache --hf-model Qwen/Qwen2.5-0.5B-Instruct --batch-size 4 --runs 10
+
+Builds prompts the way the inference server does (chat template over the real
+query-analysis and summarization system prompts followed by varying user
+messages) and times one-token generations - i.e. the prefill - through
+make_hf_batch_generator with and without a warmed PrefixKVCache. Greedy
+outputs of both paths over a few tokens are compared; exits 1 if they differ.
+Needs torch and transformers.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.batch_scheduler import make_hf_batch_generator
+from src.prefix_cache import PrefixKVCache
+from src.query_processor import ANALYSIS_SYSTEM_PROMPT
+from src.session_memory import SUMMARY_SYSTEM_PROMPT
+
+QUERIES = [
+    "How do I add retries to my FastAPI client?",
+    "Which of the two caching options did we pick yesterday?",
+    "Can you make it faster?",
+    "Compare connection pooling and batching for the inference service.",
+    "What was the budget we agreed on for the GPU nodes?",
+    "Summarize the open questions so far.",
+    "Why does the second request still take 400 ms?",
+    "Rewrite that in Vietnamese please.",
+]
+
+
+def render(tokenizer, system: str, user: str, prefix_only: bool = False) -> str:
+    messages = [{"role": "system", "content": system}] + ([] if prefix_only else [{"role": "user", "content": user}])
+    if getattr(tokenizer, "chat_template", None):
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=not prefix_only)
+    # Tiny test models ship without a chat template
+    text = f"<|system|>\n{system}\n"
+    return text if prefix_only else text + f"<|user|>\n{user}\n<|assistant|>\n"
+
+
+def batches(tokenizer, batch_size: int) -> List[List[str]]:
+    result = []
+    for system in (ANALYSIS_SYSTEM_PROMPT, SUMMARY_SYSTEM_PROMPT):
+        for start in range(0, len(QUERIES), batch_size):
+            result.append([render(tokenizer, system, q) for q in QUERIES[start:start + batch_size]])
+    return result
+
+
+def time_prefill(generate_batch, prompt_batches: List[List[str]], runs: int) -> float:
+    """Median seconds to generate one token for all batches."""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for prompts in prompt_batches:
+            generate_batch([(p, 1, 0.0) for p in prompts])
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hf-model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--check-tokens", type=int, default=8, help="Greedy tokens compared between both paths")
+    args = parser.parse_args()
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_model)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model = AutoModelForCausalLM.from_pretrained(args.hf_model, dtype=torch.float32).eval()
+
+    prefix_cache = PrefixKVCache(model, tokenizer, min_tokens=1)
+    prefix_cache.warm([render(tokenizer, system, "", prefix_only=True)
+                       for system in (ANALYSIS_SYSTEM_PROMPT, SUMMARY_SYSTEM_PROMPT)])
+    plain = make_hf_batch_generator(model, tokenizer)
+    cached = make_hf_batch_generator(model, tokenizer, prefix_cache=prefix_cache)
+    prompt_batches = batches(tokenizer, args.batch_size)
+
+    # Warm-up: first calls pay for kernel selection and allocator growth
+    time_prefill(plain, prompt_batches[:1], 1)
+    time_prefill(cached, prompt_batches[:1], 1)
+    plain_s = time_prefill(plain, prompt_batches, args.runs)
+    cached_s = time_prefill(cached, prompt_batches, args.runs)
+
+    mismatches = []
+    for prompts in prompt_batches:
+        items = [(p, args.check_tokens, 0.0) for p in prompts]
+        for prompt, a, b in zip(prompts, plain(items), cached(items)):
+            if a["text"] != b["text"]:
+                mismatches.append({"prompt_tail": prompt[-60:], "plain": a["text"], "cached": b["text"]})
+
+    prompt_tokens = [len(tokenizer(p, add_special_tokens=False)["input_ids"]) for b in prompt_batches for p in b]
+    print(json.dumps({
+        "model": args.hf_model,
+        "requests": len(prompt_tokens),
+        "batch_size": args.batch_size,
+        "mean_prompt_tokens": round(statistics.mean(prompt_tokens), 1),
+        "prefill_ms_plain": round(plain_s * 1000, 1),
+        "prefill_ms_cached": round(cached_s * 1000, 1),
+        "speedup": round(plain_s / cached_s, 2) if cached_s else None,
+        "prefix_cache": prefix_cache.stats(),
+        "mismatches": mismatches,
+    }, indent=2, ensure_ascii=False))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
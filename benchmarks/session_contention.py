@@ -0,0 +1,146 @@
+"""
+Many worker processes hammering the same sessions through one shared store.
+
+    python -m benchmarks.session_contention --processes 8 --sessions 3 --turns 40
+    python -m benchmarks.session_contention --backend json
+
+Every process runs turns against randomly chosen shared sessions: it reloads
+the session history from the store, runs the synchronous summarization check
+(threshold kept low so summaries race constantly) and appends a user and an
+assistant message. Afterwards the store is checked for lost or duplicated
+messages, lost memory updates (every successful summary must own a distinct
+version, versions must be contiguous) and duplicate summarization (the
+summarized range must strictly advance with each version). Exits 1 on any
+violation.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.llm_client import LLMClient
+from src.metrics import metrics
+from src.mock_llm_server import MockLLMServer
+from src.session_memory import SessionMemoryManager
+from src.storage import JsonFileBackend, SQLiteBackend, StorageManager
+from src.token_counter import ConversationBuffer
+
+FILLER = "we compared connection pooling, retries, batching and caching for the inference service again"
+
+
+def make_backend(kind: str, path: Path):
+    if kind == "json":
+        return JsonFileBackend(path)
+    return SQLiteBackend(path, legacy_dir=None)
+
+
+def worker(args) -> Dict:
+    worker_id, base_url, backend, store_path, session_ids, turns, threshold, seed = args
+    StorageManager.set_backend(make_backend(backend, store_path))
+    llm = LLMClient(base_url=base_url)
+    rng = random.Random(seed)
+    summaries = []
+    written: Dict[str, List[str]] = {}
+
+    for turn in range(turns):
+        session_id = rng.choice(session_ids)
+        messages = ConversationBuffer(StorageManager.load_messages(session_id))
+        memory_manager = SessionMemoryManager(session_id, llm)
+        summary = memory_manager.check_and_summarize(messages, threshold)
+        if summary:
+            summaries.append([session_id, memory_manager.version, summary.message_range_summarized.to_index])
+
+        marker = f"w{worker_id}-t{turn}"
+        StorageManager.append_messages(session_id, [
+            {"role": "user", "content": f"{marker} question: {FILLER}"},
+            {"role": "assistant", "content": f"{marker} answer: {FILLER}"},
+        ])
+        written.setdefault(session_id, []).append(marker)
+
+    counters = {f"{name}{dict(labels)}": value for (name, labels), value in metrics.counters.items()
+                if name in ("summaries_total", "summary_lease_busy_total")}
+    return {"summaries": summaries, "written": written, "counters": counters}
+
+
+def verify(results: List[Dict], session_ids: List[str]) -> List[str]:
+    errors = []
+    for session_id in session_ids:
+        stored = StorageManager.load_messages(session_id)
+        markers = [m["content"].split(" ", 1)[0] for m in stored]
+        expected = [marker for r in results for marker in r["written"].get(session_id, [])]
+        if len(stored) != 2 * len(expected):
+            errors.append(f"{session_id}: {len(stored)} messages stored, expected {2 * len(expected)}")
+        for marker in expected:
+            if markers.count(marker) != 2:
+                errors.append(f"{session_id}: turn {marker} stored {markers.count(marker)} times")
+
+        summaries = sorted((s for r in results for s in r["summaries"] if s[0] == session_id), key=lambda s: s[1])
+        versions = [s[1] for s in summaries]
+        if versions != list(range(1, len(versions) + 1)):
+            errors.append(f"{session_id}: summary versions {versions} are not unique and contiguous (lost update)")
+        to_indices = [s[2] for s in summaries]
+        if any(b <= a for a, b in zip(to_indices, to_indices[1:])):
+            errors.append(f"{session_id}: summarized ranges did not advance {to_indices} (duplicate summarization)")
+
+        data, version = StorageManager.load_session_memory_versioned(session_id)
+        if version != len(summaries):
+            errors.append(f"{session_id}: stored version {version} != {len(summaries)} successful summaries")
+        if summaries and data.get("message_range_summarized", {}).get("to_index") != to_indices[-1]:
+            errors.append(f"{session_id}: stored memory is not the latest successful summary")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=40, help="Turns per process")
+    parser.add_argument("--threshold", type=int, default=150)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    args = parser.parse_args()
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix="contention-"))
+    store_path = tmp_dir / "sessions.db" if args.backend == "sqlite" else tmp_dir / "sessions"
+    StorageManager.set_backend(make_backend(args.backend, store_path))
+    session_ids = [f"shared_{i}" for i in range(args.sessions)]
+
+    server = MockLLMServer(latency_ms=args.latency_ms, tokens_per_second=2000, answer_tokens=10).start()
+    try:
+        start = time.perf_counter()
+        jobs = [(i, server.base_url, args.backend, store_path, session_ids, args.turns, args.threshold, i)
+                for i in range(args.processes)]
+        with multiprocessing.Pool(args.processes, maxtasksperchild=1) as pool:
+            results = pool.map(worker, jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    errors = verify(results, session_ids)
+    counters: Dict[str, float] = {}
+    for r in results:
+        for name, value in r["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    print(json.dumps({
+        "backend": args.backend,
+        "processes": args.processes,
+        "sessions": args.sessions,
+        "turns": args.processes * args.turns,
+        "elapsed_s": round(elapsed, 2),
+        "summaries": sum(len(r["summaries"]) for r in results),
+        "summarize_requests": server.requests.get("summarize", 0),
+        "counters": counters,
+        "errors": errors,
+    }, indent=2))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
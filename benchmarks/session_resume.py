@@ -0,0 +1,124 @@
+"""
+Resuming a long session: full-history load vs the unsummarized tail.
+
+    python -m benchmarks.session_resume --messages 10000 --live 20
+    python -m benchmarks.session_resume --backend json
+
+Writes a session of N messages (in turn-sized appends) whose memory summary
+covers all but the last --live messages, then times resuming it: the whole
+log into a ConversationBuffer (what the UI and server did before) vs
+load_history() (live window plus RESUME_TAIL_MESSAGES). Also reports the
+retained memory per message of a list of dicts vs a ConversationBuffer, with
+and without the content strings both have to keep.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.config import Config
+from src.session_memory import load_history
+from src.storage import JsonFileBackend, SQLiteBackend, StorageManager
+from src.token_counter import ConversationBuffer
+
+SESSION_ID = "resume_bench"
+
+
+def make_messages(n: int) -> List[Dict]:
+    start = datetime(2025, 1, 1, 9, 0, 0)
+    messages = []
+    for i in range(n):
+        ts = (start + timedelta(seconds=7 * i, microseconds=1234 * (i % 5))).isoformat()
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"Question {i}: how should we tune the batch size for "
+                                                        f"the inference service under load?", "timestamp": ts})
+        else:
+            messages.append({"role": "assistant", "content": f"Answer {i}: start from 8 and watch p95 latency.",
+                             "is_clarification": False, "timestamp": ts})
+    return messages
+
+
+def timed(fn: Callable, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def retained_bytes(build: Callable) -> int:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    obj = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del obj
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--live", type=int, default=20, help="Messages after the summarized range")
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix="resume-bench-"))
+    backend = JsonFileBackend(tmp_dir / "sessions") if args.backend == "json" else \
+        SQLiteBackend(tmp_dir / "sessions.db", legacy_dir=None)
+    StorageManager.set_backend(backend)
+
+    messages = make_messages(args.messages)
+    start = time.perf_counter()
+    for i in range(0, len(messages), 2):
+        StorageManager.append_messages(SESSION_ID, messages[i:i + 2])
+    append_ms = (time.perf_counter() - start) * 1000 / (len(messages) / 2)
+    summarized_to = args.messages - args.live - 1
+    StorageManager.save_session_memory(SESSION_ID, {
+        "session_summary": {"key_facts": ["Batch size tuning is in progress"]},
+        "message_range_summarized": {"from_index": 0, "to_index": summarized_to,
+                                     "total_messages": summarized_to + 1, "timestamp": messages[-1]["timestamp"]},
+        "metadata": {"tokens_saved": 0, "compression_ratio": 1.0},
+    })
+
+    # Warm the tokenizer so neither side pays for loading it
+    ConversationBuffer(messages[:2])
+    full_ms = timed(lambda: ConversationBuffer(StorageManager.load_messages(SESSION_ID)), args.runs)
+    tail_ms = timed(lambda: load_history(SESSION_ID), args.runs)
+    resumed = load_history(SESSION_ID)
+    assert len(resumed) == args.messages and resumed[-1] == messages[-1]
+
+    loaded = StorageManager.load_messages(SESSION_ID)
+    content_bytes = sum(sys.getsizeof(m["content"]) for m in loaded)
+    dict_bytes = retained_bytes(lambda: [json.loads(json.dumps(m)) for m in loaded])
+    buffer_bytes = retained_bytes(lambda: ConversationBuffer([json.loads(json.dumps(m)) for m in loaded]))
+
+    n = len(loaded)
+    print(json.dumps({
+        "backend": args.backend,
+        "messages": n,
+        "append_ms_per_turn": round(append_ms, 3),
+        "resume_full_ms": round(full_ms, 2),
+        "resume_tail_ms": round(tail_ms, 2),
+        "resume_tail_loaded": len(resumed) - resumed.offset,
+        "tail_window": Config.RESUME_TAIL_MESSAGES,
+        "bytes_per_message_dicts": round(dict_bytes / n, 1),
+        "bytes_per_message_buffer": round(buffer_bytes / n, 1),
+        "overhead_bytes_per_message_dicts": round((dict_bytes - content_bytes) / n, 1),
+        "overhead_bytes_per_message_buffer": round((buffer_bytes - content_bytes) / n, 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Cold-start cost of the pipeline, measured in fresh interpreter processes.
+
+    python -m benchmarks.startup --runs 5
+
+For each run a new Python process imports the pipeline modules, builds the
+objects a worker builds (LLM client, query processor, memory manager,
+orchestrator) and runs one chat turn against the local mock LLM server.
+Reports the median of: interpreter startup, import time of the pipeline,
+object construction, the first turn (tokenizer load and pydantic schema
+builds land here), the whole process wall time, and the slowest imports as
+reported by `python -X importtime`. Nothing from src/ is imported by this
+module itself, so the parent process does not skew the children.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+PIPELINE_MODULES = ["src.orchestrator", "src.session_memory", "src.query_processor", "src.llm_client"]
+
+
+def child_first_turn(base_url: str, db_path: str):
+    """Runs in the measured process: import -> build -> one turn, printing timings as JSON."""
+    start = time.perf_counter()
+    from src.llm_client import LLMClient
+    from src.orchestrator import TurnOrchestrator
+    from src.query_processor import QueryProcessor
+    from src.session_memory import SessionMemoryManager
+    from src.storage import SQLiteBackend, StorageManager
+    imported = time.perf_counter()
+
+    StorageManager.set_backend(SQLiteBackend(Path(db_path), legacy_dir=None))
+    llm = LLMClient(base_url=base_url)
+    memory_manager = SessionMemoryManager("startup", llm)
+    orchestrator = TurnOrchestrator(llm, QueryProcessor(llm), memory_manager)
+    built = time.perf_counter()
+
+    orchestrator.run_turn("How do I add retries to my FastAPI client?", [])
+    done = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "init_ms": (built - imported) * 1000,
+        "first_turn_ms": (done - built) * 1000,
+    }))
+
+
+def _run(args: List[str], env: Dict[str, str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+
+
+def interpreter_startup_ms(env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    _run(["-c", "pass"], env)
+    return (time.perf_counter() - start) * 1000
+
+
+def slowest_imports(env: Dict[str, str], top: int) -> List[Dict]:
+    """Cumulative import time of the pipeline modules and their direct dependencies."""
+    result = _run(["-X", "importtime", "-c", "import " + ", ".join(PIPELINE_MODULES)], env)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # importtime indents nested imports by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            rows.append({"module": name.strip(), "cumulative_ms": int(cumulative_us) / 1000,
+                         "self_ms": int(self_us) / 1000})
+    return sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top-imports", type=int, default=10)
+    parser.add_argument("--child", nargs=2, metavar=("BASE_URL", "DB_PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_first_turn(*args.child)
+        return
+
+    import tempfile
+    from src.mock_llm_server import MockLLMServer
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get("PYTHONPATH")])))
+    tmp_dir = Path(tempfile.mkdtemp(prefix="startup-bench-"))
+    server = MockLLMServer(latency_ms=0, tokens_per_second=100000, answer_tokens=20).start()
+    samples: Dict[str, List[float]] = {"interpreter_ms": [], "import_ms": [], "init_ms": [], "first_turn_ms": [],
+                                       "process_wall_ms": []}
+    try:
+        for i in range(args.runs):
+            samples["interpreter_ms"].append(interpreter_startup_ms(env))
+            start = time.perf_counter()
+            result = _run(["-m", "benchmarks.startup", "--child", server.base_url, str(tmp_dir / f"run{i}.db")], env)
+            samples["process_wall_ms"].append((time.perf_counter() - start) * 1000)
+            for name, value in json.loads(result.stdout.strip().splitlines()[-1]).items():
+                samples[name].append(value)
+    finally:
+        server.stop()
+
+    report = {name: round(statistics.median(values), 1) for name, values in samples.items()}
+    report["runs"] = args.runs
+    report["slowest_imports"] = slowest_imports(env, args.top_imports)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+End-to-end chat turn latency against the local mock LLM server.
+
+    python -m benchmarks.turn_latency --sessions 8 --latency-ms 50 --tokens-per-second 200
+
+Every simulated session replays the user turns of
+tests/test_data/long_conversation.jsonl followed by the example queries in
+tests/test_data/test_queries.md through the same pipeline the UI runs:
+SessionMemoryManager -> TurnOrchestrator (QueryProcessor + answer generation).
+Reports p50/p95/p99 turn latency, throughput, LLM calls and tokens per turn.
+Compare --pipeline-mode two_call (analysis call, then answer call) with fused
+(one generation for both).
+"""
+import argparse
+import json
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.config import Config
+from src.llm_client import LLMClient
+from src.mock_llm_server import MockLLMServer
+from src.orchestrator import TurnOrchestrator, speculation_stats
+from src.query_classifier import get_query_classifier
+from src.query_processor import QueryProcessor
+from src.response_cache import get_response_cache
+from src.session_memory import SessionMemoryManager
+from src.storage import SQLiteBackend, StorageManager
+from src.token_counter import ConversationBuffer
+
+
+class CountingLLMClient(LLMClient):
+    """Counts every LLM round trip made on behalf of one session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def chat_completion(self, messages, json_mode=False, response_model=None):
+        self._count()
+        return super().chat_completion(messages, json_mode, response_model)
+
+    def stream_chat_completion(self, messages, json_mode=False, response_model=None):
+        self._count()
+        return super().stream_chat_completion(messages, json_mode, response_model)
+
+
+def load_turns() -> List[str]:
+    turns = [
+        json.loads(line)["message"]["content"]
+        for line in (Config.TEST_DATA_DIR / "long_conversation.jsonl").read_text(encoding="utf-8").splitlines()
+        if line.strip() and json.loads(line)["message"]["role"] == "user"
+    ]
+    for line in (Config.TEST_DATA_DIR / "test_queries.md").read_text(encoding="utf-8").splitlines():
+        match = re.match(r"\s*>\s*\**(.+?)\**\s*$", line)
+        if match:
+            turns.append(match.group(1))
+    return turns
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_session(session_id: str, base_url: str, turns: List[str], threshold: int,
+                pipeline_mode: str = Config.PIPELINE_MODE) -> Dict:
+    llm = CountingLLMClient(base_url=base_url)
+    memory_manager = SessionMemoryManager(session_id, llm)
+    orchestrator = TurnOrchestrator(llm, QueryProcessor(llm), memory_manager, pipeline_mode=pipeline_mode)
+    messages = ConversationBuffer()
+    latencies = []
+
+    for query in turns:
+        start = time.perf_counter()
+        memory_manager.check_and_summarize_async(messages, threshold)
+        history = memory_manager.live_messages(messages)
+        result = orchestrator.run_turn(query, history)
+        latencies.append(time.perf_counter() - start)
+        messages.append({"role": "user", "content": query})
+        messages.append({"role": "assistant", "content": result.response_text or ""})
+
+    return {"latencies": latencies, "llm_calls": llm.calls}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=8, help="Concurrent sessions")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--malformed-every", type=int, default=0)
+    parser.add_argument("--json-ramble-tokens", type=int, default=0, help="Trailing prose the mock emits after JSON")
+    parser.add_argument("--threshold", type=int, default=Config.MEMORY_THRESHOLD_TOKENS)
+    parser.add_argument("--no-response-cache", action="store_true", help="Send every analysis/answer to the LLM")
+    parser.add_argument("--pipeline-mode", choices=["two_call", "fused"], default=Config.PIPELINE_MODE)
+    args = parser.parse_args()
+    get_response_cache().enabled = not args.no_response_cache
+
+    # Keep benchmark sessions out of data/
+    tmp_dir = Path(tempfile.mkdtemp(prefix="turn-bench-"))
+    StorageManager.set_backend(SQLiteBackend(tmp_dir / "bench.db", legacy_dir=None))
+
+    turns = load_turns()
+    server = MockLLMServer(latency_ms=args.latency_ms, tokens_per_second=args.tokens_per_second,
+                           answer_tokens=args.answer_tokens, malformed_every=args.malformed_every,
+                           json_ramble_tokens=args.json_ramble_tokens).start()
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+            results = list(pool.map(
+                lambda i: run_session(f"bench_{i}", server.base_url, turns, args.threshold, args.pipeline_mode),
+                range(args.sessions),
+            ))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    latencies = [lat for r in results for lat in r["latencies"]]
+    total_turns = len(latencies)
+    report = {
+        "sessions": args.sessions,
+        "pipeline_mode": args.pipeline_mode,
+        "turns": total_turns,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1),
+        "throughput_turns_per_s": round(total_turns / elapsed, 2),
+        "llm_calls_per_turn": round(sum(r["llm_calls"] for r in results) / total_turns, 3),
+        # Counted by the server: usage in streams closed early never reaches the client
+        "prompt_tokens_per_turn": round(server.tokens["prompt"] / total_turns, 1),
+        "completion_tokens_per_turn": round(server.tokens["completion"] / total_turns, 1),
+        "server_requests": server.requests,
+        "fast_path": get_query_classifier().stats(),
+        "speculation": speculation_stats.stats(),
+        "response_cache": get_response_cache().stats(),
+        "json_early_stop": Config.JSON_EARLY_STOP,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,21 +10,29 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from src.config import Config
 from src.llm_client import LLMClient
-from src.session_memory import SessionMemoryManager
+from src.session_memory import SessionMemoryManager, load_history
 from src.query_processor import QueryProcessor
-from src.token_counter import TokenCounter
+from src.query_classifier import get_query_classifier
+from src.orchestrator import TurnOrchestrator, speculation_stats
+from src.metrics import start_metrics_server
+from src.response_cache import get_response_cache
+from src.token_counter import get_token_counter
 from src.storage import StorageManager
 
 # Logging Setup
 logging.basicConfig(level=logging.INFO)
+# Prometheus /metrics endpoint (once per process; disabled when METRICS_PORT=0)
+start_metrics_server()
 
 st.set_page_config(page_title="AI Backend Architect Demo", layout="wide")
 
 # Initialize Session State
-if "messages" not in st.session_state:
-    st.session_state.messages = []
 if "session_id" not in st.session_state:
     st.session_state.session_id = "demo_session_01"
+if "messages" not in st.session_state:
+    # Caches per-message token counts so the threshold check is O(1) per turn.
+    # Resume from the persisted message log: only the unsummarized tail is read.
+    st.session_state.messages = load_history(st.session_state.session_id)
 if "pipeline_logs" not in st.session_state:
     st.session_state.pipeline_logs = []
 
@@ -39,7 +47,7 @@ custom_session_id = st.sidebar.text_input("Session ID", value=st.session_state.s
 # Logic: Nếu người dùng đổi tên Session ID -> Reset lại bộ nhớ và tin nhắn hiển thị
 if custom_session_id != st.session_state.session_id:
     st.session_state.session_id = custom_session_id
-    st.session_state.messages = [] # Xóa chat trên màn hình để bắt đầu mới
+    st.session_state.messages = load_history(custom_session_id) # Nạp lại lịch sử của session mới
     st.session_state.pipeline_logs = []
     st.rerun() # Load lại trang để áp dụng ID mới
 
@@ -50,13 +58,14 @@ llm_client = LLMClient(base_url=api_url)
 # Memory Manager sẽ khởi tạo theo Session ID hiện tại
 memory_manager = SessionMemoryManager(st.session_state.session_id, llm_client)
 query_processor = QueryProcessor(llm_client)
-token_counter = TokenCounter()
+orchestrator = TurnOrchestrator(llm_client, query_processor, memory_manager)
+token_counter = get_token_counter()
 
 st.sidebar.divider()
 st.sidebar.subheader("📊 Token Monitor")
 
-# Tính toán token hiện tại
-current_token_count = token_counter.count_messages(st.session_state.messages)
+# Tính toán token hiện tại (only messages not yet folded into the summary)
+current_token_count = memory_manager.live_token_count(st.session_state.messages)
 
 usage_percent = min(current_token_count / threshold, 1.0)
 st.sidebar.progress(usage_percent, text=f"Used: {current_token_count} / {threshold} tokens")
@@ -143,8 +152,13 @@ with st.sidebar:
     st.divider()
     if st.button("Load Long Conversation (Trigger Memory)"):
         data = StorageManager.load_test_data("long_conversation.jsonl")
-        if data:
-            st.session_state.messages = [d["message"] for d in data]
+        # Loaded only into an empty session: repeated clicks would otherwise append the fixture again
+        if data and StorageManager.count_messages(st.session_state.session_id):
+            st.warning("This session already has messages; switch to a new Session ID to load the fixture.")
+        elif data:
+            # Append to the session's log and resume from it, so buffer indices stay log positions
+            StorageManager.append_messages(st.session_state.session_id, [d["message"] for d in data])
+            st.session_state.messages = load_history(st.session_state.session_id)
             st.toast(f"Loaded {len(data)} messages!", icon="✅")
             summary = memory_manager.check_and_summarize(st.session_state.messages, threshold)
             if summary:
@@ -153,6 +167,8 @@ with st.sidebar:
 # --- Chat Logic ---
 if selected_tab == "💬 Chat Interface":
     # Display History
+    if st.session_state.messages.offset:
+        st.caption(f"🗂️ {st.session_state.messages.offset} earlier messages are folded into the session memory.")
     for msg in st.session_state.messages:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
@@ -174,47 +190,45 @@ if selected_tab == "💬 Chat Interface":
             
             # Step A: Check Memory
             st.write("Checking Context Size...")
-            summary = memory_manager.check_and_summarize(st.session_state.messages, threshold)
-            if summary:
-                st.write("⚠️ Threshold exceeded! Summarizing history...")
+            # Summarization runs in the background; this turn keeps the previous memory
+            summary_job = memory_manager.check_and_summarize_async(st.session_state.messages, threshold)
+            if summary_job:
+                st.write("⚠️ Threshold exceeded! Summarizing history in background...")
 
-            # Step B: Query Understanding
+            # Step B: Query Understanding (answer generation may start speculatively in parallel)
             st.write("Analyzing Query Ambiguity...")
-            memory_context = memory_manager.get_context_string()
             
-            # Process query with history (excluding current prompt yet)
-            analysis = query_processor.process_query(
-                query=prompt, 
-                recent_history=st.session_state.messages, 
-                memory_context=memory_context
-            )
-
-            # --- [CRITICAL LOGIC] OVERRIDE CONFIDENCE SCORE ---
-            if analysis.is_ambiguous and analysis.confidence_score < 0.9:
-                analysis.requires_clarification = True
-                if not analysis.clarifying_questions:
-                    analysis.clarifying_questions = [
-                        f"I'm not 100% sure what '{prompt}' refers to in this context. Could you clarify?",
-                        f"Are you asking about {analysis.rewritten_query}?"
-                    ]
+            # Process query with live history (excluding current prompt yet);
+            # summarized messages are represented by the memory context instead
+            live_history = memory_manager.live_messages(st.session_state.messages)
+            turn = orchestrator.prepare_turn(prompt, live_history)
+            analysis = turn.analysis
 
             st.session_state.pipeline_logs.append(
                 {"step": "Query Analysis", "details": analysis.model_dump()}
             )
+            if turn.context:
+                st.session_state.pipeline_logs.append(
+                    {"step": "Context Packing", "details": turn.context.model_dump()}
+                )
+            if turn.cache_hits:
+                st.session_state.pipeline_logs.append(
+                    {"step": "Response Cache", "details": {"hits": turn.cache_hits}}
+                )
+            if turn.speculation.attempted:
+                st.session_state.pipeline_logs.append(
+                    {"step": "Speculative Answer", "details": turn.speculation.model_dump()}
+                )
 
             # Initialize flow variables
-            is_clarification = False
-            response_text = ""
+            is_clarification = turn.is_clarification
+            response_text = turn.response_text or ""
+            response_stream = None
 
             # --- BRANCHING LOGIC ---
-            if analysis.requires_clarification:
+            if is_clarification:
                 # [PATH 1: STOP & ASK]
                 st.write(f"🛑 Ambiguous request (Confidence: {analysis.confidence_score}). Asking for clarification...")
-                
-                clarification_msg = analysis.clarifying_questions[0] if analysis.clarifying_questions else "Could you please clarify?"
-                
-                response_text = clarification_msg
-                is_clarification = True
                 status.update(label="Clarification Needed", state="complete", expanded=False)
 
             else:
@@ -222,68 +236,50 @@ if selected_tab == "💬 Chat Interface":
                 st.write(f"✅ Query is clear (Confidence: {analysis.confidence_score}).")
                 if analysis.is_ambiguous:
                     st.write(f"🔄 Rewritten: **{analysis.rewritten_query}**")
-                
-                st.write("Generating Response...")
-
-                context_to_use = analysis.augmented_context
-                if not context_to_use:
-                    context_to_use = "No specific context found."
-
-                # Get User Profile for Personalization
-                user_profile_str = ""
-                if memory_manager.current_memory:
-                     user_profile_str = f"User Profile/Facts: {memory_manager.current_memory.session_summary.key_facts}"
-
-                final_system_prompt = f"""
-                You are a helpful AI assistant.
-                Current Date: {datetime.now().strftime("%Y-%m-%d")}
-                
-                === USER INFORMATION ===
-                {user_profile_str}
-                
-                === CONTEXT ===
-                {context_to_use}
-                
-                INSTRUCTIONS:
-                - Answer the user's question using the CONTEXT.
-                - Maintain a helpful tone.
-                """
-                
-                # [FIX CONTEXT LOSS] Use sliding window of last 15 messages
-                recent_msgs_for_context = st.session_state.messages[-15:] 
-                
-                final_messages = [{"role": "system", "content": final_system_prompt}]
-                
-                # Append Clean History
-                for m in recent_msgs_for_context:
-                    clean_msg = {"role": m["role"], "content": m["content"]}
-                    final_messages.append(clean_msg)
-                
-                # Append Rewritten Query
-                final_messages.append({"role": "user", "content": analysis.rewritten_query})
-
-                response_text = llm_client.chat_completion(final_messages)
-                status.update(label="Complete!", state="complete", expanded=False)
+
+                if "answer" in turn.cache_hits:
+                    st.write("🗄️ Answer served from the response cache.")
+                    status.update(label="Complete!", state="complete", expanded=False)
+                elif turn.speculation.kept:
+                    st.write(f"⚡ Speculative answer kept (saved {turn.speculation.latency_saved_seconds}s).")
+                    # Streams what the speculative generation has produced so far, then the rest live
+                    response_stream = orchestrator.stream_answer(turn)
+                    status.update(label="Streaming response...", state="complete", expanded=False)
+                else:
+                    if turn.pipeline_mode == "fused":
+                        st.write("🔗 Fused mode: the answer continues the analysis generation (one LLM call).")
+                    else:
+                        st.write("Generating Response...")
+                    # Tokens are rendered in the chat bubble as they arrive (see below)
+                    response_stream = orchestrator.stream_answer(turn)
+                    status.update(label="Streaming response...", state="complete", expanded=False)
 
         # 3. Output & Update State
+        with st.chat_message("assistant"):
+            if response_stream is not None:
+                response_text = st.write_stream(response_stream)
+                orchestrator.record_answer(turn, response_text)
+            else:
+                st.markdown(response_text)
+            if is_clarification:
+                st.info("💡 I need a bit more detail to answer accurately.")
+
         # Save timestamp to session history
-        st.session_state.messages.append({
+        user_msg = {
             "role": "user", 
             "content": prompt,
             "timestamp": current_time
-        })
-        
-        st.session_state.messages.append({
+        }
+        assistant_msg = {
             "role": "assistant", 
             "content": response_text,
             "is_clarification": is_clarification,
             "timestamp": datetime.now().isoformat()
-        })
-        
-        with st.chat_message("assistant"):
-            st.markdown(response_text)
-            if is_clarification:
-                st.info("💡 I need a bit more detail to answer accurately.")
+        }
+        st.session_state.messages.append(user_msg)
+        st.session_state.messages.append(assistant_msg)
+        # Persist both messages in one batched write to the append-only log
+        StorageManager.append_messages(st.session_state.session_id, [user_msg, assistant_msg])
 
 # --- Tab: Memory View ---
 if selected_tab == "💾 Memory & State":
@@ -295,6 +291,12 @@ if selected_tab == "💾 Memory & State":
 
 # --- Tab: Pipeline Debug ---
 if selected_tab == "🛠️ Pipeline Visualizer":
+    fast_path = get_query_classifier().stats()
+    st.caption(f"⚡ Query fast path: {fast_path['fast_path_hits']}/{fast_path['total']} turns skipped the LLM analysis call (hit rate {fast_path['hit_rate']:.0%})")
+    cache_stats = get_response_cache().stats()
+    st.caption(f"🗄️ Response cache: analysis hit rate {cache_stats['analysis']['hit_rate']:.0%}, answer hit rate {cache_stats['answer']['hit_rate']:.0%}")
+    spec = speculation_stats.stats()
+    st.caption(f"🔮 Speculation: {spec['kept']}/{spec['attempted']} kept, {spec['latency_saved_seconds']}s saved, {spec['wasted_tokens']} tokens wasted")
     st.subheader("Pipeline Logs")
     for log in reversed(st.session_state.pipeline_logs):
         with st.expander(f"{log['step']}"):
@@ -0,0 +1,362 @@
+"""
+Batch evaluation of query analysis and summarization.
+
+    python run_eval.py tests/test_data/eval_cases.jsonl -o data/eval/results.jsonl --concurrency 16
+    python run_eval.py cases.jsonl -o results.jsonl --stages analyze --no-fast-path
+    python run_eval.py tests/test_data/eval_cases.jsonl -o /tmp/results.jsonl --mock   # no GPU server
+
+Each input line is one case:
+
+    {"id": "q1", "query": "Why is it so slow?",
+     "history": [{"role": "user", "content": "..."}, ...],
+     "memory": {...SessionMemory or just its session_summary...},
+     "threshold": 200,
+     "expected": {"is_ambiguous": true, "requires_clarification": true}}
+
+Only "query" is required ("id" defaults to the line number). Cases run
+concurrently through the same components the chat UI uses: the history is
+summarized by SessionMemoryManager when it exceeds the threshold (stage
+"summarize"), then QueryProcessor analyzes the query against the live history
+and the memory context (stage "analyze": fast path, else LLM; the response
+cache is bypassed unless --response-cache). Every finished case is appended
+to the output JSONL together with per-stage latency, token counts and LLM
+calls, and any "expected" fields are checked against the analysis.
+
+The output file is the checkpoint: rerunning with the same output skips cases
+that already have an "ok" record and retries the rest (the last record of a
+case wins). A summary over all records is printed at the end.
+"""
+import argparse
+import json
+import logging
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from src.config import Config
+from src.llm_client import LLMClient
+from src.models import MessageRange, SessionMemory, SessionSummaryData, SummaryMetadata
+from src.query_processor import QueryProcessor
+from src.response_cache import ResponseCache, get_response_cache
+from src.session_memory import SessionMemoryManager
+from src.storage import SQLiteBackend, StorageManager
+from src.token_counter import ConversationBuffer, get_token_counter
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("summarize", "analyze")
+
+
+class UsageTrackingLLMClient(LLMClient):
+    """
+    Counts LLM calls and tokens made on behalf of one case. Tokens are counted
+    locally: with JSON early stop the stream is closed before the server's
+    usage chunk arrives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_counter = get_token_counter()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def _record(self, messages: List[Dict[str, str]], output: str):
+        self.calls += 1
+        self.prompt_tokens += self.token_counter.count_messages(messages)
+        self.completion_tokens += self.token_counter.count_tokens(output)
+
+    def chat_completion(self, messages, json_mode=False, response_model=None):
+        output = super().chat_completion(messages, json_mode, response_model)
+        self._record(messages, output)
+        return output
+
+    def json_completion(self, messages, pydantic_model):
+        if Config.JSON_EARLY_STOP != "client":
+            # Goes through chat_completion, which records it
+            return super().json_completion(messages, pydantic_model)
+        output = super().json_completion(messages, pydantic_model)
+        self._record(messages, output)
+        return output
+
+
+def load_cases(path: Path) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            if not case.get("query"):
+                raise ValueError(f"{path}:{line_no}: case has no 'query'")
+            case.setdefault("id", str(line_no))
+            case["id"] = str(case["id"])
+            yield case
+
+
+def load_records(path: Path) -> Dict[str, Dict[str, Any]]:
+    """Last record per case id in an existing output file (a torn last line is ignored)."""
+    records: Dict[str, Dict[str, Any]] = {}
+    if not path.exists():
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping unreadable line in {path}")
+                continue
+            records[record["id"]] = record
+    return records
+
+
+def to_session_memory(memory: Dict[str, Any]) -> SessionMemory:
+    """Accepts a full SessionMemory or just a session_summary."""
+    if "session_summary" in memory:
+        return SessionMemory(**memory)
+    return SessionMemory(
+        session_summary=SessionSummaryData(**memory),
+        message_range_summarized=MessageRange(from_index=0, to_index=-1, total_messages=0, timestamp=""),
+        metadata=SummaryMetadata(tokens_saved=0, compression_ratio=1.0),
+    )
+
+
+def check_expected(expected: Dict[str, Any], analysis: Dict[str, Any]) -> Dict[str, bool]:
+    return {field: analysis.get(field) == value for field, value in expected.items()}
+
+
+class BatchEvaluator:
+    """Runs cases through SessionMemoryManager and QueryProcessor and appends records to a JSONL file."""
+
+    def __init__(
+        self,
+        base_url: str,
+        output: Path,
+        concurrency: int = 8,
+        stages=STAGES,
+        threshold: int = Config.MEMORY_THRESHOLD_TOKENS,
+        use_fast_path: bool = Config.QUERY_FAST_PATH,
+        use_response_cache: bool = False,
+    ):
+        self.base_url = base_url
+        self.output = output
+        self.concurrency = concurrency
+        self.stages = stages
+        self.threshold = threshold
+        self.use_fast_path = use_fast_path
+        self.response_cache = get_response_cache() if use_response_cache else ResponseCache(enabled=False)
+        self.token_counter = get_token_counter()
+        # Eval sessions never touch data/: a throwaway store per run
+        self.run_id = time.strftime("%Y%m%d%H%M%S")
+        store_dir = Path(tempfile.mkdtemp(prefix="eval-"))
+        StorageManager.set_backend(SQLiteBackend(store_dir / "eval.db", legacy_dir=None))
+        self._write_lock = threading.Lock()
+
+    def _client(self) -> UsageTrackingLLMClient:
+        # All clients share one keep-alive pool sized for the concurrency
+        return UsageTrackingLLMClient(base_url=self.base_url,
+                                      pool_maxsize=max(self.concurrency, Config.LLM_POOL_MAXSIZE))
+
+    def run_case(self, case: Dict[str, Any]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        record: Dict[str, Any] = {"id": case["id"], "query": case["query"], "status": "ok"}
+        latency: Dict[str, float] = {}
+        llm = self._client()
+        try:
+            session_id = f"eval-{self.run_id}-{case['id']}"
+            if case.get("memory"):
+                StorageManager.save_session_memory(session_id, to_session_memory(case["memory"]).model_dump())
+            memory_manager = SessionMemoryManager(session_id, llm)
+            history = ConversationBuffer(case.get("history") or [])
+            record["history_tokens"] = history.total_tokens
+
+            if "summarize" in self.stages:
+                stage_start = time.perf_counter()
+                summary = memory_manager.check_and_summarize(history, case.get("threshold", self.threshold))
+                latency["summarize"] = (time.perf_counter() - stage_start) * 1000
+                record["summarized"] = summary is not None
+                if summary is not None:
+                    record["summary"] = summary.session_summary.model_dump()
+                    record["summary_range"] = summary.message_range_summarized.model_dump()
+
+            memory_context = memory_manager.get_context_string()
+            record["memory_context_tokens"] = self.token_counter.count_tokens(memory_context)
+
+            if "analyze" in self.stages:
+                stage_start = time.perf_counter()
+                processor = QueryProcessor(llm, use_fast_path=self.use_fast_path, response_cache=self.response_cache)
+                live_history = memory_manager.live_messages(history)
+                analysis = processor.fast_path(case["query"], live_history, memory_context)
+                record["analysis_source"] = "fast_path"
+                if analysis is None:
+                    analysis = processor.cached_analysis(case["query"], live_history, memory_context)
+                    record["analysis_source"] = "cache"
+                if analysis is None:
+                    analysis = processor.analyze_with_llm(case["query"], live_history, memory_context)
+                    record["analysis_source"] = "llm"
+                latency["analyze"] = (time.perf_counter() - stage_start) * 1000
+                record["analysis"] = analysis.model_dump()
+                if case.get("expected"):
+                    record["checks"] = check_expected(case["expected"], record["analysis"])
+        except Exception as e:
+            logger.error(f"Case {case['id']} failed: {e}")
+            record["status"] = "error"
+            record["error"] = f"{type(e).__name__}: {e}"
+
+        latency["total"] = (time.perf_counter() - start) * 1000
+        record["latency_ms"] = {stage: round(ms, 1) for stage, ms in latency.items()}
+        record["llm_calls"] = llm.calls
+        record["prompt_tokens"] = llm.prompt_tokens
+        record["completion_tokens"] = llm.completion_tokens
+        return record
+
+    def _append(self, f, record: Dict[str, Any]):
+        with self._write_lock:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+    def run(self, cases: List[Dict[str, Any]], done: Set[str]) -> int:
+        """Runs every case not in done; returns how many ran."""
+        pending = [case for case in cases if case["id"] not in done]
+        logger.info(f"{len(pending)} cases to run ({len(cases) - len(pending)} already done), "
+                    f"concurrency {self.concurrency}")
+        if not pending:
+            return 0
+
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        # A crash may have left a partial line; start on a fresh one
+        torn = False
+        if self.output.exists() and self.output.stat().st_size:
+            with open(self.output, "rb") as f:
+                f.seek(-1, 2)
+                torn = f.read() != b"\n"
+        start = time.perf_counter()
+        finished = 0
+        with open(self.output, "a", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            if torn:
+                f.write("\n")
+            futures = [pool.submit(self.run_case, case) for case in pending]
+            for future in as_completed(futures):
+                self._append(f, future.result())
+                finished += 1
+                if finished % 100 == 0 or finished == len(pending):
+                    rate = finished / (time.perf_counter() - start)
+                    logger.info(f"{finished}/{len(pending)} cases, {rate:.1f}/s, "
+                                f"eta {(len(pending) - finished) / rate:.0f}s")
+        return finished
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(records: Dict[str, Dict[str, Any]], elapsed: Optional[float] = None) -> Dict[str, Any]:
+    ok = [r for r in records.values() if r["status"] == "ok"]
+    report: Dict[str, Any] = {
+        "cases": len(records),
+        "ok": len(ok),
+        "errors": len(records) - len(ok),
+    }
+    if elapsed:
+        report["elapsed_s"] = round(elapsed, 2)
+    if not ok:
+        return report
+
+    for stage in ("summarize", "analyze", "total"):
+        values = [r["latency_ms"][stage] for r in ok if stage in r["latency_ms"]]
+        if values:
+            report[f"{stage}_latency_ms"] = {
+                "p50": round(percentile(values, 50), 1),
+                "p95": round(percentile(values, 95), 1),
+                "mean": round(statistics.mean(values), 1),
+            }
+    report["llm_calls"] = sum(r["llm_calls"] for r in ok)
+    report["prompt_tokens"] = sum(r["prompt_tokens"] for r in ok)
+    report["completion_tokens"] = sum(r["completion_tokens"] for r in ok)
+    report["summarized"] = sum(1 for r in ok if r.get("summarized"))
+
+    sources: Dict[str, int] = {}
+    for r in ok:
+        if "analysis_source" in r:
+            sources[r["analysis_source"]] = sources.get(r["analysis_source"], 0) + 1
+    if sources:
+        report["analysis_source"] = sources
+    if any("analysis" in r for r in ok):
+        report["ambiguous_rate"] = round(
+            sum(1 for r in ok if r.get("analysis", {}).get("is_ambiguous")) / len(ok), 4)
+
+    accuracy: Dict[str, List[bool]] = {}
+    for r in ok:
+        for field, passed in r.get("checks", {}).items():
+            accuracy.setdefault(field, []).append(passed)
+    if accuracy:
+        report["accuracy"] = {field: {"cases": len(v), "accuracy": round(sum(v) / len(v), 4)}
+                              for field, v in accuracy.items()}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cases", type=Path, help="Input JSONL of cases")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="Results JSONL (also the checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated subset of: summarize,analyze")
+    parser.add_argument("--threshold", type=int, default=Config.MEMORY_THRESHOLD_TOKENS,
+                        help="Summarization threshold for cases without their own")
+    parser.add_argument("--limit", type=int, default=0, help="Only the first N cases")
+    parser.add_argument("--no-fast-path", action="store_true", help="Send every query to the LLM analyzer")
+    parser.add_argument("--response-cache", action="store_true", help="Reuse cached analyses (off by default)")
+    parser.add_argument("--restart", action="store_true", help="Discard existing results instead of resuming")
+    parser.add_argument("--base-url", default=Config.LLM_API_BASE_URL)
+    parser.add_argument("--mock", action="store_true", help="Run against the local mock LLM server")
+    parser.add_argument("--summary", type=Path, help="Also write the summary JSON here")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel(logging.INFO)
+
+    stages = tuple(s.strip() for s in args.stages.split(",") if s.strip())
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    cases = list(load_cases(args.cases))
+    if args.limit:
+        cases = cases[:args.limit]
+    if args.restart and args.output.exists():
+        args.output.unlink()
+    done = {case_id for case_id, r in load_records(args.output).items() if r["status"] == "ok"}
+
+    server = None
+    base_url = args.base_url
+    if args.mock:
+        from src.mock_llm_server import MockLLMServer
+        server = MockLLMServer(latency_ms=50, tokens_per_second=500).start()
+        base_url = server.base_url
+    try:
+        evaluator = BatchEvaluator(base_url, args.output, args.concurrency, stages, args.threshold,
+                                   use_fast_path=not args.no_fast_path, use_response_cache=args.response_cache)
+        start = time.perf_counter()
+        ran = evaluator.run(cases, done)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.stop()
+
+    case_ids = {case["id"] for case in cases}
+    records = {case_id: r for case_id, r in load_records(args.output).items() if case_id in case_ids}
+    report = summarize(records, elapsed if ran else None)
+    report["ran_this_time"] = ran
+    report["output"] = str(args.output)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.summary:
+        args.summary.write_text(text + "\n", encoding="utf-8")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
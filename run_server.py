@@ -0,0 +1,290 @@
+"""
+Headless API for the chat pipeline (summarize -> analyze -> answer).
+
+    python run_server.py --port 8080 --workers 4
+
+    POST /v1/sessions/{session_id}/turns      {"message": "...", "stream": false}
+    GET  /v1/sessions/{session_id}/memory
+    GET  /v1/sessions/{session_id}/messages?start=0&limit=50
+    GET  /healthz
+    GET  /metrics
+
+LLM clients, the query processor and per-session state are created once per
+worker process and shared across requests. Turns of one session are
+serialized by a per-session lock within a worker; across workers each turn
+first syncs history and memory from the shared store, memory updates are
+compare-and-swap and summarization is leased, so no sticky routing is needed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from src.config import Config
+from src.llm_client import AsyncLLMClient, LLMClient
+from src.metrics import metrics
+from src.orchestrator import TurnOrchestrator
+from src.query_processor import QueryProcessor
+from src.session_memory import SessionMemoryManager, load_history
+from src.storage import StorageManager
+
+logger = logging.getLogger(__name__)
+
+
+class TurnRequest(BaseModel):
+    message: str
+    stream: bool = False
+
+
+class SessionState:
+    """Per-session objects that live across requests in one worker."""
+
+    def __init__(self, session_id: str, llm_client: LLMClient, query_processor: QueryProcessor):
+        self.session_id = session_id
+        self.lock = asyncio.Lock()
+        # Requests holding this state; guarded by ChatService._sessions_lock, pinned states are never evicted
+        self.users = 0
+        # Only the unsummarized tail of the log is read; older turns live in the memory summary
+        self.messages = load_history(session_id)
+        self.memory_manager = SessionMemoryManager(session_id, llm_client)
+        self.orchestrator = TurnOrchestrator(llm_client, query_processor, self.memory_manager)
+
+
+class ChatService:
+    def __init__(self, max_sessions: int = Config.SERVER_MAX_SESSIONS, threshold: int = Config.MEMORY_THRESHOLD_TOKENS):
+        self.llm_client = LLMClient()
+        self.async_llm = AsyncLLMClient()
+        self.query_processor = QueryProcessor(self.llm_client)
+        self.threshold = threshold
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._sessions_lock = threading.Lock()
+
+    def _acquire(self, session_id: str) -> SessionState:
+        with self._sessions_lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                state.users += 1
+                return state
+        # Loading history hits storage; do it outside the registry lock
+        state = SessionState(session_id, self.llm_client, self.query_processor)
+        with self._sessions_lock:
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                existing.users += 1
+                return existing
+            state.users += 1
+            self._sessions[session_id] = state
+            # Only idle sessions are evicted; a pinned one stays so one session never has two states
+            for stale_id in list(self._sessions):
+                if len(self._sessions) <= self.max_sessions:
+                    break
+                if self._sessions[stale_id].users == 0:
+                    del self._sessions[stale_id]
+            return state
+
+    def _release(self, state: SessionState):
+        with self._sessions_lock:
+            state.users -= 1
+
+    @asynccontextmanager
+    async def session(self, session_id: str) -> AsyncIterator[SessionState]:
+        """Pins the session's state for the duration of the block."""
+        state = await asyncio.to_thread(self._acquire, session_id)
+        try:
+            yield state
+        finally:
+            self._release(state)
+
+    @staticmethod
+    def _sync(state: SessionState):
+        # Other workers may have appended turns or written a newer summary
+        newer = StorageManager.load_messages(state.session_id, len(state.messages))
+        if newer:
+            state.messages.extend(newer)
+        state.memory_manager.reload()
+
+    async def _prepare(self, state: SessionState, message: str):
+        await asyncio.to_thread(self._sync, state)
+        # Summarization is queued on the background worker; this turn keeps the previous memory
+        state.memory_manager.check_and_summarize_async(state.messages, self.threshold)
+        live_history = state.memory_manager.live_messages(state.messages)
+        return await asyncio.to_thread(state.orchestrator.prepare_turn, message, live_history)
+
+    async def _commit(self, state: SessionState, message: str, received_at: str, response_text: str,
+                      is_clarification: bool) -> int:
+        user_msg = {"role": "user", "content": message, "timestamp": received_at}
+        assistant_msg = {
+            "role": "assistant",
+            "content": response_text,
+            "is_clarification": is_clarification,
+            "timestamp": datetime.now().isoformat(),
+        }
+        first = await asyncio.to_thread(StorageManager.append_messages, state.session_id, [user_msg, assistant_msg])
+        if first is None:
+            state.messages.extend([user_msg, assistant_msg])
+            return len(state.messages) - 1
+        # Re-read the tail so the local buffer follows the store's order if another worker interleaved
+        await asyncio.to_thread(self._sync, state)
+        return first + 1
+
+    @staticmethod
+    def _turn_body(state: SessionState, turn, response_text: str, turn_index: int) -> Dict[str, Any]:
+        return {
+            "session_id": state.session_id,
+            "turn_index": turn_index,
+            "response": response_text,
+            "is_clarification": turn.is_clarification,
+            "analysis": turn.analysis.model_dump(),
+            "speculation": turn.speculation.model_dump(),
+            "context": turn.context.model_dump() if turn.context else None,
+            "cache_hits": turn.cache_hits,
+        }
+
+    async def run_turn(self, session_id: str, message: str) -> Dict[str, Any]:
+        async with self.session(session_id) as state, state.lock:
+            received_at = datetime.now().isoformat()
+            turn = await self._prepare(state, message)
+            response_text = turn.response_text
+            if response_text is None:
+                with metrics.span("answer_generation"):
+                    if turn.answer_stream is not None:
+                        # Fused mode or kept speculation: the answer is an already running (sync) stream
+                        response_text = await asyncio.to_thread(
+                            lambda: "".join(state.orchestrator.stream_answer(turn)))
+                    else:
+                        response_text = await self.async_llm.chat_completion(turn.answer_messages)
+                state.orchestrator.record_answer(turn, response_text)
+            turn_index = await self._commit(state, message, received_at, response_text, turn.is_clarification)
+            return self._turn_body(state, turn, response_text, turn_index)
+
+    async def stream_turn(self, session_id: str, message: str) -> AsyncIterator[str]:
+        """SSE events: analysis, then answer deltas, then done (with the full turn)."""
+        # The lock is held for the whole stream so the next turn sees this one in its history
+        async with self.session(session_id) as state, state.lock:
+            received_at = datetime.now().isoformat()
+            turn = await self._prepare(state, message)
+            yield _sse({"type": "analysis", "analysis": turn.analysis.model_dump()})
+
+            if turn.response_text is not None:
+                response_text = turn.response_text
+                yield _sse({"type": "delta", "content": response_text})
+            else:
+                parts = []
+                if turn.answer_stream is not None:
+                    deltas = _iterate_in_thread(state.orchestrator.stream_answer(turn))
+                else:
+                    deltas = self.async_llm.stream_chat_completion(turn.answer_messages)
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield _sse({"type": "delta", "content": delta})
+                response_text = "".join(parts)
+                state.orchestrator.record_answer(turn, response_text)
+
+            turn_index = await self._commit(state, message, received_at, response_text, turn.is_clarification)
+            yield _sse({"type": "done", **self._turn_body(state, turn, response_text, turn_index)})
+        yield "data: [DONE]\n\n"
+
+    async def aclose(self):
+        await self.async_llm.aclose()
+
+
+async def _iterate_in_thread(iterator: Iterator[str]) -> AsyncIterator[str]:
+    """Consumes a blocking iterator (a sync LLM stream) without blocking the event loop."""
+    try:
+        while True:
+            item = await asyncio.to_thread(next, iterator, None)
+            if item is None:
+                break
+            yield item
+    finally:
+        await asyncio.to_thread(iterator.close)
+
+
+def _sse(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+service: Optional[ChatService] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global service
+    service = ChatService()
+    yield
+    await service.aclose()
+
+
+app = FastAPI(title="Chat Assistant with Session Memory", lifespan=lifespan)
+
+
+@app.post("/v1/sessions/{session_id}/turns")
+async def create_turn(session_id: str, request: TurnRequest):
+    if not request.message.strip():
+        raise HTTPException(status_code=422, detail="message must not be empty")
+    if request.stream:
+        return StreamingResponse(_stream_or_error(session_id, request.message), media_type="text/event-stream")
+    try:
+        return await service.run_turn(session_id, request.message)
+    except Exception as e:
+        logger.error(f"Turn failed for session {session_id}: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+async def _stream_or_error(session_id: str, message: str) -> AsyncIterator[str]:
+    # Headers are already sent once streaming starts, so failures become an error event
+    try:
+        async for event in service.stream_turn(session_id, message):
+            yield event
+    except Exception as e:
+        logger.error(f"Streaming turn failed for session {session_id}: {e}")
+        yield _sse({"type": "error", "detail": str(e)})
+
+
+@app.get("/v1/sessions/{session_id}/memory")
+async def get_memory(session_id: str):
+    async with service.session(session_id) as state:
+        memory = state.memory_manager.current_memory
+    return memory.model_dump() if memory else {}
+
+
+@app.get("/v1/sessions/{session_id}/messages")
+async def get_messages(session_id: str, start: int = 0, limit: Optional[int] = None):
+    return await asyncio.to_thread(StorageManager.load_messages, session_id, start, limit)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "llm": service.llm_client.router.stats()}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat pipeline API server")
+    parser.add_argument("--host", default=Config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=Config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=Config.SERVER_WORKERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run("run_server:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
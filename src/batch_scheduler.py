@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+from src.config import Config
+from src.json_stream import JsonObjectScanner
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Dynamic batching in front of a blocking batch generator (e.g. a HF model).
+    Requests are queued and grouped into one batch until either max_batch_size
+    is reached or the oldest request has waited max_wait_ms. Only requests with
+    the same key (e.g. sampling params) share a batch. Each caller awaits its
+    own result.
+
+    generate_batch receives the list of submitted items and must return one
+    result per item, in order. It runs in a worker thread so the event loop
+    keeps accepting requests while the model is busy.
+    """
+
+    def __init__(
+        self,
+        generate_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = Config.BATCH_MAX_SIZE,
+        max_wait_ms: float = Config.BATCH_MAX_WAIT_MS,
+    ):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        # One model call at a time: the GPU is the serialized resource
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-gen")
+        self._pending: Deque[Tuple[Hashable, Any, asyncio.Future, float]] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item: Any, key: Hashable = None) -> Any:
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((key, item, future, time.monotonic()))
+        self._wakeup.set()
+        return await future
+
+    def _take_batch(self) -> List[Tuple[Hashable, Any, asyncio.Future, float]]:
+        """Pops up to max_batch_size pending requests sharing the oldest request's key."""
+        key = self._pending[0][0]
+        batch, rest = [], deque()
+        while self._pending and len(batch) < self.max_batch_size:
+            entry = self._pending.popleft()
+            if entry[0] == key:
+                batch.append(entry)
+            else:
+                rest.append(entry)
+        rest.extend(self._pending)
+        self._pending = rest
+        return batch
+
+    def _ready_count(self) -> int:
+        key = self._pending[0][0]
+        return sum(1 for entry in self._pending if entry[0] == key)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Wait for the batch to fill, but never past the oldest request's deadline
+            deadline = self._pending[0][3] + self.max_wait
+            while self._ready_count() < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self._take_batch()
+            items = [entry[1] for entry in batch]
+            started = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self.generate_batch, items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"generate_batch returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                logger.error(f"Batch generation failed: {e}")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - started
+                self.batches += 1
+                self.items += len(batch)
+
+            for (_, _, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": len(self._pending),
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+
+def make_json_stopping_criteria(tokenizer, batch_size: int, prefix: str = ""):
+    """
+    HF StoppingCriteria that ends each row once its first top-level JSON object
+    has closed (per-row, so finished rows are padded while the rest continue).
+    prefix is text already forced into the completion, e.g. a prefilled "{".
+    """
+    import torch
+    from transformers import StoppingCriteria
+
+    class JsonObjectStoppingCriteria(StoppingCriteria):
+        def __init__(self):
+            self.scanners = [JsonObjectScanner(prefix) for _ in range(batch_size)]
+
+        def __call__(self, input_ids, scores, **kwargs):
+            # Only the newest token is decoded; braces and quotes are single ASCII tokens
+            done = [
+                scanner.feed(tokenizer.decode(row[-1:], skip_special_tokens=True))
+                for scanner, row in zip(self.scanners, input_ids)
+            ]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return JsonObjectStoppingCriteria()
+
+
+def make_cancel_stopping_criteria(cancel):
+    """HF StoppingCriteria that ends generation once the threading.Event cancel is set."""
+    from transformers import StoppingCriteria
+
+    class CancelStoppingCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            return cancel.is_set()
+
+    return CancelStoppingCriteria()
+
+
+def truncate_to_json_object(text: str, prefix: str = "") -> str:
+    """Prefix + text cut right after the first complete JSON object (unchanged if none closed)."""
+    scanner = JsonObjectScanner()
+    scanner.feed(prefix + text)
+    return scanner.result() or prefix + text
+
+
+def make_hf_batch_generator(model, tokenizer, prefix_cache=None, **generate_kwargs) -> Callable[[List[Tuple]], List[Dict[str, Any]]]:
+    """
+    Builds a generate_batch function for a HF causal LM. Items are
+    (prompt, max_new_tokens, temperature[, json_prefix]); prompts are
+    left-padded into one tensor and each output is truncated to its own
+    max_new_tokens. When json_prefix is given (str, possibly "" - batch such
+    requests under their own key) rows stop at the end of their JSON object.
+    With a PrefixKVCache, batches whose prompts share a cached static prefix
+    skip its prefill. Each result is {"text", "prompt_tokens", "completion_tokens"}.
+    """
+    import torch
+
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    def generate_batch(items: List[Tuple]) -> List[Dict[str, Any]]:
+        prompts = [item[0] for item in items]
+        max_new_tokens = max(item[1] for item in items)
+        temperature = items[0][2]
+        json_prefixes = [item[3] if len(item) > 3 else None for item in items]
+        extra_kwargs = dict(generate_kwargs)
+        if json_prefixes[0] is not None:
+            from transformers import StoppingCriteriaList
+            criteria = make_json_stopping_criteria(tokenizer, len(items), json_prefixes[0])
+            extra_kwargs["stopping_criteria"] = StoppingCriteriaList([criteria])
+        if prefix_cache is not None:
+            inputs, past_key_values = prefix_cache.prepare_inputs(prompts)
+            if past_key_values is not None:
+                extra_kwargs["past_key_values"] = past_key_values
+        else:
+            # Chat-template prompts already carry BOS/special tokens
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(model.device)
+        with torch.no_grad():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                do_sample=temperature > 0,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                **extra_kwargs,
+            )
+        generated = output[:, inputs["input_ids"].shape[1]:]
+        prompt_lengths = inputs["attention_mask"].sum(dim=1).tolist()
+        results = []
+        for tokens, prompt_tokens, item, json_prefix in zip(generated, prompt_lengths, items, json_prefixes):
+            tokens = tokens[:item[1]]
+            # Finished rows are filled with pad (== eos for Llama 3) after they stop
+            completion_tokens = int((tokens != tokenizer.pad_token_id).sum())
+            text = tokenizer.decode(tokens, skip_special_tokens=True)
+            if json_prefix is not None:
+                text = truncate_to_json_object(text, json_prefix)
+            results.append({
+                "text": text.strip(),
+                "prompt_tokens": int(prompt_tokens),
+                "completion_tokens": completion_tokens,
+            })
+        return results
+
+    return generate_batch
@@ -1,26 +1,131 @@
 import os
-from dotenv import load_dotenv
 from pathlib import Path
 
-load_dotenv()
+
+def _load_env_file():
+    """
+    Loads .env (project root, then working directory) into the environment.
+    This is the only thing importing this module does: python-dotenv is only
+    imported when a .env file exists, and no directories are created here.
+    """
+    for candidate in (Path(__file__).resolve().parent.parent / ".env", Path.cwd() / ".env"):
+        if candidate.is_file():
+            from dotenv import load_dotenv
+            load_dotenv(candidate)
+            return
+
+
+_load_env_file()
 
 class Config:
-    # LLM Settings
+    # LLM Settings (several OpenAI-compatible backends may be given, comma-separated)
     LLM_API_BASE_URL = os.getenv("LLM_API_BASE_URL", "http://localhost:8000/v1")
     MODEL_NAME = "meta-llama/Meta-Llama-3-8B-Instruct"
+
+    # LLM Transport (connection pooling / timeouts)
+    LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "10"))
+    LLM_POOL_MAXSIZE = int(os.getenv("LLM_POOL_MAXSIZE", "100"))
+    LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+    LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+    LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+    # LLM Routing: retries, per-backend circuit breaker, hedged requests past the p95 latency
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_RETRY_BACKOFF_MS = float(os.getenv("LLM_RETRY_BACKOFF_MS", "200"))
+    LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+    LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+    LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+    LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+    # Threads running hedged duplicates; a hedge is skipped while all are busy
+    LLM_HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "16"))
+    LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
     
+    # Query Understanding: rule-based fast path before the LLM analysis call
+    QUERY_FAST_PATH = os.getenv("QUERY_FAST_PATH", "true").lower() == "true"
+    # Start answer generation concurrently with query analysis when the query looks unambiguous
+    SPECULATIVE_ANSWERS = os.getenv("SPECULATIVE_ANSWERS", "true").lower() == "true"
+    SPECULATION_WORKERS = int(os.getenv("SPECULATION_WORKERS", "4"))
+    # "two_call": analysis call, then answer call; "fused": one generation emits the analysis JSON, then the answer
+    PIPELINE_MODE = os.getenv("PIPELINE_MODE", "two_call").lower()
+
+    # JSON calls (analysis/summary) end at the object's closing brace:
+    # "server": non-streamed request with stop_on_json_end (the server stops there and can batch the request);
+    # "client": stream and close the connection at the brace, for servers without stop_on_json_end;
+    # "off": plain JSON-mode completion. "true"/"false" are read as "server"/"off".
+    JSON_EARLY_STOP = os.getenv("JSON_EARLY_STOP", "server").lower()
+    JSON_EARLY_STOP = {"true": "server", "false": "off"}.get(JSON_EARLY_STOP, JSON_EARLY_STOP)
+
+    # Inference server dynamic batching (colab_server.ipynb)
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+    BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+    # Streamed requests each run their own generate thread; at most this many at once
+    STREAM_MAX_CONCURRENCY = int(os.getenv("STREAM_MAX_CONCURRENCY", "4"))
+
+    # Inference server prefix caching: reuse the prefill (KV) of static system prompts
+    PREFIX_CACHE_MAX_ENTRIES = int(os.getenv("PREFIX_CACHE_MAX_ENTRIES", "8"))
+    PREFIX_CACHE_MAX_TOKENS = int(os.getenv("PREFIX_CACHE_MAX_TOKENS", "16384"))
+    # Shorter prefixes are not worth caching; a prefix is cached once seen this many times (or warmed)
+    PREFIX_CACHE_MIN_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "64"))
+    PREFIX_CACHE_MIN_SEEN = int(os.getenv("PREFIX_CACHE_MIN_SEEN", "2"))
+
+    # Headless API server (run_server.py)
+    SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+    SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+    SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+    # Per-worker cap on sessions kept in memory (history buffer + memory manager)
+    SERVER_MAX_SESSIONS = int(os.getenv("SERVER_MAX_SESSIONS", "1024"))
+
     # Memory Settings
     # Default threshold (low for demo purposes, can be overridden)
     MEMORY_THRESHOLD_TOKENS = int(os.getenv("MEMORY_THRESHOLD_TOKENS", "1000")) 
+    # Memory compaction: per-section token cap for summary lists
+    MEMORY_SECTION_TOKEN_CAP = int(os.getenv("MEMORY_SECTION_TOKEN_CAP", "200"))
+    # Background summarization pool size
+    SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))
+
+    # Prompt token budgets for the context packer (system prompt + memory + snippets + recent turns)
+    ANSWER_CONTEXT_BUDGET_TOKENS = int(os.getenv("ANSWER_CONTEXT_BUDGET_TOKENS", "4096"))
+    ANALYSIS_CONTEXT_BUDGET_TOKENS = int(os.getenv("ANALYSIS_CONTEXT_BUDGET_TOKENS", "2048"))
+
+    # BM25 recall over summarized (archived) messages
+    RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+    RETRIEVAL_SNIPPET_CHARS = int(os.getenv("RETRIEVAL_SNIPPET_CHARS", "300"))
+    RETRIEVAL_MAX_SESSIONS = int(os.getenv("RETRIEVAL_MAX_SESSIONS", "256"))
+
+    # In-process cache of loaded session memories
+    SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "1024"))
+    SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "600"))
+    SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    
+    # Response cache: QueryAnalysis and final answers reused across turns/sessions (memory tier + optional SQLite tier)
+    RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "true").lower() == "true"
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "4096"))
+    RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+    # SQLite file for the on-disk tier ("" = memory only)
+    RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
     
+    # Observability: Prometheus /metrics port (0 = off) and optional JSONL trace file
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+    TRACE_FILE = os.getenv("TRACE_FILE", "")
+
     # Paths
     BASE_DIR = Path(__file__).resolve().parent.parent
     DATA_DIR = BASE_DIR / "data"
     SESSION_DIR = DATA_DIR / "sessions"
     TEST_DATA_DIR = BASE_DIR / "tests" / "test_data"
 
+    # Storage backend: "sqlite" (default, WAL mode) or "json" (legacy per-file layout)
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+    SQLITE_PATH = Path(os.getenv("SQLITE_PATH", str(DATA_DIR / "sessions.db")))
+    # Lease held by the worker summarizing a session; expires if that worker dies
+    SESSION_LEASE_SECONDS = float(os.getenv("SESSION_LEASE_SECONDS", "120"))
+    # JSON backend message logs: segment files roll at this size (offsets are kept in a per-session index)
+    MESSAGE_LOG_SEGMENT_BYTES = int(os.getenv("MESSAGE_LOG_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+    # Resuming a session loads what is not yet summarized plus at least this many of the newest messages
+    RESUME_TAIL_MESSAGES = int(os.getenv("RESUME_TAIL_MESSAGES", "50"))
+
     @staticmethod
     def ensure_dirs():
+        # Not run on import; storage backends create their own directories on first use
         Config.SESSION_DIR.mkdir(parents=True, exist_ok=True)
 
-Config.ensure_dirs()
\ No newline at end of file
@@ -0,0 +1,84 @@
+import logging
+from typing import Dict, List, Optional
+from src.models import ContextBreakdown, ContextPack
+from src.token_counter import MESSAGE_OVERHEAD_TOKENS, ConversationBuffer, TokenCounter, get_token_counter
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ContextPacker:
+    """
+    Chooses prompt context under a token budget instead of fixed message
+    windows. Priority: fixed parts (system prompt, query) -> memory summary ->
+    retrieved snippets (in rank order) -> recent turns, newest first and
+    contiguous. History passed as a ConversationBuffer is costed from its
+    cached per-message counts.
+    """
+
+    def __init__(self, budget_tokens: int, token_counter: Optional[TokenCounter] = None):
+        self.budget_tokens = budget_tokens
+        self.token_counter = token_counter or get_token_counter()
+
+    def _message_counts(self, history) -> List[int]:
+        if isinstance(history, ConversationBuffer):
+            return history.token_counts
+        counts = self.token_counter.count_tokens_batch([m.get("content", "") for m in history])
+        return [c + MESSAGE_OVERHEAD_TOKENS for c in counts]
+
+    def pack(
+        self,
+        fixed: List[str],
+        summary: str = "",
+        snippets: Optional[List[str]] = None,
+        history: Optional[List[Dict]] = None,
+    ) -> ContextPack:
+        snippets = snippets or []
+        history = history if history is not None else []
+        breakdown = ContextBreakdown(budget_tokens=self.budget_tokens)
+        pack = ContextPack(breakdown=breakdown)
+
+        fixed_tokens = sum(self.token_counter.count_tokens_batch(fixed))
+        breakdown.included_tokens["fixed"] = fixed_tokens
+        remaining = self.budget_tokens - fixed_tokens
+        if remaining < 0:
+            logger.warning(f"Fixed prompt parts ({fixed_tokens} tokens) exceed the context budget ({self.budget_tokens})")
+
+        if summary:
+            summary_tokens = self.token_counter.count_tokens(summary)
+            if summary_tokens <= remaining:
+                pack.summary = summary
+                remaining -= summary_tokens
+                breakdown.included_tokens["summary"] = summary_tokens
+            else:
+                breakdown.dropped_items["summary"] = 1
+
+        snippet_tokens = 0
+        for i, (snippet, count) in enumerate(zip(snippets, self.token_counter.count_tokens_batch(snippets))):
+            if count > remaining:
+                breakdown.dropped_items["snippets"] = len(snippets) - i
+                break
+            pack.snippets.append(snippet)
+            remaining -= count
+            snippet_tokens += count
+        breakdown.included_tokens["snippets"] = snippet_tokens
+
+        # Newest turns first; stop at the first one that does not fit so the window stays contiguous
+        counts = self._message_counts(history)
+        kept = 0
+        history_tokens = 0
+        for count in reversed(counts):
+            if count > remaining:
+                break
+            remaining -= count
+            history_tokens += count
+            kept += 1
+        pack.history = list(history[len(history) - kept:]) if kept else []
+        breakdown.included_tokens["history"] = history_tokens
+        if kept < len(history):
+            breakdown.dropped_items["history"] = len(history) - kept
+
+        breakdown.used_tokens = sum(breakdown.included_tokens.values())
+        for section, dropped in breakdown.dropped_items.items():
+            metrics.inc("context_dropped_items_total", dropped, section=section)
+        return pack
@@ -0,0 +1,64 @@
+from typing import Optional
+
+
+class JsonObjectScanner:
+    """
+    Incrementally finds the first top-level JSON object in streamed text.
+    feed() is called with each chunk as it arrives and returns True once the
+    object's closing brace has been seen; braces inside strings (and escaped
+    quotes) are ignored. Any preamble before the object and anything the model
+    keeps generating after it are left out of result().
+    """
+
+    def __init__(self, prefix: str = ""):
+        self.raw = ""
+        self._start = -1
+        self._end = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        if prefix:
+            self.feed(prefix)
+
+    @property
+    def complete(self) -> bool:
+        return self._end != -1
+
+    def feed(self, chunk: str) -> bool:
+        if self.complete:
+            return True
+        offset = len(self.raw)
+        self.raw += chunk
+        for i, ch in enumerate(chunk, start=offset):
+            if self._start == -1:
+                if ch == "{":
+                    self._start = i
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end = i
+                    return True
+        return False
+
+    def result(self) -> Optional[str]:
+        """The complete object text, or None if it has not closed yet."""
+        if not self.complete:
+            return None
+        return self.raw[self._start:self._end + 1]
+
+    def end_offset(self) -> Optional[int]:
+        """Index just past the closing brace in everything fed so far."""
+        return self._end + 1 if self.complete else None
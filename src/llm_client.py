@@ -1,38 +1,141 @@
-import requests
 import json
+import functools
 import logging
 import re
-from typing import Dict, Any, List
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Any, List, Tuple, Optional, Iterator, AsyncIterator
 from src.config import Config
+from src.metrics import metrics
+from src.json_stream import JsonObjectScanner
+from src.llm_router import Backend, get_llm_router
+
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
 
-class LLMClient:
+# Sampling temperature by default follows json_mode; callers that stream an
+# answer behind a JSON head (fused mode) pass ANSWER_TEMPERATURE explicitly.
+JSON_TEMPERATURE = 0.1
+ANSWER_TEMPERATURE = 0.7
+
+# requests/httpx are imported when the first client is built, not on import:
+# together they are most of this module's import time.
+
+# Pooled sessions are shared per process so that every LLMClient pointing at the
+# same endpoint reuses the same keep-alive connections (Streamlit rebuilds the
+# client on every rerun).
+_SESSIONS: Dict[Tuple[str, int, int], "requests.Session"] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _get_shared_session(base_url: str, pool_connections: int, pool_maxsize: int) -> "requests.Session":
+    key = (base_url, pool_connections, pool_maxsize)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSIONS[key] = session
+        return session
+
+
+@functools.lru_cache(maxsize=None)
+def _response_format(pydantic_model: Any) -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": pydantic_model.__name__, "schema": pydantic_model.model_json_schema()},
+    }
+
+
+class _BaseLLMClient:
+    """Payload building and output parsing shared by the sync and async clients."""
+
     def __init__(self, base_url: str = Config.LLM_API_BASE_URL):
-        self.base_url = base_url.rstrip("/")
+        # base_url may list several backends (comma-separated); requests are spread by the router
+        self.router = get_llm_router(base_url)
+        self.base_url = self.router.backends[0].base_url
         self.headers = {"Content-Type": "application/json"}
+        self.url = self.router.backends[0].url
 
-    def chat_completion(self, messages: List[Dict[str, str]], json_mode: bool = False) -> str:
-        url = f"{self.base_url}/chat/completions"
-        
+    def _build_payload(
+        self,
+        messages: List[Dict[str, str]],
+        json_mode: bool,
+        stream: bool = False,
+        response_model: Optional[Any] = None,
+        temperature: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        if temperature is None:
+            temperature = JSON_TEMPERATURE if json_mode else ANSWER_TEMPERATURE
         payload = {
-            "model": "meta-llama/Meta-Llama-3-8B-Instruct",
+            "model": Config.MODEL_NAME,
             "messages": messages,
-            "temperature": 0.1 if json_mode else 0.7, 
+            "temperature": temperature,
             "max_tokens": 2048
         }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        if response_model is not None:
+            # Schema-constrained JSON; stop_on_json_end is a colab_server extension
+            # (ends generation at the object's closing brace), ignored elsewhere.
+            payload["response_format"] = _response_format(response_model)
+            payload["stop_on_json_end"] = True
+        return payload
 
-        try:
-            logger.info(f"Sending request to {url}")
-            response = requests.post(url, headers=self.headers, json=payload, timeout=60)
-            response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
-        except Exception as e:
-            logger.error(f"LLM API Call failed: {str(e)}")
-            raise e
+    def _finish_json_scan(self, scanner: JsonObjectScanner, pydantic_model: Any) -> str:
+        if scanner.complete:
+            trailing = len(scanner.raw) - scanner.end_offset()
+            metrics.inc("json_early_stop_total", model=pydantic_model.__name__)
+            metrics.inc("json_trailing_chars_discarded_total", trailing, model=pydantic_model.__name__)
+            return scanner.result()
+        # No balanced object: hand the raw text to validate_json_output's fallback
+        return scanner.raw
+
+    @staticmethod
+    def _kind(json_mode: bool) -> str:
+        return "json" if json_mode else "text"
+
+    def _extract_content(self, data: Dict[str, Any], json_mode: bool = False) -> str:
+        if data.get("usage"):
+            metrics.record_llm_usage(data["usage"], kind=self._kind(json_mode))
+        return data["choices"][0]["message"]["content"]
+
+    def _parse_sse_line(self, line: str, json_mode: bool = False) -> Optional[str]:
+        """
+        Parses one OpenAI-style SSE line ("data: {...}").
+        Returns the delta text ("" for keep-alives/role-only chunks) or None on [DONE].
+        """
+        if not line or not line.startswith("data:"):
+            return ""
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        chunk = json.loads(data)
+        if chunk.get("usage"):
+            metrics.record_llm_usage(chunk["usage"], kind=self._kind(json_mode))
+        choices = chunk.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def _observe_stream(self, json_mode: bool, start: float, first_token_at: Optional[float], status: str):
+        # Generators may resume in another context, so streams are timed by hand instead of span()
+        kind = self._kind(json_mode)
+        metrics.observe("pipeline_stage_seconds", time.perf_counter() - start, stage="llm_stream")
+        if first_token_at is not None:
+            metrics.observe("llm_time_to_first_token_seconds", first_token_at - start, kind=kind)
+        metrics.inc("llm_requests_total", kind=kind, stream="true", status=status)
 
     def validate_json_output(self, content: str, pydantic_model: Any) -> Any:
+        with metrics.span("json_validation", model=pydantic_model.__name__):
+            return self._validate_json_output(content, pydantic_model)
+
+    def _validate_json_output(self, content: str, pydantic_model: Any) -> Any:
         try:
             # 1. Loại bỏ lớp vỏ Markdown nếu có
             cleaned_text = content.replace("```json", "").replace("```", "").strip()
@@ -44,7 +147,7 @@ class LLMClient:
             if start_index != -1 and end_index != -1 and end_index > start_index:
                 # Cắt lấy đúng phần JSON
                 json_candidate = cleaned_text[start_index : end_index + 1]
-                
+
                 try:
                     # 3. Parse JSON sạch vào Pydantic Model
                     # Lúc này ta sẽ lấy được confidence_score: 0.8 gốc của AI
@@ -57,13 +160,14 @@ class LLMClient:
 
             # --- FALLBACK  ---
             logger.warning("Active Fallback Mode due to parsing failure.")
-            
+            metrics.inc("json_fallback_total", model=pydantic_model.__name__)
+
             fallback_data = {
                 "original_query": "Unknown",
                 "is_ambiguous": True,
-                "ambiguity_reasons": ["System Format Error"], 
+                "ambiguity_reasons": ["System Format Error"],
                 # Cắt ngắn text để tránh làm vỡ giao diện nếu text quá dài
-                "rewritten_query": cleaned_text[:200], 
+                "rewritten_query": cleaned_text[:200],
                 "augmented_context": "Raw output could not be parsed.",
                 "confidence_score": 0.1, # Điểm thấp báo hiệu lỗi hệ thống
                 "requires_clarification": True
@@ -72,4 +176,271 @@ class LLMClient:
 
         except Exception as e:
             logger.error(f"FATAL ERROR parsing JSON: {e}")
-            raise ValueError("Critical parsing error")
\ No newline at end of file
+            raise ValueError("Critical parsing error")
+
+
+class LLMClient(_BaseLLMClient):
+    def __init__(
+        self,
+        base_url: str = Config.LLM_API_BASE_URL,
+        pool_connections: int = Config.LLM_POOL_CONNECTIONS,
+        pool_maxsize: int = Config.LLM_POOL_MAXSIZE,
+        connect_timeout: float = Config.LLM_CONNECT_TIMEOUT,
+        read_timeout: float = Config.LLM_READ_TIMEOUT,
+    ):
+        super().__init__(base_url)
+        self.timeout = (connect_timeout, read_timeout)
+        self.sessions = {b.base_url: _get_shared_session(b.base_url, pool_connections, pool_maxsize)
+                         for b in self.router.backends}
+        self.session = self.sessions[self.base_url]
+
+    def _post(self, backend: Backend, payload: Dict[str, Any], json_mode: bool) -> str:
+        logger.info(f"Sending request to {backend.url}")
+        response = self.sessions[backend.base_url].post(backend.url, headers=self.headers, json=payload,
+                                                        timeout=self.timeout)
+        response.raise_for_status()
+        return self._extract_content(response.json(), json_mode)
+
+    def chat_completion(self, messages: List[Dict[str, str]], json_mode: bool = False,
+                        response_model: Optional[Any] = None) -> str:
+        payload = self._build_payload(messages, json_mode, response_model=response_model)
+        kind = self._kind(json_mode)
+
+        try:
+            with metrics.span("llm_call", kind=kind):
+                content, _ = self.router.call("completion", lambda b: self._post(b, payload, json_mode))
+            metrics.inc("llm_requests_total", kind=kind, stream="false", status="ok")
+            return content
+        except Exception as e:
+            metrics.inc("llm_requests_total", kind=kind, stream="false", status="error")
+            logger.error(f"LLM API Call failed: {str(e)}")
+            raise e
+
+    def json_completion(self, messages: List[Dict[str, str]], pydantic_model: Any) -> str:
+        """
+        JSON-mode completion constrained to pydantic_model's schema, ending at
+        the first top-level object (Config.JSON_EARLY_STOP): by default one
+        non-streamed request whose generation the server stops at the closing
+        brace (and can batch with others); in "client" mode the response is
+        streamed and the connection closed once the object is complete.
+        Returns the object text (or the raw text if none closed) for
+        validate_json_output.
+        """
+        if Config.JSON_EARLY_STOP == "off":
+            return self.chat_completion(messages, json_mode=True)
+        if Config.JSON_EARLY_STOP == "server":
+            return self._finish_json_scan(
+                JsonObjectScanner(self.chat_completion(messages, json_mode=True, response_model=pydantic_model)),
+                pydantic_model)
+
+        scanner = JsonObjectScanner()
+        stream = self.stream_chat_completion(messages, json_mode=True, response_model=pydantic_model)
+        try:
+            for delta in stream:
+                if scanner.feed(delta):
+                    break
+        finally:
+            stream.close()
+        return self._finish_json_scan(scanner, pydantic_model)
+
+    def stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        json_mode: bool = False,
+        response_model: Optional[Any] = None,
+        temperature: Optional[float] = None,
+    ) -> Iterator[str]:
+        """
+        Yields content deltas as the server emits them (stream=True). Retries
+        and hedging apply until the first delta arrives; after that the
+        stream stays on the backend that produced it.
+        """
+        payload = self._build_payload(messages, json_mode, stream=True, response_model=response_model,
+                                      temperature=temperature)
+        (stream, first), backend = self.router.call(
+            "stream", lambda b: self._open_stream(b, payload, json_mode),
+            discard=lambda opened: opened[0].close(), hold=True,
+        )
+        error: Optional[BaseException] = None
+        try:
+            if first is not None:
+                yield first
+                yield from stream
+        except GeneratorExit:
+            # Closed early by the consumer (e.g. JSON early stop): not a backend failure
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stream.close()
+            self.router.finish(backend, error)
+
+    def _open_stream(self, backend: Backend, payload: Dict[str, Any], json_mode: bool) -> Tuple[Iterator[str], Optional[str]]:
+        """Starts a stream on backend and waits for its first delta (None if it ended without one)."""
+        stream = self._stream_from(backend, payload, json_mode)
+        try:
+            return stream, next(stream)
+        except StopIteration:
+            return stream, None
+
+    def _stream_from(self, backend: Backend, payload: Dict[str, Any], json_mode: bool) -> Iterator[str]:
+        start, first_token_at, status = time.perf_counter(), None, "ok"
+        try:
+            logger.info(f"Sending streaming request to {backend.url}")
+            with self.sessions[backend.base_url].post(backend.url, headers=self.headers, json=payload,
+                                                      timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    delta = self._parse_sse_line(line, json_mode)
+                    if delta is None:
+                        break
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        yield delta
+        except Exception as e:
+            status = "error"
+            logger.error(f"LLM API Stream failed: {str(e)}")
+            raise e
+        finally:
+            self._observe_stream(json_mode, start, first_token_at, status)
+
+
+class AsyncLLMClient(_BaseLLMClient):
+    """
+    Async counterpart of LLMClient built on httpx.
+    One instance keeps a bounded pool of keep-alive connections, so many
+    completions can be in flight concurrently without a thread per request.
+    """
+
+    def __init__(
+        self,
+        base_url: str = Config.LLM_API_BASE_URL,
+        max_connections: int = Config.LLM_POOL_MAXSIZE,
+        max_keepalive_connections: int = Config.LLM_POOL_CONNECTIONS,
+        keepalive_expiry: float = Config.LLM_KEEPALIVE_EXPIRY,
+        connect_timeout: float = Config.LLM_CONNECT_TIMEOUT,
+        read_timeout: float = Config.LLM_READ_TIMEOUT,
+    ):
+        super().__init__(base_url)
+        import httpx
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+    async def _post(self, backend: Backend, payload: Dict[str, Any], json_mode: bool) -> str:
+        logger.info(f"Sending async request to {backend.url}")
+        response = await self.client.post(backend.url, json=payload)
+        response.raise_for_status()
+        return self._extract_content(response.json(), json_mode)
+
+    async def chat_completion(self, messages: List[Dict[str, str]], json_mode: bool = False,
+                              response_model: Optional[Any] = None) -> str:
+        payload = self._build_payload(messages, json_mode, response_model=response_model)
+        kind = self._kind(json_mode)
+
+        try:
+            with metrics.span("llm_call", kind=kind):
+                content, _ = await self.router.acall("completion", lambda b: self._post(b, payload, json_mode))
+            metrics.inc("llm_requests_total", kind=kind, stream="false", status="ok")
+            return content
+        except Exception as e:
+            metrics.inc("llm_requests_total", kind=kind, stream="false", status="error")
+            logger.error(f"LLM API Call failed: {str(e)}")
+            raise e
+
+    async def json_completion(self, messages: List[Dict[str, str]], pydantic_model: Any) -> str:
+        """Async counterpart of LLMClient.json_completion."""
+        if Config.JSON_EARLY_STOP == "off":
+            return await self.chat_completion(messages, json_mode=True)
+        if Config.JSON_EARLY_STOP == "server":
+            return self._finish_json_scan(
+                JsonObjectScanner(await self.chat_completion(messages, json_mode=True, response_model=pydantic_model)),
+                pydantic_model)
+
+        scanner = JsonObjectScanner()
+        stream = self.stream_chat_completion(messages, json_mode=True, response_model=pydantic_model)
+        try:
+            async for delta in stream:
+                if scanner.feed(delta):
+                    break
+        finally:
+            await stream.aclose()
+        return self._finish_json_scan(scanner, pydantic_model)
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        json_mode: bool = False,
+        response_model: Optional[Any] = None,
+        temperature: Optional[float] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Async iterator over content deltas (stream=True). Retried until the
+        first delta arrives, but not hedged: an httpx stream has to be read
+        and closed in the task that opened it.
+        """
+        payload = self._build_payload(messages, json_mode, stream=True, response_model=response_model,
+                                      temperature=temperature)
+        (stream, first), backend = await self.router.acall(
+            "stream", lambda b: self._open_stream(b, payload, json_mode), hold=True, hedge=False,
+        )
+        error: Optional[BaseException] = None
+        try:
+            if first is not None:
+                yield first
+                async for delta in stream:
+                    yield delta
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await stream.aclose()
+            self.router.finish(backend, error)
+
+    async def _open_stream(self, backend: Backend, payload: Dict[str, Any],
+                           json_mode: bool) -> Tuple[AsyncIterator[str], Optional[str]]:
+        stream = self._stream_from(backend, payload, json_mode)
+        try:
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+
+    async def _stream_from(self, backend: Backend, payload: Dict[str, Any], json_mode: bool) -> AsyncIterator[str]:
+        start, first_token_at, status = time.perf_counter(), None, "ok"
+        try:
+            logger.info(f"Sending async streaming request to {backend.url}")
+            async with self.client.stream("POST", backend.url, json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    delta = self._parse_sse_line(line, json_mode)
+                    if delta is None:
+                        break
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        yield delta
+        except Exception as e:
+            status = "error"
+            logger.error(f"LLM API Stream failed: {str(e)}")
+            raise e
+        finally:
+            self._observe_stream(json_mode, start, first_token_at, status)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+from src.config import Config
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class NoBackendAvailableError(RuntimeError):
+    """Every backend's circuit is open: fail the call now instead of waiting on a dead endpoint."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Connection errors, timeouts, 429 and 5xx; other 4xx and parsing errors are not retried."""
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(exc, httpx.TransportError):
+        return True
+    # requests' ConnectionError / Timeout are OSErrors
+    return isinstance(exc, OSError)
+
+
+def split_base_urls(base_url: str) -> List[str]:
+    """LLM_API_BASE_URL may list several OpenAI-compatible backends, comma-separated."""
+    return [url.strip().rstrip("/") for url in base_url.split(",") if url.strip()]
+
+
+class Backend:
+    """Load, health and circuit state of one backend as seen by this process. Mutated under the router lock."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.url = f"{base_url}/chat/completions"
+        self.outstanding = 0
+        self.latency_ewma = 0.0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_executor_lock = threading.Lock()
+# One per hedge worker: a hedge is only sent when a worker is free, so it never waits in the queue
+_hedge_slots = threading.BoundedSemaphore(Config.LLM_HEDGE_WORKERS)
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Process-wide pool that runs hedged (duplicate) sync requests."""
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=Config.LLM_HEDGE_WORKERS, thread_name_prefix="hedge")
+        return _hedge_executor
+
+
+def _start_thread(fn: Callable[..., Any], *args) -> Future:
+    """Runs fn on a new daemon thread right away (no pool, no queue); the Future holds its outcome."""
+    future: Future = Future()
+    future.set_running_or_notify_cancel()
+
+    def target():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True, name="llm-primary").start()
+    return future
+
+
+class LLMRouter:
+    """
+    Spreads requests over several OpenAI-compatible backends.
+
+    - Least outstanding requests: each call goes to the healthy backend with
+      the fewest requests in flight (ties: lower latency EWMA).
+    - Circuit breaker: after breaker_failures consecutive retryable failures a
+      backend is skipped for breaker_reset_seconds, then one probe request is
+      let through (half-open); its outcome closes or re-opens the circuit.
+    - Retries: retryable failures are retried up to max_retries times with
+      exponential backoff and jitter; a retry that can go to a backend not
+      tried yet is sent there at once.
+    - Hedging: once a kind of call ("completion", "stream" = time to first
+      token) has enough latency samples, a call still running past their p95
+      is duplicated on another backend; the first success wins and the loser
+      is discarded. No hedge is sent while every hedge worker is busy.
+
+    fn(backend) performs the request against one backend. With hold=True the
+    backend stays counted as busy after fn returns (a stream being consumed)
+    until finish() is called.
+    """
+
+    def __init__(
+        self,
+        base_urls: Iterable[str],
+        max_retries: int = Config.LLM_MAX_RETRIES,
+        backoff_seconds: float = Config.LLM_RETRY_BACKOFF_MS / 1000.0,
+        breaker_failures: int = Config.LLM_BREAKER_FAILURES,
+        breaker_reset_seconds: float = Config.LLM_BREAKER_RESET_SECONDS,
+        hedge: bool = Config.LLM_HEDGE,
+        hedge_min_samples: int = Config.LLM_HEDGE_MIN_SAMPLES,
+        latency_window: int = Config.LLM_LATENCY_WINDOW,
+    ):
+        self.backends = [Backend(url) for url in base_urls]
+        if not self.backends:
+            raise ValueError("LLMRouter needs at least one backend URL")
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._latency_window = latency_window
+        self._lock = threading.Lock()
+
+    # --- Backend selection and bookkeeping ---
+    def _usable(self, backend: Backend, now: float) -> bool:
+        if backend.state == CLOSED:
+            return True
+        if backend.state == OPEN and now - backend.opened_at >= self.breaker_reset_seconds:
+            return True
+        # Half-open: only one probe at a time
+        return backend.state == HALF_OPEN and not backend.probing
+
+    def _acquire(self, exclude: Iterable[str] = (), strict: bool = False) -> Optional[Backend]:
+        """
+        Least-loaded usable backend, preferring ones not in exclude (strict:
+        only those). Counts it as busy. None if nothing qualifies.
+        """
+        exclude = set(exclude)
+        with self._lock:
+            now = time.monotonic()
+            usable = [b for b in self.backends if self._usable(b, now)]
+            preferred = [b for b in usable if b.base_url not in exclude]
+            candidates = preferred if preferred or strict else usable
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.outstanding, b.latency_ewma))
+            if backend.state != CLOSED:
+                backend.state = HALF_OPEN
+                backend.probing = True
+            backend.outstanding += 1
+            backend.requests += 1
+            metrics.set_gauge("llm_backend_outstanding", backend.outstanding, backend=backend.base_url)
+            return backend
+
+    def acquire(self, exclude: Iterable[str] = ()) -> Backend:
+        backend = self._acquire(exclude)
+        if backend is None:
+            metrics.inc("llm_router_rejected_total")
+            raise NoBackendAvailableError("All LLM backends are unavailable (circuit open)")
+        return backend
+
+    def _record_latency(self, backend: Backend, op: str, latency: float):
+        # Caller holds the lock
+        self._latencies.setdefault(op, deque(maxlen=self._latency_window)).append(latency)
+        backend.latency_ewma = latency if not backend.latency_ewma else 0.8 * backend.latency_ewma + 0.2 * latency
+
+    def finish(self, backend: Backend, error: Optional[BaseException] = None,
+               op: Optional[str] = None, latency: Optional[float] = None):
+        """Ends a request on backend: records its outcome for the breaker and latency stats."""
+        cancelled = isinstance(error, (GeneratorExit, asyncio.CancelledError))
+        failed = error is not None and not cancelled and is_retryable(error)
+        with self._lock:
+            backend.outstanding -= 1
+            backend.probing = False
+            if cancelled:
+                # Abandoned by the caller (e.g. a losing hedge): says nothing about the backend
+                pass
+            elif failed:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.state == HALF_OPEN or backend.consecutive_failures >= self.breaker_failures:
+                    if backend.state != OPEN:
+                        logger.warning(f"Circuit opened for LLM backend {backend.base_url} "
+                                       f"after {backend.consecutive_failures} failures: {error}")
+                        metrics.inc("llm_circuit_opened_total", backend=backend.base_url)
+                    backend.state = OPEN
+                    backend.opened_at = time.monotonic()
+            else:
+                # Success, or an answer the backend was healthy enough to give (e.g. a 4xx)
+                if backend.state != CLOSED:
+                    logger.info(f"Circuit closed for LLM backend {backend.base_url}")
+                backend.state = CLOSED
+                backend.consecutive_failures = 0
+                if error is None and latency is not None and op is not None:
+                    self._record_latency(backend, op, latency)
+            metrics.set_gauge("llm_backend_outstanding", backend.outstanding, backend=backend.base_url)
+            metrics.set_gauge("llm_backend_circuit_open", 1 if backend.state == OPEN else 0, backend=backend.base_url)
+        if cancelled:
+            status = "cancelled"
+        else:
+            status = "ok" if error is None else ("error" if failed else "client_error")
+        metrics.inc("llm_backend_requests_total", backend=backend.base_url, status=status)
+        if latency is not None and error is None:
+            metrics.observe("llm_backend_seconds", latency, backend=backend.base_url, op=op or "")
+
+    def hedge_delay(self, op: str) -> Optional[float]:
+        """p95 latency of this kind of call, once there are enough samples (None = do not hedge)."""
+        if not self.hedge or len(self.backends) < 2:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies.get(op, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def _backoff(self, attempt: int, tried: List[str]) -> float:
+        """No wait when another backend can take the retry; otherwise exponential with jitter."""
+        with self._lock:
+            now = time.monotonic()
+            if any(b.base_url not in tried and self._usable(b, now) for b in self.backends):
+                return 0.0
+        return self.backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    # --- Sync calls ---
+    def _run(self, backend: Backend, op: str, fn: Callable[[Backend], Any], hold: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            result = fn(backend)
+        except BaseException as e:
+            self.finish(backend, e)
+            raise
+        latency = time.perf_counter() - start
+        if hold:
+            self._hold(backend, op, latency)
+        else:
+            self.finish(backend, op=op, latency=latency)
+        return result
+
+    def _hold(self, backend: Backend, op: str, latency: float):
+        # Still busy until the caller finishes consuming the result; latency is recorded now
+        with self._lock:
+            self._record_latency(backend, op, latency)
+        metrics.observe("llm_backend_seconds", latency, backend=backend.base_url, op=op)
+
+    def call(self, op: str, fn: Callable[[Backend], Any], discard: Optional[Callable[[Any], None]] = None,
+             hold: bool = False) -> Tuple[Any, Backend]:
+        """Runs fn on a backend with retries and hedging; returns (result, backend that produced it)."""
+        tried: List[str] = []
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._call_hedged(op, fn, discard, hold, tried)
+            except NoBackendAvailableError:
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, tried)
+                logger.warning(f"LLM {op} failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                metrics.inc("llm_retries_total", op=op)
+                time.sleep(delay)
+
+    def _call_hedged(self, op: str, fn, discard, hold: bool, tried: List[str]) -> Tuple[Any, Backend]:
+        primary = self.acquire(exclude=tried)
+        tried.append(primary.base_url)
+        delay = self.hedge_delay(op)
+        if delay is None:
+            return self._run(primary, op, fn, hold), primary
+
+        # The primary starts at once on its own thread, so the hedge delay measures the
+        # request itself and no shared pool caps how many calls run at a time
+        futures = {_start_thread(self._run, primary, op, fn, hold): primary}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            if not _hedge_slots.acquire(blocking=False):
+                # Every hedge worker is busy: duplicating now would only add load
+                metrics.inc("llm_hedges_skipped_total", op=op)
+            else:
+                secondary = self._acquire(exclude=[primary.base_url], strict=True)
+                if secondary is None:
+                    _hedge_slots.release()
+                else:
+                    metrics.inc("llm_hedges_total", op=op)
+                    hedge = get_hedge_executor().submit(self._run, secondary, op, fn, hold)
+                    hedge.add_done_callback(lambda _: _hedge_slots.release())
+                    futures[hedge] = secondary
+
+        pending = set(futures)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            won = next((f for f in done if f.exception() is None), None)
+            if won is None:
+                error = next(iter(done)).exception()
+                continue
+            winner = futures[won]
+            if winner is not primary:
+                metrics.inc("llm_hedge_wins_total", op=op)
+            # Both attempts may have finished together: release every result but the winner's
+            for loser in (done | pending) - {won}:
+                loser.add_done_callback(lambda f, b=futures[loser]: self._discard(f, b, discard, hold))
+            return won.result(), winner
+        raise error
+
+    def _discard(self, future, backend: Backend, discard, hold: bool):
+        if future.exception() is not None:
+            return
+        if hold:
+            self.finish(backend)
+        if discard is not None:
+            try:
+                discard(future.result())
+            except Exception as e:
+                logger.debug(f"Discarding hedged result failed: {e}")
+
+    # --- Async calls ---
+    async def _arun(self, backend: Backend, op: str, fn: Callable[[Backend], Awaitable[Any]], hold: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            result = await fn(backend)
+        except BaseException as e:
+            self.finish(backend, e)
+            raise
+        latency = time.perf_counter() - start
+        if hold:
+            self._hold(backend, op, latency)
+        else:
+            self.finish(backend, op=op, latency=latency)
+        return result
+
+    async def acall(self, op: str, fn: Callable[[Backend], Awaitable[Any]],
+                    discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+                    hold: bool = False, hedge: bool = True) -> Tuple[Any, Backend]:
+        """
+        Async counterpart of call(); discard is awaited on a losing hedge's
+        result. Use hedge=False for results that must stay in the calling task
+        (e.g. an open HTTP stream).
+        """
+        tried: List[str] = []
+        for attempt in range(self.max_retries + 1):
+            try:
+                primary = self.acquire(exclude=tried)
+                tried.append(primary.base_url)
+                delay = self.hedge_delay(op) if hedge else None
+                if delay is None:
+                    return await self._arun(primary, op, fn, hold), primary
+                return await self._acall_hedged(op, fn, discard, hold, primary, delay)
+            except NoBackendAvailableError:
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, tried)
+                logger.warning(f"LLM {op} failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                metrics.inc("llm_retries_total", op=op)
+                await asyncio.sleep(delay)
+
+    async def _acall_hedged(self, op: str, fn, discard, hold: bool, primary: Backend,
+                            delay: float) -> Tuple[Any, Backend]:
+        tasks = {asyncio.ensure_future(self._arun(primary, op, fn, hold)): primary}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            secondary = self._acquire(exclude=[primary.base_url], strict=True)
+            if secondary is not None:
+                metrics.inc("llm_hedges_total", op=op)
+                tasks[asyncio.ensure_future(self._arun(secondary, op, fn, hold))] = secondary
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            won = next((t for t in done if t.exception() is None), None)
+            if won is None:
+                error = next(iter(done)).exception()
+                continue
+            winner = tasks[won]
+            if winner is not primary:
+                metrics.inc("llm_hedge_wins_total", op=op)
+            for loser in pending:
+                # Nothing waits for the loser any more: stop it
+                loser.cancel()
+            # A loser that finished anyway (together with the winner, or before the cancel landed) is discarded
+            for loser in (done | pending) - {won}:
+                loser.add_done_callback(lambda t, b=tasks[loser]: self._adiscard(t, b, discard, hold))
+            return won.result(), winner
+        raise error
+
+    def _adiscard(self, task: "asyncio.Future", backend: Backend, discard, hold: bool):
+        if task.cancelled() or task.exception() is not None:
+            return
+        if hold:
+            self.finish(backend)
+        if discard is not None:
+            asyncio.ensure_future(self._aclose_discarded(discard, task.result()))
+
+    @staticmethod
+    async def _aclose_discarded(discard, result: Any):
+        try:
+            await discard(result)
+        except Exception as e:
+            logger.debug(f"Discarding hedged result failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backends": [b.snapshot() for b in self.backends],
+                "p95_ms": {op: round(sorted(v)[min(len(v) - 1, int(0.95 * len(v)))] * 1000, 1)
+                           for op, v in self._latencies.items() if v},
+            }
+
+
+_routers: Dict[Tuple[str, ...], LLMRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_llm_router(base_url: str) -> LLMRouter:
+    """
+    Process-wide router per backend list, so health and latency stats are
+    shared by every client (Streamlit rebuilds its client on each rerun).
+    """
+    key = tuple(split_base_urls(base_url))
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = LLMRouter(key)
+            _routers[key] = router
+        return router
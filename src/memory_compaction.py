@@ -0,0 +1,148 @@
+import json
+import logging
+import re
+from typing import Dict, List, Optional, Set
+from src.config import Config
+from src.metrics import metrics
+from src.models import SessionSummaryData, UserProfile
+from src.retrieval import tokenize
+from src.token_counter import TokenCounter, get_token_counter
+
+logger = logging.getLogger(__name__)
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+# After normalize_item, "don't" reads "don t"
+_NEGATION_RE = re.compile(r"\b(?:not|no|never|nor|without|cannot|\w+n t)\b")
+_SUFFIXES = ("ing", "ed", "es", "s")
+
+# Sections of SessionSummaryData that are lists of free-text items
+SECTIONS = ("key_facts", "decisions", "open_questions", "todos")
+PROFILE_SECTIONS = ("preferences", "constraints")
+
+
+def normalize_item(item: str) -> str:
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", item.lower())).strip()
+
+
+def _numbers(text: str) -> List[str]:
+    return _NUMBER_RE.findall(text)
+
+
+def _stem(term: str) -> str:
+    # Inflection only: "caches"/"cached"/"caching" -> "cach"
+    for suffix in _SUFFIXES:
+        if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+            term = term[:-len(suffix)]
+            break
+    return term[:-1] if term.endswith("e") and len(term) > 3 else term
+
+
+def _content_stems(norm: str) -> Set[str]:
+    # Negations are compared separately ("don't" and "do not" are the same)
+    return {_stem(term) for term in tokenize(_NEGATION_RE.sub(" ", norm))}
+
+
+def is_near_duplicate(a: str, b: str) -> bool:
+    """
+    Near-verbatim restatements only: the same numbers, the same negation and
+    the same content words up to inflection, stopwords and word order.
+    "Write tests for the API" and "Write docs for the API", or "Use X" and
+    "Do not use X", are different items.
+    """
+    norm_a, norm_b = normalize_item(a), normalize_item(b)
+    if norm_a == norm_b:
+        return True
+    if _numbers(norm_a) != _numbers(norm_b):
+        return False
+    if len(_NEGATION_RE.findall(norm_a)) % 2 != len(_NEGATION_RE.findall(norm_b)) % 2:
+        return False
+    stems_a = _content_stems(norm_a)
+    return bool(stems_a) and stems_a == _content_stems(norm_b)
+
+
+def merge_items(old: List[str], new: List[str]) -> List[str]:
+    """
+    Order-preserving union, oldest first. An item that restates an existing
+    one replaces it and moves to the end (being mentioned again ranks it as
+    recent for the token cap); the newer wording is kept.
+    """
+    merged: List[str] = []
+    for item in list(old) + list(new):
+        item = item.strip() if item else ""
+        if not item:
+            continue
+        for i, kept in enumerate(merged):
+            if is_near_duplicate(kept, item):
+                del merged[i]
+                break
+        merged.append(item)
+    return merged
+
+
+def cap_items(items: List[str], cap_tokens: int, token_counter: Optional[TokenCounter] = None) -> List[str]:
+    """Keeps the most recent items (the tail) whose tokens fit in cap_tokens; never drops the newest."""
+    if cap_tokens <= 0 or not items:
+        return list(items)
+    counts = (token_counter or get_token_counter()).count_tokens_batch(items)
+    kept = 0
+    used = 0
+    for count in reversed(counts):
+        if kept and used + count > cap_tokens:
+            break
+        used += count
+        kept += 1
+    return list(items[len(items) - kept:])
+
+
+class MemoryCompactor:
+    """
+    Keeps SessionSummaryData bounded: every list section is deduplicated
+    (near-verbatim restatements only) and capped at a token budget, dropping the
+    least recently mentioned items first. Applied whenever a summary is merged,
+    so the memory injected into prompts stops growing with the conversation.
+    """
+
+    def __init__(
+        self,
+        section_cap_tokens: int = Config.MEMORY_SECTION_TOKEN_CAP,
+        token_counter: Optional[TokenCounter] = None,
+    ):
+        self.section_cap_tokens = section_cap_tokens
+        self.token_counter = token_counter or get_token_counter()
+
+    def _compact_section(self, name: str, old: List[str], new: List[str]) -> List[str]:
+        merged = merge_items(old, new)
+        capped = cap_items(merged, self.section_cap_tokens, self.token_counter)
+        duplicates = len(old) + len(new) - len(merged)
+        if duplicates:
+            metrics.inc("memory_items_dropped_total", duplicates, section=name, reason="duplicate")
+        if len(capped) < len(merged):
+            metrics.inc("memory_items_dropped_total", len(merged) - len(capped), section=name, reason="cap")
+        return capped
+
+    def merge(self, base: SessionSummaryData, update: SessionSummaryData) -> SessionSummaryData:
+        """Folds a summary of newer messages into the existing one and compacts the result."""
+        profile = {
+            name: self._compact_section(name, getattr(base.user_profile, name), getattr(update.user_profile, name))
+            for name in PROFILE_SECTIONS
+        }
+        sections = {name: self._compact_section(name, getattr(base, name), getattr(update, name)) for name in SECTIONS}
+        return SessionSummaryData(user_profile=UserProfile(**profile), **sections)
+
+    def compact(self, summary: SessionSummaryData) -> SessionSummaryData:
+        return self.merge(SessionSummaryData(), summary)
+
+
+def render_context(summary: SessionSummaryData) -> str:
+    """Compact prompt rendering: empty sections left out, no indentation."""
+    data: Dict = {}
+    profile = {k: v for k, v in summary.user_profile.model_dump().items() if v}
+    if profile:
+        data["user_profile"] = profile
+    for name in SECTIONS:
+        items = getattr(summary, name)
+        if items:
+            data[name] = items
+    return json.dumps(data, ensure_ascii=False) if data else ""
@@ -0,0 +1,113 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+# One index entry per message: segment number, byte offset in the segment, record length
+INDEX_ENTRY = struct.Struct("<IQI")
+INDEX_NAME = "index.bin"
+
+
+def _segment_name(segment: int) -> str:
+    return f"{segment:08d}.seg"
+
+
+class SegmentMessageLog:
+    """
+    Append-only message log of one session, stored in a directory:
+
+        00000000.seg, 00000001.seg, ...   JSON lines, rolled at segment_bytes
+        index.bin                          fixed-size (segment, offset, length) per message
+
+    Message i is located with one lookup at i * INDEX_ENTRY.size in the index,
+    which is memory-mapped for reads, so reading a window (e.g. the tail of a
+    10k-message session) touches only that window's index pages and bytes.
+
+    Records are written to the segment before their index entry, so every
+    indexed message is complete; bytes left past the last entry by a crash are
+    never indexed, and a torn index entry is cut off on the next append.
+    Appends must be serialized by the caller (JsonFileBackend holds a lock
+    file); reads need no lock.
+    """
+
+    def __init__(self, directory: Path, segment_bytes: int = Config.MESSAGE_LOG_SEGMENT_BYTES):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.index_path = self.directory / INDEX_NAME
+
+    def exists(self) -> bool:
+        return self.index_path.exists()
+
+    def count(self) -> int:
+        try:
+            return self.index_path.stat().st_size // INDEX_ENTRY.size
+        except FileNotFoundError:
+            return 0
+
+    def _entries(self, start: int, end: int) -> List[Tuple[int, int, int]]:
+        if end <= start:
+            return []
+        with open(self.index_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            return [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size) for i in range(start, end)]
+
+    def read(self, start: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        count = self.count()
+        start = max(start, 0)
+        end = count if limit is None else min(count, start + limit)
+        entries = self._entries(start, end)
+        messages: List[Dict[str, Any]] = []
+        # Consecutive entries of one segment are contiguous: one read per segment
+        i = 0
+        while i < len(entries):
+            segment = entries[i][0]
+            j = i
+            while j + 1 < len(entries) and entries[j + 1][0] == segment:
+                j += 1
+            first_offset = entries[i][1]
+            last_offset, last_length = entries[j][1], entries[j][2]
+            with open(self.directory / _segment_name(segment), "rb") as f:
+                f.seek(first_offset)
+                data = f.read(last_offset + last_length - first_offset)
+            for _, offset, length in entries[i:j + 1]:
+                messages.append(json.loads(data[offset - first_offset:offset - first_offset + length]))
+            i = j + 1
+        return messages
+
+    def append(self, messages: List[Dict[str, Any]]) -> int:
+        """Appends a batch (caller holds the session's append lock); returns the index of the first message."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        records = [(json.dumps(m, ensure_ascii=False) + "\n").encode("utf-8") for m in messages]
+        with open(self.index_path, "ab+") as index:
+            size = index.seek(0, os.SEEK_END)
+            if size % INDEX_ENTRY.size:
+                logger.warning(f"Truncating torn entry in {self.index_path}")
+                size -= size % INDEX_ENTRY.size
+                index.truncate(size)
+            first = size // INDEX_ENTRY.size
+            segment = 0
+            if first:
+                index.seek(size - INDEX_ENTRY.size)
+                segment = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+            segment_path = self.directory / _segment_name(segment)
+            segment_size = segment_path.stat().st_size if segment_path.exists() else 0
+            batch_bytes = sum(len(r) for r in records)
+            if segment_size and segment_size + batch_bytes > self.segment_bytes:
+                segment += 1
+                segment_path = self.directory / _segment_name(segment)
+
+            entries = []
+            with open(segment_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(b"".join(records))
+            for record in records:
+                entries.append(INDEX_ENTRY.pack(segment, offset, len(record)))
+                offset += len(record)
+            index.seek(0, os.SEEK_END)
+            index.write(b"".join(entries))
+        return first
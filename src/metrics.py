@@ -0,0 +1,189 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional, Tuple
+from src.config import Config
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) for the stage latency histogram
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_span: contextvars.ContextVar[Optional[Tuple[str, str]]] = contextvars.ContextVar("current_span", default=None)
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics: counters, gauges and histograms with labels,
+    rendered in the Prometheus text exposition format. span() times a pipeline
+    stage, records it in the stage histogram and optionally appends a JSONL
+    trace record (trace/span/parent ids propagate through contextvars).
+    """
+
+    def __init__(self, trace_file: str = Config.TRACE_FILE, buckets=DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counters: Dict[LabelKey, float] = {}
+        self.gauges: Dict[LabelKey, float] = {}
+        self.histograms: Dict[LabelKey, Dict[str, Any]] = {}
+        self.trace_file = trace_file
+        self._trace_lock = threading.Lock()
+        self._trace_dir_ready = False
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self.histograms[key] = hist
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["count"] += 1
+            hist["sum"] += value
+
+    @contextmanager
+    def span(self, stage: str, **attrs) -> Iterator[Dict[str, Any]]:
+        """Times a pipeline stage. Callers may add attributes to the yielded dict."""
+        parent = _current_span.get()
+        trace_id = parent[0] if parent else uuid.uuid4().hex
+        span_id = uuid.uuid4().hex[:16]
+        token = _current_span.set((trace_id, span_id))
+        start_wall = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _current_span.reset(token)
+            self.observe("pipeline_stage_seconds", duration, stage=stage)
+            if error:
+                self.inc("pipeline_stage_errors_total", stage=stage)
+            if self.trace_file:
+                self._write_trace({
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_id": parent[1] if parent else None,
+                    "name": stage,
+                    "start": start_wall,
+                    "duration_ms": round(duration * 1000, 3),
+                    "error": error,
+                    "attrs": attrs,
+                })
+
+    def _write_trace(self, record: Dict[str, Any]):
+        try:
+            line = json.dumps(record, ensure_ascii=False, default=str)
+            with self._trace_lock:
+                if not self._trace_dir_ready:
+                    Path(self.trace_file).parent.mkdir(parents=True, exist_ok=True)
+                    self._trace_dir_ready = True
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            logger.error(f"Failed to write trace record: {e}")
+
+    def record_llm_usage(self, usage: Dict[str, Any], kind: str):
+        self.inc("llm_prompt_tokens_total", usage.get("prompt_tokens", 0) or 0, kind=kind)
+        self.inc("llm_completion_tokens_total", usage.get("completion_tokens", 0) or 0, kind=kind)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+            seen = set()
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for bound, count in zip(self.buckets, hist["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', f'{bound:g}'))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {hist['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+_metrics_server: Optional["ThreadingHTTPServer"] = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = Config.METRICS_PORT, host: str = "0.0.0.0") -> Optional["ThreadingHTTPServer"]:
+    """Serves GET /metrics in a daemon thread. Idempotent per process; port 0 disables it."""
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is not None or not port:
+            return _metrics_server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            _metrics_server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logger.error(f"Could not start metrics server on port {port}: {e}")
+            return None
+        _metrics_server.daemon_threads = True
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics available at http://{host}:{port}/metrics")
+        return _metrics_server
@@ -0,0 +1,284 @@
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from src.json_stream import JsonObjectScanner
+
+logger = logging.getLogger(__name__)
+
+MALFORMED_JSON = 'Sure! Here is the analysis you asked for: {"original_query": "unterminated'
+QUERY_RE = re.compile(r'=== CURRENT USER QUERY ===\s*"(.*?)"', re.DOTALL)
+
+
+class MockLLMServer:
+    """
+    Deterministic local stand-in for the OpenAI-compatible /v1/chat/completions
+    endpoint served by colab_server.ipynb. Responses are canned per prompt type
+    (query analysis, summarization, answer, fused analysis + answer), timed by a fixed latency plus a
+    tokens-per-second rate, and every Nth JSON response can be made malformed
+    to exercise the fallback path. json_ramble_tokens appends trailing prose
+    after JSON objects (as real models do) unless the request sets
+    stop_on_json_end.
+
+    Faults for exercising the client's routing: every error_every-th request
+    is answered with HTTP 503 (1 = backend down) and every slow_every-th one
+    waits an extra slow_ms first. Both may be changed while serving.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 50,
+        tokens_per_second: float = 200,
+        answer_tokens: int = 60,
+        malformed_every: int = 0,
+        json_ramble_tokens: int = 0,
+        error_every: int = 0,
+        slow_every: int = 0,
+        slow_ms: float = 0,
+    ):
+        self.latency = latency_ms / 1000.0
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.malformed_every = malformed_every
+        self.json_ramble_tokens = json_ramble_tokens
+        self.error_every = error_every
+        self.slow_every = slow_every
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        # Tokens (whitespace-separated words) of all prompts received and completions produced
+        self.tokens = {"prompt": 0, "completion": 0}
+        self._json_responses = 0
+        self._calls = 0
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Mock LLM server listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # --- Canned responses ---
+    def _count(self, kind: str):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def _next_json_is_malformed(self) -> bool:
+        with self._lock:
+            self._json_responses += 1
+            return bool(self.malformed_every) and self._json_responses % self.malformed_every == 0
+
+    def next_fault(self) -> Optional[str]:
+        """Fault to inject into the next request: "error", "slow" or None."""
+        with self._lock:
+            self._calls += 1
+            calls = self._calls
+        if self.error_every and calls % self.error_every == 0:
+            self._count("error")
+            return "error"
+        if self.slow_every and calls % self.slow_every == 0:
+            self._count("slow")
+            return "slow"
+        return None
+
+    def respond(self, messages: List[Dict[str, str]]) -> str:
+        system = messages[0].get("content", "") if messages else ""
+        user = messages[-1].get("content", "") if messages else ""
+
+        if "Memory Manager" in system:
+            self._count("summarize")
+            if self._next_json_is_malformed():
+                return MALFORMED_JSON
+            return json.dumps({
+                "session_summary": {
+                    "user_profile": {"preferences": ["Python", "FastAPI"], "constraints": ["performance"]},
+                    "key_facts": ["User is a backend engineer", "User builds APIs with FastAPI"],
+                    "decisions": ["Use FastAPI for new projects"],
+                    "open_questions": [],
+                    "todos": ["Add validation for JSON outputs"],
+                },
+                "message_range_summarized": {"from_index": 0, "to_index": 0, "total_messages": 0, "timestamp": ""},
+                "metadata": {"summary_version": "1.0", "tokens_saved": 0, "compression_ratio": 0.0},
+            })
+
+        if "Query Analyst" in system:
+            # Fused mode (PIPELINE_MODE=fused): the analysis object, then the answer
+            fused = "ANSWER:" in system
+            self._count("fused" if fused else "analyze")
+            if self._next_json_is_malformed():
+                return MALFORMED_JSON
+            match = QUERY_RE.search(user)
+            query = match.group(1) if match else user
+            analysis = json.dumps({
+                "original_query": query,
+                "is_ambiguous": False,
+                "rewritten_query": query,
+                "confidence_score": 1.0,
+                "requires_clarification": False,
+                "ambiguity_reasons": [],
+                "needed_context_from_memory": [],
+                "clarifying_questions": [],
+            })
+            return f"{analysis}\nANSWER: {self._answer()}" if fused else analysis
+
+        self._count("answer")
+        return self._answer()
+
+    def _answer(self) -> str:
+        return " ".join(f"token{i}" for i in range(self.answer_tokens))
+
+    def finish_json(self, content: str, stop_on_json_end: bool) -> str:
+        if not self.json_ramble_tokens or not (content.startswith("{") and content.endswith("}")):
+            return content
+        if stop_on_json_end:
+            scanner = JsonObjectScanner()
+            scanner.feed(content)
+            return scanner.result() or content
+        ramble = " ".join(f"note{i}" for i in range(self.json_ramble_tokens))
+        return f"{content}\n\nExplanation: {ramble}"
+
+    def _generation_delay(self, text: str) -> float:
+        return len(text.split()) / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: Dict[str, Any]):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"detail": "Not Found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                fault = server.next_fault()
+                if fault == "error":
+                    self._send_json(503, {"detail": "Injected failure"})
+                    return
+                if fault == "slow":
+                    time.sleep(server.slow_ms / 1000.0)
+                messages = request.get("messages", [])
+                content = server.finish_json(server.respond(messages), bool(request.get("stop_on_json_end")))
+                prompt_tokens = sum(len(m.get("content", "").split()) for m in messages)
+                completion_tokens = len(content.split())
+                with server._lock:
+                    server.tokens["prompt"] += prompt_tokens
+                    server.tokens["completion"] += completion_tokens
+
+                time.sleep(server.latency)
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+                if request.get("stream"):
+                    self._stream(completion_id, content, usage)
+                    return
+
+                time.sleep(server._generation_delay(content))
+                self._send_json(200, {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+
+            def _stream(self, completion_id: str, content: str, usage: Dict[str, int]):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                per_token = 1.0 / server.tokens_per_second if server.tokens_per_second > 0 else 0.0
+                words = content.split(" ")
+                try:
+                    for i, word in enumerate(words):
+                        time.sleep(per_token)
+                        delta = word if i == 0 else f" {word}"
+                        chunk = {"id": completion_id, "object": "chat.completion.chunk",
+                                 "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    final = {"id": completion_id, "object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+                    self.wfile.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Client cancelled (e.g. a discarded speculative answer)
+                    pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic OpenAI-compatible mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--malformed-every", type=int, default=0, help="Make every Nth JSON response malformed")
+    parser.add_argument("--json-ramble-tokens", type=int, default=0, help="Trailing prose after JSON objects")
+    parser.add_argument("--error-every", type=int, default=0, help="Answer every Nth request with HTTP 503")
+    parser.add_argument("--slow-every", type=int, default=0, help="Delay every Nth request by --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockLLMServer(args.host, args.port, args.latency_ms, args.tokens_per_second,
+                           args.answer_tokens, args.malformed_every, args.json_ramble_tokens,
+                           args.error_every, args.slow_every, args.slow_ms)
+    print(f"Mock LLM API BASE URL: {server.base_url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
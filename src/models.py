@@ -1,48 +1,54 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional, Dict, Any
 
+
+class _Model(BaseModel):
+    # Validators/serializers are built on first use instead of at import time
+    model_config = ConfigDict(defer_build=True)
+
+
 # --- Chat Models ---
-class Message(BaseModel):
+class Message(_Model):
     role: str
     content: str
     timestamp: Optional[str] = None
 
-class ChatRequest(BaseModel):
+class ChatRequest(_Model):
     model: str
     messages: List[Message]
     temperature: float = 0.7
     max_tokens: int = 1024
 
 # --- Feature A: Session Memory Schema ---
-class UserProfile(BaseModel):
+class UserProfile(_Model):
     preferences: List[str] = Field(default_factory=list)
     constraints: List[str] = Field(default_factory=list)
 
-class SessionSummaryData(BaseModel):
+class SessionSummaryData(_Model):
     user_profile: UserProfile = Field(default_factory=UserProfile)
     key_facts: List[str] = Field(default_factory=list)
     decisions: List[str] = Field(default_factory=list)
     open_questions: List[str] = Field(default_factory=list)
     todos: List[str] = Field(default_factory=list)
 
-class MessageRange(BaseModel):
+class MessageRange(_Model):
     from_index: int
     to_index: int
     total_messages: int
     timestamp: str
 
-class SummaryMetadata(BaseModel):
+class SummaryMetadata(_Model):
     summary_version: str = "1.0"
     tokens_saved: int
     compression_ratio: float
 
-class SessionMemory(BaseModel):
+class SessionMemory(_Model):
     session_summary: SessionSummaryData
     message_range_summarized: MessageRange
     metadata: SummaryMetadata
 
 # --- Feature B: Query Understanding Schema ---
-class QueryAnalysis(BaseModel):
+class QueryAnalysis(_Model):
     """
     Kết quả phân tích câu hỏi. 
     Sử dụng Field(default...) để đảm bảo không bao giờ bị lỗi Validation.
@@ -58,5 +64,49 @@ class QueryAnalysis(BaseModel):
     requires_clarification: bool = Field(default=False)
 
     # Cấu hình để bỏ qua các trường thừa nếu LLM lỡ tay thêm vào
-    class Config:
-        extra = "ignore"
\ No newline at end of file
+    model_config = ConfigDict(extra="ignore")
+
+# --- Context Packing ---
+class ContextBreakdown(_Model):
+    budget_tokens: int
+    used_tokens: int = 0
+    # Tokens spent per section (fixed, summary, snippets, history)
+    included_tokens: Dict[str, int] = Field(default_factory=dict)
+    # Items left out per section because they did not fit
+    dropped_items: Dict[str, int] = Field(default_factory=dict)
+
+class ContextPack(_Model):
+    summary: str = ""
+    snippets: List[str] = Field(default_factory=list)
+    history: List[Dict[str, Any]] = Field(default_factory=list)
+    breakdown: ContextBreakdown
+
+# --- Pipeline Orchestration ---
+class SpeculationReport(_Model):
+    attempted: bool = False
+    kept: bool = False
+    analysis_seconds: float = 0.0
+    answer_seconds: float = 0.0
+    latency_saved_seconds: float = 0.0
+    wasted_tokens: int = 0
+
+class TurnResult(_Model):
+    analysis: QueryAnalysis
+    is_clarification: bool = False
+    # Set when the answer is already known (clarification or cached answer)
+    response_text: Optional[str] = None
+    # Prompt for the final answer when it still has to be generated/streamed
+    answer_messages: List[Dict[str, str]] = Field(default_factory=list)
+    # "two_call" or "fused" (the answer is the rest of the analysis generation)
+    pipeline_mode: str = "two_call"
+    # A still-running answer stream (FusedAnswer, or SpeculativeAnswer when speculation was kept);
+    # answer_messages is the fallback if it ends without an answer
+    answer_stream: Optional[Any] = Field(default=None, exclude=True)
+    speculation: SpeculationReport = Field(default_factory=SpeculationReport)
+    # What the answer prompt's context packer included and dropped
+    context: Optional[ContextBreakdown] = None
+    # Which stages were served from the response cache ("analysis", "answer")
+    cache_hits: List[str] = Field(default_factory=list)
+    # Set when the answer still has to be generated; the caller stores it under this key afterwards
+    answer_cache_key: Optional[str] = Field(default=None, exclude=True)
+    answer_cache_tag: Optional[str] = Field(default=None, exclude=True)
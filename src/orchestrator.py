@@ -0,0 +1,404 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from src.config import Config
+from src.llm_client import LLMClient
+from src.models import ContextBreakdown, QueryAnalysis, SpeculationReport, TurnResult
+from src.query_classifier import QueryClassifier, get_query_classifier
+from src.query_processor import QueryProcessor
+from src.session_memory import SessionMemoryManager
+from src.token_counter import get_token_counter
+from src.metrics import metrics
+from src.context_packer import ContextPacker
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeAnswer:
+    """
+    The speculative answer as it streams in. Iterating replays what has
+    arrived so far and then follows the live generation, so a kept
+    speculation can be streamed without waiting for it to finish. close()
+    (also called when iteration ends or is abandoned) stops the generation.
+    """
+
+    def __init__(self, cancel: threading.Event):
+        self.cancel = cancel
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+
+    def append(self, delta: str):
+        with self._cond:
+            self.parts.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._cond:
+            self.done, self.error = True, error
+            self._cond.notify_all()
+
+    def __iter__(self) -> Iterator[str]:
+        sent = 0
+        try:
+            while True:
+                with self._cond:
+                    while sent == len(self.parts) and not self.done:
+                        self._cond.wait()
+                    pending = self.parts[sent:]
+                    if not pending and self.error is not None:
+                        raise self.error
+                    if not pending:
+                        return
+                sent += len(pending)
+                yield from pending
+        finally:
+            self.close()
+
+    def close(self):
+        self.cancel.set()
+
+_speculation_executor: Optional[ThreadPoolExecutor] = None
+_speculation_executor_lock = threading.Lock()
+
+
+def get_speculation_executor() -> ThreadPoolExecutor:
+    """Process-wide pool for speculative answers, created on the first speculative turn."""
+    global _speculation_executor
+    with _speculation_executor_lock:
+        if _speculation_executor is None:
+            _speculation_executor = ThreadPoolExecutor(max_workers=Config.SPECULATION_WORKERS,
+                                                       thread_name_prefix="speculate")
+        return _speculation_executor
+
+
+class SpeculationStats:
+    """Process-wide totals: how much latency speculation saved and what it wasted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempted = 0
+        self.kept = 0
+        self.cancelled = 0
+        self.latency_saved_seconds = 0.0
+        self.wasted_tokens = 0
+
+    def record(self, report: SpeculationReport):
+        if not report.attempted:
+            return
+        metrics.inc("speculation_total", outcome="kept" if report.kept else "cancelled")
+        metrics.inc("speculation_latency_saved_seconds_total", report.latency_saved_seconds)
+        metrics.inc("speculation_wasted_tokens_total", report.wasted_tokens)
+        with self._lock:
+            self.attempted += 1
+            if report.kept:
+                self.kept += 1
+                self.latency_saved_seconds += report.latency_saved_seconds
+            else:
+                self.cancelled += 1
+                self.wasted_tokens += report.wasted_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "attempted": self.attempted,
+                "kept": self.kept,
+                "cancelled": self.cancelled,
+                "keep_rate": round(self.kept / self.attempted, 4) if self.attempted else 0.0,
+                "latency_saved_seconds": round(self.latency_saved_seconds, 3),
+                "wasted_tokens": self.wasted_tokens,
+            }
+
+
+speculation_stats = SpeculationStats()
+
+
+class TurnOrchestrator:
+    """
+    Runs one chat turn: query analysis -> (clarification | answer).
+    When the query looks unambiguous, answer generation on the original query
+    starts concurrently with the analysis call and is kept only if the analysis
+    leaves the query unchanged and needs no clarification; a kept answer is
+    handed over as a live stream (TurnResult.answer_stream), not waited for.
+
+    With pipeline_mode="fused", a query that needs the LLM is analyzed and
+    answered by one generation instead: prepare_turn returns once the analysis
+    object has streamed in, and the rest of that stream is the answer
+    (stream_answer). Clarification turns stop the generation there.
+    """
+
+    def __init__(
+        self,
+        llm_client: LLMClient,
+        query_processor: QueryProcessor,
+        memory_manager: SessionMemoryManager,
+        classifier: Optional[QueryClassifier] = None,
+        speculate: bool = Config.SPECULATIVE_ANSWERS,
+        context_budget: int = Config.ANSWER_CONTEXT_BUDGET_TOKENS,
+        pipeline_mode: str = Config.PIPELINE_MODE,
+    ):
+        if pipeline_mode not in ("two_call", "fused"):
+            raise ValueError(f"Unknown pipeline mode: {pipeline_mode!r} (expected 'two_call' or 'fused')")
+        self.llm = llm_client
+        self.query_processor = query_processor
+        self.memory_manager = memory_manager
+        self.classifier = classifier or get_query_classifier()
+        self.speculate = speculate
+        self.packer = ContextPacker(context_budget)
+        self.pipeline_mode = pipeline_mode
+
+    # --- Prompt building ---
+    @staticmethod
+    def _answer_system_prompt(user_profile_str: str, context: str) -> str:
+        return f"""
+                You are a helpful AI assistant.
+                Current Date: {datetime.now().strftime("%Y-%m-%d")}
+
+                === USER INFORMATION ===
+                {user_profile_str}
+
+                === CONTEXT ===
+                {context or "No specific context found."}
+
+                INSTRUCTIONS:
+                - Answer the user's question using the CONTEXT.
+                - Maintain a helpful tone.
+                """
+
+    def pack_answer_context(self, query: str, context: str, history: List[Dict],
+                            snippets: Optional[List[str]] = None) -> Tuple[List[Dict[str, str]], ContextBreakdown]:
+        """Answer prompt packed to the token budget; returns (messages, ContextBreakdown)."""
+        # Get User Profile for Personalization
+        user_profile_str = ""
+        summary = self.memory_manager.compact_summary()
+        if summary:
+            user_profile_str = f"User Profile/Facts: {summary.key_facts}"
+
+        packed = self.packer.pack(
+            fixed=[self._answer_system_prompt("", context), query],
+            summary=user_profile_str,
+            snippets=snippets,
+            history=history,
+        )
+        if packed.snippets:
+            recalled = "Relevant earlier messages:\n" + "\n".join(packed.snippets)
+            context = f"{context}\n\n{recalled}" if context else recalled
+
+        final_messages = [{"role": "system", "content": self._answer_system_prompt(packed.summary, context)}]
+        for m in packed.history:
+            final_messages.append({"role": m["role"], "content": m["content"]})
+        final_messages.append({"role": "user", "content": query})
+        return final_messages, packed.breakdown
+
+    def build_answer_messages(self, query: str, context: str, history: List[Dict],
+                              snippets: Optional[List[str]] = None) -> List[Dict[str, str]]:
+        return self.pack_answer_context(query, context, history, snippets)[0]
+
+    @staticmethod
+    def apply_clarification_policy(analysis: QueryAnalysis, query: str) -> QueryAnalysis:
+        # --- [CRITICAL LOGIC] OVERRIDE CONFIDENCE SCORE ---
+        if analysis.is_ambiguous and analysis.confidence_score < 0.9:
+            analysis.requires_clarification = True
+            if not analysis.clarifying_questions:
+                analysis.clarifying_questions = [
+                    f"I'm not 100% sure what '{query}' refers to in this context. Could you clarify?",
+                    f"Are you asking about {analysis.rewritten_query}?"
+                ]
+        return analysis
+
+    # --- Speculation ---
+    def _generate_speculative(self, messages: List[Dict[str, str]], answer: SpeculativeAnswer) -> Tuple[str, bool, float]:
+        """Streams the answer into answer so generation can be abandoned mid-way on cancel."""
+        start = time.perf_counter()
+        error: Optional[Exception] = None
+        try:
+            stream = self.llm.stream_chat_completion(messages)
+            try:
+                for delta in stream:
+                    answer.append(delta)
+                    if answer.cancel.is_set():
+                        return "".join(answer.parts), False, time.perf_counter() - start
+            finally:
+                stream.close()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            answer.finish(error)
+        return "".join(answer.parts), True, time.perf_counter() - start
+
+    @staticmethod
+    def _record_kept(future: Future, report: SpeculationReport):
+        try:
+            _, _, answer_seconds = future.result()
+        except Exception as e:
+            logger.error(f"Speculative generation failed: {e}")
+            return
+        report.answer_seconds = round(answer_seconds, 4)
+
+    @staticmethod
+    def _record_cancelled(future: Future, report: SpeculationReport):
+        try:
+            text, _, answer_seconds = future.result()
+        except Exception:
+            text, answer_seconds = "", 0.0
+        report.answer_seconds = round(answer_seconds, 4)
+        report.wasted_tokens = get_token_counter().count_tokens(text)
+        speculation_stats.record(report)
+
+    def _should_speculate(self, query: str) -> bool:
+        if not self.speculate or not hasattr(self.llm, "stream_chat_completion"):
+            return False
+        return self.classifier.likely_unambiguous(query)
+
+    def prepare_turn(self, query: str, history: List[Dict]) -> TurnResult:
+        with metrics.span("turn_prepare"):
+            return self._prepare_turn(query, history)
+
+    def _prepare_turn(self, query: str, history: List[Dict]) -> TurnResult:
+        memory_context = self.memory_manager.get_context_string()
+        report = SpeculationReport()
+        future: Optional[Future] = None
+        speculative_context: Optional[ContextBreakdown] = None
+        fused_answer = None
+        fused_snippets: List[str] = []
+        fused_messages: List[Dict[str, str]] = []
+        fused_context: Optional[ContextBreakdown] = None
+        speculative_messages: List[Dict[str, str]] = []
+        speculative_answer = SpeculativeAnswer(threading.Event())
+
+        start = time.perf_counter()
+        # The rule-based fast path is local and instant, so there is nothing to overlap with it
+        analysis = self.query_processor.fast_path(query, history, memory_context)
+        cache_hits = []
+        if analysis is None:
+            analysis = self.query_processor.cached_analysis(query, history, memory_context)
+            if analysis is not None:
+                cache_hits.append("analysis")
+        if analysis is None and self.pipeline_mode == "fused":
+            fused_snippets = self.query_processor.recall_snippets([query], self.memory_manager)
+            analysis, fused_answer, fused_messages, fused_context = self.query_processor.analyze_fused(
+                query, history, memory_context, fused_snippets)
+        elif analysis is None:
+            if self._should_speculate(query):
+                report.attempted = True
+                snippets = self.query_processor.recall_snippets([query], self.memory_manager)
+                speculative_messages, speculative_context = self.pack_answer_context(query, "", history, snippets)
+                future = get_speculation_executor().submit(
+                    self._generate_speculative, speculative_messages, speculative_answer)
+            analysis = self.query_processor.analyze_with_llm(query, history, memory_context)
+        analysis = self.apply_clarification_policy(analysis, query)
+        report.analysis_seconds = round(time.perf_counter() - start, 4)
+
+        result = TurnResult(analysis=analysis, speculation=report, cache_hits=cache_hits,
+                            pipeline_mode="fused" if fused_answer is not None else "two_call")
+
+        if future is not None:
+            keep = analysis.rewritten_query.strip() == query.strip() and not analysis.requires_clarification
+            if keep and future.done() and future.exception() is not None:
+                logger.error(f"Speculative generation failed: {future.exception()}")
+                keep = False
+            if keep:
+                # Stream the rest of the running generation instead of waiting for it.
+                # Sequential cost would be analysis + answer; the overlap is what we saved
+                report.kept = True
+                report.latency_saved_seconds = report.analysis_seconds
+                if future.done():
+                    report.latency_saved_seconds = round(min(report.analysis_seconds, future.result()[2]), 4)
+                result.answer_stream = speculative_answer
+                result.answer_messages = speculative_messages
+                result.context = speculative_context
+                speculation_stats.record(report)
+                future.add_done_callback(lambda f: self._record_kept(f, report))
+            else:
+                # Don't block the turn on the abandoned stream; account for it when it stops
+                speculative_answer.close()
+                future.add_done_callback(lambda f, r=report.model_copy(): self._record_cancelled(f, r))
+            logger.info(f"Speculation {'kept' if report.kept else 'cancelled'}: saved={report.latency_saved_seconds}s")
+
+        if analysis.requires_clarification:
+            if fused_answer is not None:
+                # Early stop: nothing after the analysis is needed
+                fused_answer.close()
+            result.is_clarification = True
+            result.response_text = analysis.clarifying_questions[0] if analysis.clarifying_questions else "Could you please clarify?"
+        else:
+            cache = self.query_processor.cache
+            # Answers are cached under the exact prompt that produced them (history included)
+            if report.kept:
+                # Kept speculation answers the same (unchanged) query from its own prompt
+                result.answer_cache_key, result.answer_cache_tag = cache.answer_key(speculative_messages, memory_context)
+                return result
+
+            if fused_answer is not None:
+                prompt, result.context = fused_messages, fused_context
+            else:
+                snippets = self.query_processor.recall_snippets(
+                    self.query_processor.recall_queries(analysis), self.memory_manager)
+                prompt, result.context = self.pack_answer_context(
+                    analysis.rewritten_query, analysis.augmented_context, history, snippets)
+            result.answer_cache_key, result.answer_cache_tag = cache.answer_key(prompt, memory_context)
+            cached = cache.get_answer(result.answer_cache_key)
+            if cached is not None:
+                if fused_answer is not None:
+                    fused_answer.close()
+                result.response_text = cached
+                result.cache_hits.append("answer")
+                result.answer_cache_key = None
+            elif fused_answer is not None:
+                result.answer_stream = fused_answer
+                # Only used if the generation ends without an answer (see stream_answer)
+                result.answer_messages = self.pack_answer_context(
+                    analysis.rewritten_query, analysis.augmented_context, history, fused_snippets)[0]
+            else:
+                result.answer_messages = prompt
+        return result
+
+    def record_answer(self, result: TurnResult, response_text: str):
+        """Stores a generated answer in the response cache (call after streaming/generating it)."""
+        if result.answer_cache_key:
+            self.query_processor.cache.put_answer(result.answer_cache_key, result.answer_cache_tag, response_text)
+            result.answer_cache_key = None
+
+    def stream_answer(self, result: TurnResult) -> Iterator[str]:
+        """
+        Answer deltas for a prepared turn whose response_text is None: the rest
+        of the fused generation, or a separate answer call (two_call mode, or a
+        fused generation that stopped after the analysis).
+        """
+        if result.answer_stream is not None:
+            answered = False
+            for delta in result.answer_stream:
+                answered = True
+                yield delta
+            if answered:
+                return
+            if result.pipeline_mode == "fused":
+                logger.warning("Fused generation ended without an answer; generating it separately")
+                metrics.inc("fused_answer_missing_total")
+                # The cache key describes the fused prompt, not the one this answer comes from
+                result.answer_cache_key = None
+            else:
+                logger.warning("Speculative generation produced no answer; generating it again")
+        stream = self.llm.stream_chat_completion(result.answer_messages)
+        try:
+            yield from stream
+        finally:
+            stream.close()
+
+    def run_turn(self, query: str, history: List[Dict]) -> TurnResult:
+        """Blocking variant of prepare_turn that also generates the final answer."""
+        with metrics.span("turn"):
+            result = self.prepare_turn(query, history)
+            if result.response_text is None:
+                with metrics.span("answer_generation"):
+                    if result.answer_stream is not None:
+                        result.response_text = "".join(self.stream_answer(result))
+                    else:
+                        result.response_text = self.llm.chat_completion(result.answer_messages)
+                self.record_answer(result, result.response_text)
+        return result
@@ -0,0 +1,199 @@
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from src.config import Config
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _prefix_key(ids: Sequence[int]) -> str:
+    return hashlib.sha256(",".join(map(str, ids)).encode("ascii")).hexdigest()[:16]
+
+
+def _expand_cache(cache: Any, batch_size: int) -> Any:
+    """Private copy of a cached prefix for one generate() call (generate appends to it in place)."""
+    cache = copy.deepcopy(cache)
+    if batch_size == 1:
+        return cache
+    if hasattr(cache, "batch_repeat_interleave"):
+        cache.batch_repeat_interleave(batch_size)
+        return cache
+    # Legacy tuple-of-tuples cache
+    return tuple(tuple(t.repeat_interleave(batch_size, dim=0) for t in layer) for layer in cache)
+
+
+class PrefixKVCache:
+    """
+    Reuses the prefill of static prompt prefixes (the analysis and summary
+    system prompts) across requests of a HF causal LM.
+
+    A prefix becomes cacheable once it is warmed explicitly or has been seen
+    in min_seen requests; its past-key-values are then computed once and kept
+    in an LRU bounded by entry count and total tokens, keyed by a hash of the
+    prefix token ids. prepare_inputs() tokenizes a batch and, when every prompt
+    starts with the same cached prefix, returns the inputs laid out as
+    [prefix | left padding | suffix] together with a copy of the cached KV
+    expanded to the batch. Position ids follow the attention mask, so the
+    prefix keeps positions 0..P-1 in every row and generate() only runs
+    prefill over the suffixes. Anything else falls back to plain left padding.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_entries: int = Config.PREFIX_CACHE_MAX_ENTRIES,
+        max_tokens: int = Config.PREFIX_CACHE_MAX_TOKENS,
+        min_tokens: int = Config.PREFIX_CACHE_MIN_TOKENS,
+        min_seen: int = Config.PREFIX_CACHE_MIN_SEEN,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.min_seen = min_seen
+        self._lock = threading.Lock()
+        # Every prefix seen so far (bounded), with how often it was seen
+        self._known: "OrderedDict[str, Tuple[Tuple[int, ...], int]]" = OrderedDict()
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, ...], Any]]" = OrderedDict()
+        # Keys whose KV is being built (outside the lock)
+        self._building: Set[str] = set()
+        self.cached_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.reused_tokens = 0
+
+    # --- Registration ---
+    def _encode(self, text: str) -> Tuple[int, ...]:
+        # Chat-template text already carries BOS/special tokens
+        return tuple(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def observe(self, prefix_text: str, warm: bool = False) -> Optional[str]:
+        """Records that a request starts with prefix_text; returns its key if it is long enough to cache."""
+        ids = self._encode(prefix_text)
+        if len(ids) < self.min_tokens:
+            return None
+        key = _prefix_key(ids)
+        with self._lock:
+            _, seen = self._known.pop(key, (ids, 0))
+            self._known[key] = (ids, self.min_seen if warm else seen + 1)
+            limit = 4 * max(self.max_entries, 1)
+            # Forget the least recently seen prefixes that hold no KV
+            for stale in list(self._known):
+                if len(self._known) <= limit:
+                    break
+                if stale not in self._entries:
+                    del self._known[stale]
+        return key
+
+    def warm(self, prefix_texts: Iterable[str]):
+        """Computes the KV of known static prefixes up front (e.g. at server start)."""
+        for text in prefix_texts:
+            key = self.observe(text, warm=True)
+            if key:
+                self._entry(key)
+
+    # --- Lookup ---
+    def _build(self, ids: Tuple[int, ...]) -> Any:
+        import torch
+        with torch.no_grad():
+            output = self.model(input_ids=torch.tensor([ids], device=self.model.device), use_cache=True)
+        return output.past_key_values
+
+    def _entry(self, key: str) -> Optional[Tuple[Tuple[int, ...], Any]]:
+        """
+        Cached (ids, kv) for a qualified prefix, building it on first use. The
+        forward pass runs outside the lock; a prefix another thread is still
+        building counts as not cached for this request.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            ids, seen = self._known.get(key, ((), 0))
+            if not ids or seen < self.min_seen or len(ids) > self.max_tokens or key in self._building:
+                return None
+            self._building.add(key)
+        try:
+            entry = (ids, self._build(ids))
+        finally:
+            with self._lock:
+                self._building.discard(key)
+        with self._lock:
+            self.builds += 1
+            metrics.inc("prefix_cache_builds_total")
+            self._entries[key] = entry
+            self.cached_tokens += len(ids)
+            while len(self._entries) > self.max_entries or self.cached_tokens > self.max_tokens:
+                _, (evicted_ids, _) = self._entries.popitem(last=False)
+                self.cached_tokens -= len(evicted_ids)
+            metrics.set_gauge("prefix_cache_tokens", self.cached_tokens)
+        return entry
+
+    def _match(self, prompt_ids: List[List[int]]) -> Optional[Tuple[Tuple[int, ...], Any]]:
+        """Longest qualified prefix shared by every prompt (each must have at least one token after it)."""
+        with self._lock:
+            candidates = sorted(self._known.items(), key=lambda item: len(item[1][0]), reverse=True)
+        for key, (ids, _) in candidates:
+            n = len(ids)
+            if all(len(p) > n and tuple(p[:n]) == ids for p in prompt_ids):
+                entry = self._entry(key)
+                if entry is not None:
+                    return entry
+        return None
+
+    def prepare_inputs(self, prompts: List[str]) -> Tuple[Dict[str, Any], Optional[Any]]:
+        """Tokenized batch (left padded) plus past_key_values to pass to generate(), or None."""
+        import torch
+
+        tokenizer = self.tokenizer
+        prompt_ids = [tokenizer(p, add_special_tokens=False)["input_ids"] for p in prompts]
+        entry = self._match(prompt_ids)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            metrics.inc("prefix_cache_requests_total", len(prompts), result="miss")
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+            return inputs.to(self.model.device), None
+
+        prefix, kv = entry
+        n = len(prefix)
+        width = max(len(p) - n for p in prompt_ids)
+        pad = tokenizer.pad_token_id
+        input_ids, attention_mask = [], []
+        for p in prompt_ids:
+            suffix = list(p[n:])
+            gap = width - len(suffix)
+            input_ids.append(list(prefix) + [pad] * gap + suffix)
+            attention_mask.append([1] * n + [0] * gap + [1] * len(suffix))
+        with self._lock:
+            self.hits += 1
+            self.reused_tokens += n * len(prompts)
+        metrics.inc("prefix_cache_requests_total", len(prompts), result="hit")
+        metrics.inc("prefix_cache_reused_tokens_total", n * len(prompts))
+        inputs = {
+            "input_ids": torch.tensor(input_ids, device=self.model.device),
+            "attention_mask": torch.tensor(attention_mask, device=self.model.device),
+        }
+        return inputs, _expand_cache(kv, len(prompts))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "cached_tokens": self.cached_tokens,
+                "known_prefixes": len(self._known),
+                "hits": self.hits,
+                "misses": self.misses,
+                "builds": self.builds,
+                "reused_tokens": self.reused_tokens,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,183 @@
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional
+from src.models import QueryAnalysis
+
+logger = logging.getLogger(__name__)
+
+_GREETING = r"(hi|hello|hey|howdy|good (morning|afternoon|evening)|thanks|thank you|bye|goodbye|xin chào|chào|cảm ơn)"
+# The whole message is a greeting, optionally addressed ("hi there", "thanks a lot")
+GREETING_RE = re.compile(
+    rf"^\W*{_GREETING}(\W+(there|all|everyone|again|so much|a lot|bạn))*\W*$",
+    re.IGNORECASE,
+)
+# The whole message is a self-introduction (a name of up to three words), optionally after a greeting
+SELF_INTRO_RE = re.compile(
+    rf"^\W*({_GREETING}\W+)?(my name is|call me|i am called|tên (tôi|mình) là)\s+[\w.'-]+(\s+[\w.'-]+){{0,2}}\W*$",
+    re.IGNORECASE,
+)
+CODE_INTENT_RE = re.compile(
+    r"\b(how (do|can|should) i|how to|implement|write|code|example|snippet|build|create|set up|setup)\b",
+    re.IGNORECASE,
+)
+# Words that usually point back at something said earlier
+ANAPHORA_RE = re.compile(
+    r"\b(it|its|it's|this|that|these|those|they|them|their|he|him|his|she|her|there|"
+    r"the same|the above|the previous|the former|the latter|one)\b",
+    re.IGNORECASE,
+)
+# Follow-up cues: comparisons, alternatives and recall of earlier turns. They need the
+# conversation to be understood but, unlike a bare pronoun, can still make sense without it
+FOLLOW_UP_RE = re.compile(
+    r"\b(instead|mentioned|decided|agreed|discussed|earlier|before|again|previous|previously|last time|"
+    r"other|others|another|both|either|neither|two options|the options|what about|how about|"
+    r"remind|recall|you said|we said|as well|also|too|vs|versus|compared?)\b",
+    re.IGNORECASE,
+)
+# How a standalone question or request opens
+STANDALONE_START_RE = re.compile(
+    r"^\s*(what|how|why|when|where|which|who|is|are|does|do|can|could|should|explain|describe|"
+    r"show|list|write|give|create|build|implement|define)\b",
+    re.IGNORECASE,
+)
+WORD_RE = re.compile(r"[\w.+#-]+", re.UNICODE)
+# Identifier-looking tokens: versions, dotted paths, snake_case, camelCase, C++/C#
+CODE_TOKEN_RE = re.compile(r"\d|[._]|[a-z][A-Z]|\+\+|#$")
+
+KNOWN_ENTITIES = {
+    "python", "fastapi", "flask", "django", "postgresql", "postgres", "mysql", "sqlite", "redis",
+    "docker", "kubernetes", "llama", "langchain", "pydantic", "streamlit", "react", "javascript",
+    "typescript", "sql", "json", "rest", "graphql", "vllm", "pytorch", "tensorflow", "numpy", "pandas",
+    "git", "linux", "aws", "gcp", "azure", "openai", "huggingface", "colab", "ngrok", "uvicorn",
+}
+
+
+class QueryClassifier:
+    """
+    Cheap local pre-classifier run before the LLM query-analysis call.
+    Returns a QueryAnalysis only when the rules are confident; None means
+    "genuinely ambiguous, ask the LLM".
+    """
+
+    def __init__(self, max_greeting_words: int = 12, min_self_contained_words: int = 4):
+        self.max_greeting_words = max_greeting_words
+        self.min_self_contained_words = min_self_contained_words
+        self._lock = threading.Lock()
+        self.total = 0
+        self.hits: Dict[str, int] = {}
+
+    @staticmethod
+    def _entities(query: str) -> List[str]:
+        """Known technologies, identifier-like tokens and quoted terms (capitalization alone does not count)."""
+        found = []
+        for word in WORD_RE.findall(query):
+            stripped = word.strip(".-")
+            if not stripped:
+                continue
+            if stripped.lower() in KNOWN_ENTITIES:
+                found.append(stripped)
+            elif len(stripped) > 1 and CODE_TOKEN_RE.search(stripped) and not stripped.isdigit():
+                found.append(stripped)
+        found.extend(re.findall(r"[\"'`]([^\"'`]{2,})[\"'`]", query))
+        return found
+
+    @staticmethod
+    def likely_unambiguous(query: str) -> bool:
+        """Heuristic for speculation: the LLM will probably keep the query as-is."""
+        return not ANAPHORA_RE.search(query) and not FOLLOW_UP_RE.search(query) \
+            and not CODE_INTENT_RE.search(query)
+
+    def _record(self, rule: Optional[str]):
+        with self._lock:
+            self.total += 1
+            if rule:
+                self.hits[rule] = self.hits.get(rule, 0) + 1
+
+    def classify(self, query: str, recent_history: List[Dict], memory_context: str = "") -> Optional[QueryAnalysis]:
+        text = query.strip()
+        words = WORD_RE.findall(text)
+        has_anaphora = bool(ANAPHORA_RE.search(text))
+        is_follow_up = has_anaphora or bool(FOLLOW_UP_RE.search(text))
+        result: Optional[QueryAnalysis] = None
+        rule: Optional[str] = None
+
+        if not words:
+            rule = "empty"
+            result = self._clarify(query, "Empty query")
+        elif (GREETING_RE.match(text) or SELF_INTRO_RE.match(text)) and len(words) <= self.max_greeting_words:
+            # Both patterns span the whole message, so nothing else is being asked
+            rule = "greeting"
+            result = self._clear(query, query, ["User is greeting or introducing themselves"])
+        elif has_anaphora and not recent_history and not memory_context.strip():
+            # A reference with nothing to resolve it against: rubric score 0.1
+            rule = "unresolvable_reference"
+            result = self._clarify(query, "Query refers to something not present in the conversation")
+        elif not is_follow_up and len(words) >= self.min_self_contained_words and STANDALONE_START_RE.search(text):
+            # Naming an entity is not enough: the query must also read as a standalone
+            # question or request with no cue pointing back at the conversation
+            entities = self._entities(text)
+            if entities:
+                rule = "self_contained"
+                rewritten = query
+                reasons = [f"Query names explicit entities: {', '.join(entities[:5])}"]
+                if CODE_INTENT_RE.search(text):
+                    base = query.rstrip()
+                    separator = "" if base.endswith((".", "?", "!")) else "."
+                    rewritten = f"{base}{separator} Please provide code examples."
+                    reasons.append("User wants implementation details")
+                result = self._clear(query, rewritten, reasons)
+
+        self._record(rule)
+        if rule:
+            logger.info(f"Query fast path hit ({rule}), skipping LLM analysis")
+        return result
+
+    @staticmethod
+    def _clear(query: str, rewritten: str, reasons: List[str]) -> QueryAnalysis:
+        return QueryAnalysis(
+            original_query=query,
+            is_ambiguous=False,
+            ambiguity_reasons=reasons,
+            rewritten_query=rewritten,
+            augmented_context="No specific context resolved from history.",
+            confidence_score=1.0,
+            requires_clarification=False,
+        )
+
+    @staticmethod
+    def _clarify(query: str, reason: str) -> QueryAnalysis:
+        return QueryAnalysis(
+            original_query=query,
+            is_ambiguous=True,
+            ambiguity_reasons=[reason],
+            rewritten_query=query,
+            augmented_context="No specific context resolved from history.",
+            clarifying_questions=[f"Could you tell me what '{query.strip()}' refers to?"],
+            confidence_score=0.1,
+            requires_clarification=True,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hit_total = sum(self.hits.values())
+            return {
+                "total": self.total,
+                "fast_path_hits": hit_total,
+                "llm_fallthrough": self.total - hit_total,
+                "hit_rate": round(hit_total / self.total, 4) if self.total else 0.0,
+                "by_rule": dict(self.hits),
+            }
+
+
+_default_classifier: Optional[QueryClassifier] = None
+_default_classifier_lock = threading.Lock()
+
+
+def get_query_classifier() -> QueryClassifier:
+    """Process-wide classifier so the hit-rate counters survive Streamlit reruns."""
+    global _default_classifier
+    with _default_classifier_lock:
+        if _default_classifier is None:
+            _default_classifier = QueryClassifier()
+        return _default_classifier
@@ -1,118 +1,298 @@
+import itertools
 import logging
 import json
-from typing import List, Dict
-from src.llm_client import LLMClient
-from src.models import QueryAnalysis
+from typing import Iterator, List, Dict, Optional, Tuple
+from src.config import Config
+from src.llm_client import ANSWER_TEMPERATURE, LLMClient
+from src.json_stream import JsonObjectScanner
+from src.models import ContextBreakdown, QueryAnalysis
+from src.query_classifier import QueryClassifier, get_query_classifier
+from src.metrics import metrics
+from src.context_packer import ContextPacker
+from src.response_cache import ResponseCache, get_response_cache
 
 logger = logging.getLogger(__name__)
 
+# --- PROMPT: KẾT HỢP GIAO TIẾP + CODE INTENT ---
+# Kept byte-identical across calls (nothing per-request in it) so the inference
+# server can reuse its prefill from the prefix cache; query, memory and history
+# go in the user message.
+_ANALYSIS_INSTRUCTIONS = """
+You are an expert Query Analyst for a RAG system.
+
+YOUR GOALS:
+1. Resolve pronouns (he, she, it, that) in the USER QUERY using CHAT HISTORY.
+2. Analyze if the query is Technical, Social, or Ambiguous.
+3. **CRITICAL:** If the query is about PROGRAMMING, IMPLEMENTATION, or "HOW TO", append "Please provide code examples" to the 'rewritten_query'.
+4. Assign a 'confidence_score' based on the RUBRIC below.
+
+=== SCORE RUBRIC (How to judge confidence) ===
+- 1.0 (Certain): 
+     a) The query names specific entities (e.g., "FastAPI", "PostgreSQL").
+     b) OR The query asks for CODE/IMPLEMENTATION (e.g., "How do I write a loop?").
+     c) OR The query is a CLEAR GREETING or SELF-INTRO (e.g., "Hi", "Hello", "My name is Son").
+- 0.8 (Likely): You inferred the target from context, but there is a small chance of error.
+- 0.5 (Unsure): The pronoun could refer to multiple things in history.
+- 0.1 (Guessing): No context available to resolve the ambiguity.
+
+=== EXAMPLES FOR TRAINING ===
+
+-- Example 1: Coding Question (Add Code Request) --
+History: [{"role": "user", "content": "I want to build an API."}]
+Query: "How to start?"
+Output: {
+    "original_query": "How to start?",
+    "is_ambiguous": true,
+    "rewritten_query": "How to start building an API? Please provide code examples.",
+    "confidence_score": 0.9, 
+    "requires_clarification": false, 
+    "ambiguity_reasons": ["Inferred 'it' is API", "User wants implementation details"],
+    "needed_context_from_memory": [],
+    "clarifying_questions": []
+}
+
+-- Example 2: Social / Greeting (Keep Natural) --
+History: []
+Query: "Hi, my name is Son"
+Output: {
+    "original_query": "Hi, my name is Son",
+    "is_ambiguous": false,
+    "rewritten_query": "Hi, my name is Son",
+    "confidence_score": 1.0,
+    "requires_clarification": false,
+    "ambiguity_reasons": ["User is introducing themselves"],
+    "needed_context_from_memory": [],
+    "clarifying_questions": []
+}
+"""
+
+ANALYSIS_SYSTEM_PROMPT = _ANALYSIS_INSTRUCTIONS + """
+RESPONSE RULES:
+- Output STRICT JSON only.
+- ALL fields are required.
+- If 'confidence_score' < 0.9, you MUST set 'requires_clarification' to true.
+"""
+
+# Fused mode: one generation carries the analysis object and then the answer
+FUSED_ANSWER_MARKER = "ANSWER:"
+
+FUSED_SYSTEM_PROMPT = _ANALYSIS_INSTRUCTIONS + f"""
+RESPONSE RULES:
+- First output the analysis as ONE JSON object with ALL fields above.
+- If 'confidence_score' < 0.9, you MUST set 'requires_clarification' to true.
+- If 'requires_clarification' is true, STOP right after the JSON object.
+- Otherwise write a new line starting with "{FUSED_ANSWER_MARKER}" after the JSON object, then answer
+  the 'rewritten_query' as a helpful AI assistant, using the LONG TERM MEMORY, the CHAT HISTORY and
+  the RELEVANT EARLIER MESSAGES.
+"""
+
+
+class FusedAnswer:
+    """
+    The answer part of a fused generation: the deltas that follow the
+    analysis object, without the ANSWER: marker. close() ends the underlying
+    stream (e.g. a clarification turn, or an answer served from the cache).
+    """
+
+    def __init__(self, stream: Iterator[str], head: str = ""):
+        self._stream = stream
+        self._head = head
+
+    def __iter__(self) -> Iterator[str]:
+        pending, started = "", False
+        try:
+            for delta in itertools.chain((self._head,), self._stream):
+                if started:
+                    yield delta
+                    continue
+                # Hold back leading whitespace and the marker, which may be split across deltas
+                pending += delta
+                text = pending.lstrip()
+                if FUSED_ANSWER_MARKER.startswith(text):
+                    continue
+                if text.startswith(FUSED_ANSWER_MARKER):
+                    text = text[len(FUSED_ANSWER_MARKER):].lstrip()
+                if text:
+                    started = True
+                    yield text
+        finally:
+            self.close()
+
+    def close(self):
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            close()
+
+
 class QueryProcessor:
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, classifier: Optional[QueryClassifier] = None,
+                 use_fast_path: bool = Config.QUERY_FAST_PATH, top_k: int = Config.RETRIEVAL_TOP_K,
+                 context_budget: int = Config.ANALYSIS_CONTEXT_BUDGET_TOKENS,
+                 fused_context_budget: int = Config.ANSWER_CONTEXT_BUDGET_TOKENS,
+                 response_cache: Optional[ResponseCache] = None):
         self.llm = llm_client
+        self.classifier = (classifier or get_query_classifier()) if use_fast_path else None
+        self.top_k = top_k
+        self.packer = ContextPacker(context_budget)
+        self.fused_packer = ContextPacker(fused_context_budget)
+        self.cache = response_cache or get_response_cache()
 
     def process_query(self, query: str, recent_history: List[Dict], memory_context: str) -> QueryAnalysis:
         logger.info(f"Processing query: {query}")
-        
-        history_text = json.dumps(recent_history[-5:], ensure_ascii=False) if recent_history else "[]"
-        
-        # --- PROMPT: KẾT HỢP GIAO TIẾP + CODE INTENT ---
-        system_prompt = """
-        You are an expert Query Analyst for a RAG system.
-        
-        YOUR GOALS:
-        1. Resolve pronouns (he, she, it, that) in the USER QUERY using CHAT HISTORY.
-        2. Analyze if the query is Technical, Social, or Ambiguous.
-        3. **CRITICAL:** If the query is about PROGRAMMING, IMPLEMENTATION, or "HOW TO", append "Please provide code examples" to the 'rewritten_query'.
-        4. Assign a 'confidence_score' based on the RUBRIC below.
-        
-        === SCORE RUBRIC (How to judge confidence) ===
-        - 1.0 (Certain): 
-             a) The query names specific entities (e.g., "FastAPI", "PostgreSQL").
-             b) OR The query asks for CODE/IMPLEMENTATION (e.g., "How do I write a loop?").
-             c) OR The query is a CLEAR GREETING or SELF-INTRO (e.g., "Hi", "Hello", "My name is Son").
-        - 0.8 (Likely): You inferred the target from context, but there is a small chance of error.
-        - 0.5 (Unsure): The pronoun could refer to multiple things in history.
-        - 0.1 (Guessing): No context available to resolve the ambiguity.
-
-        === EXAMPLES FOR TRAINING ===
-
-        -- Example 1: Coding Question (Add Code Request) --
-        History: [{"role": "user", "content": "I want to build an API."}]
-        Query: "How to start?"
-        Output: {
-            "original_query": "How to start?",
-            "is_ambiguous": true,
-            "rewritten_query": "How to start building an API? Please provide code examples.",
-            "confidence_score": 0.9, 
-            "requires_clarification": false, 
-            "ambiguity_reasons": ["Inferred 'it' is API", "User wants implementation details"],
-            "needed_context_from_memory": [],
-            "clarifying_questions": []
-        }
-
-        -- Example 2: Social / Greeting (Keep Natural) --
-        History: []
-        Query: "Hi, my name is Son"
-        Output: {
-            "original_query": "Hi, my name is Son",
-            "is_ambiguous": false,
-            "rewritten_query": "Hi, my name is Son",
-            "confidence_score": 1.0,
-            "requires_clarification": false,
-            "ambiguity_reasons": ["User is introducing themselves"],
-            "needed_context_from_memory": [],
-            "clarifying_questions": []
-        }
-
-        RESPONSE RULES:
-        - Output STRICT JSON only.
-        - ALL fields are required.
-        - If 'confidence_score' < 0.9, you MUST set 'requires_clarification' to true.
-        """
 
-        user_prompt = f"""
+        # Cheap local rules first; only genuinely ambiguous queries reach the LLM
+        fast_analysis = self.fast_path(query, recent_history, memory_context)
+        if fast_analysis:
+            return fast_analysis
+        cached = self.cached_analysis(query, recent_history, memory_context)
+        if cached:
+            return cached
+        return self.analyze_with_llm(query, recent_history, memory_context)
+
+    def fast_path(self, query: str, recent_history: List[Dict], memory_context: str) -> Optional[QueryAnalysis]:
+        if not self.classifier:
+            return None
+        with metrics.span("query_fast_path") as span:
+            analysis = self.classifier.classify(query, recent_history, memory_context)
+            span["hit"] = analysis is not None
+        metrics.inc("query_fast_path_total", result="hit" if analysis else "miss")
+        return analysis
+
+    def cached_analysis(self, query: str, recent_history: List[Dict], memory_context: str) -> Optional[QueryAnalysis]:
+        """A previous LLM analysis of the same query from the same packed history and memory."""
+        if not self.cache.enabled:
+            return None
+        _, (key, _) = self._analysis_prompt(query, recent_history, memory_context)
+        return self.cache.get_analysis(key)
+
+    def recall_snippets(self, queries: List[str], memory_manager) -> List[str]:
+        """Archived messages most relevant to the queries, best first, formatted for the answer prompt."""
+        if not self.top_k:
+            return []
+        limit = Config.RETRIEVAL_SNIPPET_CHARS
+        snippets = []
+        for hit in memory_manager.recall(queries, self.top_k):
+            content = hit["content"] if len(hit["content"]) <= limit else hit["content"][:limit] + "..."
+            snippets.append(f"- [#{hit['index']} {hit['role']}] {content}")
+        return snippets
+
+    @staticmethod
+    def recall_queries(analysis: QueryAnalysis) -> List[str]:
+        """Retrieval is guided by the rewritten query plus what the analysis says it needs from memory."""
+        return [analysis.rewritten_query] + list(analysis.needed_context_from_memory)
+
+    def analyze_with_llm(self, query: str, recent_history: List[Dict], memory_context: str) -> QueryAnalysis:
+        with metrics.span("query_analysis"):
+            return self._analyze_with_llm(query, recent_history, memory_context)
+
+    @staticmethod
+    def _user_prompt(query: str, summary: str, history: List[Dict], snippets: Optional[List[str]] = None) -> str:
+        history_text = json.dumps(history, ensure_ascii=False)
+        recalled = ""
+        if snippets:
+            recalled = "=== RELEVANT EARLIER MESSAGES ===\n        " + "\n        ".join(snippets) + "\n\n        "
+
+        return f"""
         === LONG TERM MEMORY ===
-        {memory_context}
+        {summary}
 
         === CHAT HISTORY (Most Recent) ===
         {history_text}
 
-        === CURRENT USER QUERY ===
+        {recalled}=== CURRENT USER QUERY ===
         "{query}"
         
         OUTPUT JSON:
         """
 
+    def _finish_analysis(self, analysis: QueryAnalysis, query: str, cache_key: Tuple[str, str]) -> QueryAnalysis:
+        # --- CÁC LOGIC FALLBACK ---
+        if not analysis.rewritten_query or not analysis.rewritten_query.strip():
+            analysis.rewritten_query = query
+
+        if not analysis.augmented_context or not analysis.augmented_context.strip():
+            analysis.augmented_context = "No specific context resolved from history."
+
+        if analysis.confidence_score == 0:
+            analysis.confidence_score = 0.5
+            analysis.is_ambiguous = True
+
+        # Unparseable output and the error fallback below are not cached, so they are retried next time
+        if "System Format Error" not in analysis.ambiguity_reasons:
+            self.cache.put_analysis(*cache_key, analysis)
+        return analysis
+
+    @staticmethod
+    def _error_analysis(query: str, e: Exception) -> QueryAnalysis:
+        metrics.inc("query_analysis_errors_total")
+        logger.error(f"❌ Query Analysis Error: {str(e)}")
+        return QueryAnalysis(
+            original_query=query,
+            is_ambiguous=True,
+            ambiguity_reasons=["System Processing Error"],
+            rewritten_query=query,
+            augmented_context="System error.",
+            confidence_score=0.1,
+            requires_clarification=True
+        )
+
+    def _analysis_prompt(self, query: str, recent_history: List[Dict],
+                         memory_context: str) -> Tuple[List[Dict[str, str]], Tuple[str, str]]:
+        """Analysis prompt messages and the cache key of what they include."""
+        system_prompt = ANALYSIS_SYSTEM_PROMPT
+
+        # Memory and history are packed into what is left of the budget after the fixed prompt
+        packed = self.packer.pack(fixed=[system_prompt, query], summary=memory_context, history=recent_history or [])
+
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
+            {"role": "user", "content": self._user_prompt(query, packed.summary, packed.history)}
         ]
+        return messages, self.cache.analysis_key(query, packed.summary, packed.history, memory_context)
+
+    def _analyze_with_llm(self, query: str, recent_history: List[Dict], memory_context: str) -> QueryAnalysis:
+        messages, cache_key = self._analysis_prompt(query, recent_history, memory_context)
 
         try:
-            raw_output = self.llm.chat_completion(messages, json_mode=True)
+            raw_output = self.llm.json_completion(messages, QueryAnalysis)
             analysis = self.llm.validate_json_output(raw_output, QueryAnalysis)
-            
-            # --- CÁC LOGIC FALLBACK ---
-            if not analysis.rewritten_query or not analysis.rewritten_query.strip():
-                analysis.rewritten_query = query
-            
-            if not analysis.augmented_context or not analysis.augmented_context.strip():
-                analysis.augmented_context = "No specific context resolved from history."
-
-            if analysis.confidence_score == 0:
-                analysis.confidence_score = 0.5 
-                analysis.is_ambiguous = True
-            
-            return analysis
-
+            return self._finish_analysis(analysis, query, cache_key)
         except Exception as e:
-            logger.error(f"❌ Query Analysis Error: {str(e)}")
-            return QueryAnalysis(
-                original_query=query,
-                is_ambiguous=True,
-                ambiguity_reasons=["System Processing Error"],
-                rewritten_query=query,
-                augmented_context="System error.",
-                confidence_score=0.1,
-                requires_clarification=True
-            )
\ No newline at end of file
+            return self._error_analysis(query, e)
+
+    def analyze_fused(self, query: str, recent_history: List[Dict], memory_context: str,
+                      snippets: Optional[List[str]] = None
+                      ) -> Tuple[QueryAnalysis, FusedAnswer, List[Dict[str, str]], ContextBreakdown]:
+        """
+        One streamed generation for analysis and answer (PIPELINE_MODE=fused).
+        Returns as soon as the analysis object is complete, with the rest of
+        the stream as a FusedAnswer, the prompt and what its packer included.
+        """
+        with metrics.span("fused_analysis"):
+            # The answer is generated from this prompt too, so it gets the answer budget
+            packed = self.fused_packer.pack(fixed=[FUSED_SYSTEM_PROMPT, query], summary=memory_context,
+                                            snippets=snippets, history=recent_history or [])
+            messages = [
+                {"role": "system", "content": FUSED_SYSTEM_PROMPT},
+                {"role": "user", "content": self._user_prompt(query, packed.summary, packed.history, packed.snippets)}
+            ]
+
+            # Most of this stream is the answer, so it is sampled like one
+            stream = self.llm.stream_chat_completion(messages, json_mode=True, temperature=ANSWER_TEMPERATURE)
+            scanner = JsonObjectScanner()
+            try:
+                for delta in stream:
+                    if scanner.feed(delta):
+                        break
+                # No balanced object: validate_json_output's fallback asks for clarification
+                analysis = self.llm.validate_json_output(scanner.result() or scanner.raw, QueryAnalysis)
+                # Keyed on the fused prompt's contents, snippets included
+                cache_key = self.cache.analysis_key(query, packed.summary, packed.history, memory_context,
+                                                    packed.snippets)
+                analysis = self._finish_analysis(analysis, query, cache_key)
+            except Exception as e:
+                stream.close()
+                return self._error_analysis(query, e), FusedAnswer(iter(())), messages, packed.breakdown
+
+        head = scanner.raw[scanner.end_offset():] if scanner.complete else ""
+        return analysis, FusedAnswer(stream, head), messages, packed.breakdown
\ No newline at end of file
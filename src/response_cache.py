@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from src.config import Config
+from src.metrics import metrics
+from src.models import QueryAnalysis
+from src.session_cache import MISSING, SessionCache
+
+logger = logging.getLogger(__name__)
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s?!.,;:]+$")
+
+
+def normalize_query(query: str) -> str:
+    """Case, whitespace and trailing punctuation do not change what is being asked."""
+    return _TRAILING_PUNCT_RE.sub("", _SPACE_RE.sub(" ", query.strip().lower()))
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()[:32]
+
+
+def memory_hash(memory_context: str) -> str:
+    return _digest(memory_context or "")
+
+
+class DiskCacheTier:
+    """
+    SQLite-backed second tier shared by processes on one host and kept across
+    restarts. Expired rows are dropped on read; beyond max_entries the least
+    recently used rows are deleted.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        memory_hash TEXT NOT NULL,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_response_cache_memory ON response_cache (memory_hash);
+    CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used);
+    """
+
+    def __init__(self, db_path: Path, max_entries: int, ttl_seconds: float):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """(value, memory_hash) or None."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, memory_hash, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[2] < now:
+                conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    def put(self, key: str, kind: str, mem_hash: str, value: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, kind, memory_hash, value, expires_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, mem_hash, value, now + self.ttl_seconds, now),
+            )
+            count = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM response_cache WHERE key IN "
+                    "(SELECT key FROM response_cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def invalidate_memory(self, mem_hash: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response_cache WHERE memory_hash = ?", (mem_hash,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+
+class ResponseCache:
+    """
+    Two-level cache for LLM results that repeat across turns and sessions:
+      - QueryAnalysis keyed on the normalized query, a hash of the last few
+        history messages and the memory hash;
+      - final answers keyed on the whole prompt they were generated from
+        (system context, packed history and snippets, normalized question)
+        and the memory hash, so an answer is only reused for the same inputs.
+    Lookups go to the in-memory LRU/TTL tier first, then the optional SQLite
+    tier (hits there are promoted). Entries are tagged with the hash of the
+    SessionMemory they were produced under and dropped when that memory is
+    replaced.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = Config.RESPONSE_CACHE,
+        max_entries: int = Config.RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = Config.RESPONSE_CACHE_TTL_SECONDS,
+        disk_path: str = Config.RESPONSE_CACHE_PATH,
+    ):
+        self.enabled = enabled
+        self.memory = SessionCache(max_entries=max_entries, ttl_seconds=ttl_seconds,
+                                   max_bytes=Config.SESSION_CACHE_MAX_BYTES)
+        self.disk: Optional[DiskCacheTier] = None
+        if enabled and disk_path:
+            self.disk = DiskCacheTier(Path(disk_path), max_entries * 4, ttl_seconds)
+        self._lock = threading.Lock()
+        self._keys_by_memory: Dict[str, Set[str]] = {}
+        self._tracked = 0
+        self.hits: Dict[str, int] = {"analysis": 0, "answer": 0}
+        self.misses: Dict[str, int] = {"analysis": 0, "answer": 0}
+
+    # --- Keys ---
+    @staticmethod
+    def analysis_key(query: str, summary: str, history: List[Dict], memory_context: str,
+                     snippets: Optional[List[str]] = None) -> Tuple[str, str]:
+        """Normalized query plus exactly the memory, history and snippets the analysis prompt included."""
+        mem_hash = memory_hash(memory_context)
+        parts = [normalize_query(query), summary or ""]
+        parts.extend(f"{m.get('role', '')}:{m.get('content', '')}" for m in history)
+        parts.extend(f"snippet:{snippet}" for snippet in snippets or [])
+        return "analysis:" + _digest(*parts, mem_hash), mem_hash
+
+    @staticmethod
+    def answer_key(messages: List[Dict], memory_context: str) -> Tuple[str, str]:
+        mem_hash = memory_hash(memory_context)
+        parts = [f"{m.get('role', '')}:{m.get('content', '')}" for m in messages[:-1]]
+        if messages:
+            parts.append(normalize_query(messages[-1].get("content", "")))
+        return "answer:" + _digest(*parts, mem_hash), mem_hash
+
+    # --- Lookups ---
+    def _get(self, kind: str, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        tier = "memory"
+        if value is MISSING:
+            value = None
+            tier = "disk"
+            row = None
+            if self.disk:
+                try:
+                    row = self.disk.get(key)
+                except sqlite3.Error as e:
+                    logger.warning(f"Response cache disk read failed: {e}")
+            if row is not None:
+                value, mem_hash = row
+                self._remember(key, mem_hash, value)
+        with self._lock:
+            if value is None:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+        metrics.inc("response_cache_lookups_total", kind=kind, result=f"hit_{tier}" if value is not None else "miss")
+        return value
+
+    def _put(self, kind: str, key: str, mem_hash: str, value: str):
+        self._remember(key, mem_hash, value)
+        if self.disk:
+            try:
+                self.disk.put(key, kind, mem_hash, value)
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache disk write failed: {e}")
+
+    def _remember(self, key: str, mem_hash: str, value: str):
+        self.memory.put(key, value, size=len(value))
+        with self._lock:
+            self._keys_by_memory.setdefault(mem_hash, set()).add(key)
+            self._tracked += 1
+            if self._tracked > 2 * self.memory.max_entries:
+                # Forget keys the memory tier has already evicted
+                for tag in list(self._keys_by_memory):
+                    live = {k for k in self._keys_by_memory[tag] if k in self.memory}
+                    if live:
+                        self._keys_by_memory[tag] = live
+                    else:
+                        del self._keys_by_memory[tag]
+                self._tracked = sum(len(keys) for keys in self._keys_by_memory.values())
+
+    def get_analysis(self, key: str) -> Optional[QueryAnalysis]:
+        if not self.enabled:
+            return None
+        raw = self._get("analysis", key)
+        # A fresh object each time: callers adjust the analysis in place
+        return QueryAnalysis.model_validate_json(raw) if raw is not None else None
+
+    def put_analysis(self, key: str, mem_hash: str, analysis: QueryAnalysis):
+        if not self.enabled:
+            return
+        self._put("analysis", key, mem_hash, analysis.model_dump_json())
+
+    def get_answer(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        raw = self._get("answer", key)
+        return json.loads(raw) if raw is not None else None
+
+    def put_answer(self, key: str, mem_hash: str, text: str):
+        if not self.enabled or not text:
+            return
+        self._put("answer", key, mem_hash, json.dumps(text, ensure_ascii=False))
+
+    # --- Invalidation ---
+    def invalidate_memory(self, memory_context: str):
+        """Drops every entry produced under this memory state (called when a SessionMemory is replaced)."""
+        # Entries made without any memory are shared by all new sessions, not owned by this one
+        if not self.enabled or not memory_context:
+            return
+        mem_hash = memory_hash(memory_context)
+        with self._lock:
+            keys = self._keys_by_memory.pop(mem_hash, set())
+            self._tracked -= len(keys)
+        for key in keys:
+            self.memory.invalidate(key)
+        if self.disk:
+            self.disk.invalidate_memory(mem_hash)
+        if keys:
+            metrics.inc("response_cache_invalidations_total", len(keys))
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            self._keys_by_memory.clear()
+            self._tracked = 0
+        if self.disk:
+            self.disk.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            report = {}
+            for kind in ("analysis", "answer"):
+                lookups = self.hits[kind] + self.misses[kind]
+                report[kind] = {
+                    "hits": self.hits[kind],
+                    "misses": self.misses[kind],
+                    "hit_rate": round(self.hits[kind] / lookups, 4) if lookups else 0.0,
+                }
+        report["entries"] = len(self.memory)
+        report["disk"] = str(self.disk.db_path) if self.disk else None
+        return report
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide response cache shared by all sessions."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
@@ -0,0 +1,131 @@
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Tuple
+from src.config import Config
+from src.storage import StorageManager
+
+logger = logging.getLogger(__name__)
+
+TERM_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "does", "for", "from", "how",
+    "i", "if", "in", "is", "it", "its", "me", "my", "of", "on", "or", "so", "that", "the", "this",
+    "to", "was", "we", "what", "when", "which", "with", "you", "your",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TERM_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    In-memory inverted index with Okapi BM25 scoring. Documents are added one
+    at a time (no rebuild); IDF and the average length are computed at query
+    time from the running totals.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_lengths: Dict[int, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: int, text: str):
+        terms = tokenize(text)
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_lengths[doc_id] = len(terms)
+        self.total_length += len(terms)
+
+    def search(self, query_terms: Iterable[str], k: int) -> List[Tuple[int, float]]:
+        n = len(self.doc_lengths)
+        if not n:
+            return []
+        avg_length = self.total_length / n or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(query_terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class SessionArchive:
+    """
+    Messages of one session that were folded into the summary, kept searchable
+    so details the summary dropped can still be recalled. Doc ids are message
+    positions in the session history; add() only indexes positions it has not
+    seen, so it can be fed every summarized range as it is produced.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.index = BM25Index()
+        self.messages: Dict[int, Dict[str, str]] = {}
+        self.next_index = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, messages: List[Dict], start_index: int):
+        with self._lock:
+            if start_index == 0 and self.next_index > 0:
+                # History was restarted; positions no longer line up
+                self._reset()
+            for position, message in enumerate(messages, start=start_index):
+                if position < self.next_index or not message.get("content"):
+                    continue
+                self.messages[position] = {"role": message.get("role", ""), "content": message["content"]}
+                self.index.add(position, message["content"])
+            self.next_index = max(self.next_index, start_index + len(messages))
+
+    def ensure_loaded(self, until_index: int):
+        """Backfills from the persisted message log (e.g. after a process restart)."""
+        if self.next_index >= until_index:
+            return
+        missing = StorageManager.load_messages(self.session_id, self.next_index, until_index - self.next_index)
+        if missing:
+            self.add(missing, self.next_index)
+
+    def _reset(self):
+        self.index = BM25Index()
+        self.messages = {}
+        self.next_index = 0
+
+    def search(self, queries: List[str], k: int = Config.RETRIEVAL_TOP_K) -> List[Dict]:
+        terms = [term for query in queries if query for term in tokenize(query)]
+        with self._lock:
+            hits = self.index.search(terms, k)
+            return [{"index": doc_id, "score": round(score, 3), **self.messages[doc_id]} for doc_id, score in hits]
+
+
+_archives: "OrderedDict[str, SessionArchive]" = OrderedDict()
+_archives_lock = threading.Lock()
+
+
+def get_session_archive(session_id: str) -> SessionArchive:
+    """Process-wide archive per session, evicting the least recently used beyond RETRIEVAL_MAX_SESSIONS."""
+    with _archives_lock:
+        archive = _archives.get(session_id)
+        if archive is None:
+            archive = SessionArchive(session_id)
+            _archives[session_id] = archive
+            while len(_archives) > Config.RETRIEVAL_MAX_SESSIONS:
+                _archives.popitem(last=False)
+        else:
+            _archives.move_to_end(session_id)
+        return archive
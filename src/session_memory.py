@@ -1,11 +1,22 @@
 import logging
 import json
+import os
+import socket
+import threading
+from concurrent.futures import Future
 from datetime import datetime # <--- Đảm bảo có dòng này
-from typing import List, Dict, Optional
-from src.models import SessionMemory, Message
+from typing import List, Dict, Optional, Tuple
+from src.config import Config
+from src.models import SessionMemory, Message, MessageRange, SessionSummaryData
 from src.llm_client import LLMClient
-from src.token_counter import TokenCounter
+from src.token_counter import ConversationBuffer, get_token_counter
 from src.storage import StorageManager
+from src.metrics import metrics
+from src.session_cache import MISSING, get_session_cache
+from src.summarization_worker import SummarizationWorker, get_summarization_worker
+from src.retrieval import SessionArchive, get_session_archive
+from src.response_cache import get_response_cache
+from src.memory_compaction import MemoryCompactor, render_context
 
 logger = logging.getLogger(__name__)
 
@@ -36,36 +47,179 @@ Schema:
 }
 """
 
+def merge_summaries(base: SessionSummaryData, update: SessionSummaryData) -> SessionSummaryData:
+    """Folds a summary of newer messages into the existing one (deduplicated and token-capped)."""
+    return MemoryCompactor().merge(base, update)
+
+
+def load_history(session_id: str, tail: int = Config.RESUME_TAIL_MESSAGES) -> ConversationBuffer:
+    """
+    Resumes a session from its stored message log without reading the
+    summarized head: loads every message not yet folded into the memory plus
+    at least the newest `tail` ones (for display). Indices in the returned
+    buffer stay absolute log positions.
+    """
+    with metrics.span("session_resume", session_id=session_id) as span:
+        total = StorageManager.count_messages(session_id)
+        memory = StorageManager.load_session_memory(session_id)
+        summarized = memory["message_range_summarized"]["to_index"] + 1 if memory else 0
+        if summarized > total:
+            # Memory outlived its log; summarization restarts from 0 (see _next_unsummarized_index)
+            summarized = 0
+        start = min(summarized, max(total - tail, 0))
+        messages = ConversationBuffer(StorageManager.load_messages(session_id, start), offset=start)
+        span["loaded"] = len(messages) - start
+        span["skipped"] = start
+    return messages
+
+
+def _lease_owner() -> str:
+    # Unique per worker thread across hosts and processes
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
 class SessionMemoryManager:
     def __init__(self, session_id: str, llm_client: LLMClient):
         self.session_id = session_id
         self.llm = llm_client
-        self.token_counter = TokenCounter()
+        self.token_counter = get_token_counter()
         self.current_memory: Optional[SessionMemory] = None
+        # Stored record version this memory was read at (0 = none); used for compare-and-swap
+        self.version = 0
+        self.archive: SessionArchive = get_session_archive(session_id)
+        self.compactor = MemoryCompactor(token_counter=self.token_counter)
+        # (memory it was built from, compacted summary, rendered context); rebuilt only when the memory changes
+        self._rendered: Tuple[Optional[SessionMemory], Optional[SessionSummaryData], str] = (None, None, "")
+        self._summarize_lock = threading.Lock()
         self._load_memory()
 
-    def _load_memory(self):
-        data = StorageManager.load_session_memory(self.session_id)
-        if data:
-            self.current_memory = SessionMemory(**data)
+    def _load_memory(self, use_cache: bool = True):
+        # Hot sessions are served from the process-wide cache (no file read / re-validation)
+        if use_cache:
+            cached = get_session_cache().get(self.session_id)
+            if cached is not MISSING:
+                self.current_memory, self.version = cached
+                return
+
+        data, version = StorageManager.load_session_memory_versioned(self.session_id)
+        self.current_memory = SessionMemory(**data) if data else None
+        self.version = version
+        self._cache_memory()
+
+    def reload(self):
+        """Re-reads the stored memory, picking up summaries written by other workers."""
+        seen_version, seen_context = self.version, self.get_context_string()
+        self._load_memory(use_cache=False)
+        if self.version != seen_version:
+            get_response_cache().invalidate_memory(seen_context)
+
+    def _cache_memory(self):
+        size = len(self.current_memory.model_dump_json()) if self.current_memory else 0
+        get_session_cache().put(self.session_id, (self.current_memory, self.version), size=size)
+
+    def _next_unsummarized_index(self, messages) -> int:
+        if not self.current_memory:
+            return 0
+        start = self.current_memory.message_range_summarized.to_index + 1
+        if start > len(messages):
+            # History was restarted (e.g. new UI session) while memory persisted on disk
+            logger.info("Message list is shorter than the summarized range. Summarizing from the start.")
+            return 0
+        return start
+
+    def live_messages(self, messages) -> List[Dict]:
+        """
+        Messages not yet folded into the summary (the live context window).
+        A ConversationBuffer input yields a buffer slice that keeps its token counts.
+        """
+        start = self._next_unsummarized_index(messages)
+        if isinstance(messages, ConversationBuffer):
+            return messages.slice(start)
+        return list(messages[start:])
+
+    def recall(self, queries: List[str], k: int) -> List[Dict]:
+        """Top-k summarized messages relevant to the queries (BM25 over the session archive)."""
+        if not self.current_memory:
+            return []
+        with metrics.span("retrieval") as span:
+            self.archive.ensure_loaded(self.current_memory.message_range_summarized.to_index + 1)
+            hits = self.archive.search(queries, k)
+            span["hits"] = len(hits)
+        return hits
+
+    def live_token_count(self, messages) -> int:
+        with metrics.span("token_counting", cached=isinstance(messages, ConversationBuffer)):
+            start = self._next_unsummarized_index(messages)
+            if isinstance(messages, ConversationBuffer):
+                return messages.tokens_in_range(start)
+            return self.token_counter.count_messages(messages[start:])
 
     def check_and_summarize(self, messages: List[Dict], threshold: int) -> Optional[SessionMemory]:
         """
-        Checks if context exceeds threshold. If so, triggers summarization.
+        Checks if the unsummarized part of the context exceeds threshold. If so,
+        summarizes only the messages after the last summarized index and merges
+        the result into the existing memory (rolling summarization).
+        Passing a ConversationBuffer makes the threshold check O(1). The check
+        runs on the cached memory first, so turns under the threshold take no
+        lease and do no storage reads; it is repeated after the reload.
+        """
+        if self.live_token_count(messages) < threshold:
+            return None
+        with self._summarize_lock:
+            return self._summarize_locked(messages, threshold)
+
+    def check_and_summarize_async(self, messages: List[Dict], threshold: int,
+                                  worker: Optional[SummarizationWorker] = None) -> Optional[Future]:
+        """
+        Non-blocking variant: if the threshold is crossed, enqueue a background job
+        and return its Future. The turn keeps using the previous memory until the
+        new SessionMemory is swapped in.
         """
-        current_tokens = self.token_counter.count_messages(messages)
+        if self.live_token_count(messages) < threshold:
+            return None
+        # Snapshot so later appends by the UI don't race with the job
+        snapshot = messages.copy() if isinstance(messages, ConversationBuffer) else list(messages)
+        worker = worker or get_summarization_worker()
+        return worker.submit(self.session_id, self.check_and_summarize, snapshot, threshold)
+
+    def _summarize_locked(self, messages: List[Dict], threshold: int) -> Optional[SessionMemory]:
+        # The lease keeps other workers (threads or processes) from summarizing the same session
+        owner = _lease_owner()
+        if not StorageManager.acquire_lease(self.session_id, owner):
+            metrics.inc("summary_lease_busy_total")
+            logger.info(f"Session {self.session_id} is being summarized by another worker. Skipping.")
+            return None
+        try:
+            # Another worker may have folded messages in since this memory was loaded
+            seen_version = self.version
+            self._load_memory(use_cache=False)
+            if self.version != seen_version and self.current_memory and \
+                    self.current_memory.message_range_summarized.to_index >= len(messages):
+                logger.info(f"Stored memory of session {self.session_id} is ahead of this snapshot. Skipping.")
+                return None
+            return self._summarize_if_needed(messages, threshold)
+        finally:
+            StorageManager.release_lease(self.session_id, owner)
+
+    def _summarize_if_needed(self, messages: List[Dict], threshold: int) -> Optional[SessionMemory]:
+        start = self._next_unsummarized_index(messages)
+        current_tokens = self.live_token_count(messages)
         logger.info(f"Current context tokens: {current_tokens}/{threshold}")
 
         if current_tokens < threshold:
             return None
 
-        logger.info("Threshold exceeded. Triggering summarization...")
-        
+        logger.info(f"Threshold exceeded. Triggering summarization of messages {start}..{len(messages) - 1}")
+        with metrics.span("summarization", session_id=self.session_id, messages=len(messages) - start):
+            return self._summarize_range(messages, start, current_tokens)
+
+    def _summarize_range(self, messages: List[Dict], start: int, current_tokens: int) -> Optional[SessionMemory]:
         # Lấy thời gian thực để đưa vào Prompt
-        current_time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = datetime.now()
+        current_time_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        # Prepare prompt
-        msgs_text = json.dumps(messages, ensure_ascii=False)
+        # Prepare prompt (only the new messages, so prompt size stays bounded)
+        msgs_text = json.dumps(list(messages[start:]), ensure_ascii=False)
         
         # Prompt được cập nhật để chứa thời gian
         prompt_content = f"""
@@ -81,25 +235,76 @@ class SessionMemoryManager:
         ]
 
         # Call LLM
-        raw_output = self.llm.chat_completion(prompt_messages, json_mode=True)
+        raw_output = self.llm.json_completion(prompt_messages, SessionMemory)
         
         # Parse and Validate
         try:
             summary_obj = self.llm.validate_json_output(raw_output, SessionMemory)
-            
+
+            previous = self.current_memory
+            summarized_tokens = current_tokens
+            from_index = start
+            if previous:
+                # Tokens covered by the previous summary = what it saved + its own size
+                summarized_tokens += previous.metadata.tokens_saved + self.token_counter.count_tokens(
+                    json.dumps(previous.session_summary.model_dump()))
+                from_index = previous.message_range_summarized.from_index
+            # Merge (or, for the first summary, just dedupe) and cap every section
+            summary_obj.session_summary = self.compactor.merge(
+                previous.session_summary if previous else SessionSummaryData(), summary_obj.session_summary)
+
+            # The range is tracked locally; the model's own indices are not trusted
+            summary_obj.message_range_summarized = MessageRange(
+                from_index=from_index,
+                to_index=len(messages) - 1,
+                total_messages=len(messages),
+                timestamp=now.isoformat(timespec="seconds"),
+            )
+
             # Calculate stats
-            tokens_after = self.token_counter.count_tokens(json.dumps(summary_obj.model_dump()))
-            summary_obj.metadata.tokens_saved = current_tokens - tokens_after
-            summary_obj.metadata.compression_ratio = round(tokens_after / current_tokens, 2)
-            
+            tokens_after = self.token_counter.count_tokens(json.dumps(summary_obj.session_summary.model_dump()))
+            summary_obj.metadata.tokens_saved = summarized_tokens - tokens_after
+            summary_obj.metadata.compression_ratio = round(tokens_after / summarized_tokens, 2)
+
+            version = StorageManager.save_session_memory_cas(self.session_id, summary_obj.model_dump(), self.version)
+            if version is None:
+                # Lost the race (e.g. our lease expired mid-call); keep the winner's memory
+                metrics.inc("summaries_total", status="conflict")
+                self._load_memory(use_cache=False)
+                return None
+            metrics.set_gauge("summary_compression_ratio", summary_obj.metadata.compression_ratio)
+            metrics.inc("summary_tokens_saved_total", max(summary_obj.metadata.tokens_saved, 0))
+            metrics.inc("summaries_total", status="ok")
+
+            # Single reference assignment: readers see either the old or the new memory
+            previous_context = self.get_context_string()
             self.current_memory = summary_obj
-            StorageManager.save_session_memory(self.session_id, summary_obj.model_dump())
+            self.version = version
+            self._cache_memory()
+            # Analyses and answers produced under the old memory no longer apply
+            get_response_cache().invalidate_memory(previous_context)
+            # Keep the exact wording searchable now that only the summary carries it
+            self.archive.add(list(messages[start:]), start)
             return summary_obj
         except Exception as e:
+            metrics.inc("summaries_total", status="error")
             logger.error(f"Summarization failed: {e}")
             return None
 
+    def compact_summary(self) -> Optional[SessionSummaryData]:
+        """The current summary deduplicated and capped (memories stored before compaction are bounded too)."""
+        memory = self.current_memory
+        if memory is None:
+            return None
+        cached_for, summary, _ = self._rendered
+        if cached_for is not memory:
+            summary = self.compactor.compact(memory.session_summary)
+            self._rendered = (memory, summary, render_context(summary))
+            metrics.set_gauge("memory_context_chars", len(self._rendered[2]))
+        return self._rendered[1]
+
     def get_context_string(self) -> str:
-        if not self.current_memory:
+        """Compact memory rendering for prompts; cached until the memory changes."""
+        if self.compact_summary() is None:
             return ""
-        return json.dumps(self.current_memory.session_summary.model_dump(), indent=2, ensure_ascii=False)
\ No newline at end of file
+        return self._rendered[2]
\ No newline at end of file
@@ -1,33 +1,503 @@
 import json
 import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 from src.config import Config
+from src.message_log import SegmentMessageLog
+from src.session_cache import get_session_cache
 
 logger = logging.getLogger(__name__)
 
+
+class StorageBackend(ABC):
+    """
+    Interface for session persistence (memories + append-only message logs).
+    Memory records carry a version (0 = no record) so several worker processes
+    can update them with compare-and-swap, and sessions can be leased to one
+    owner at a time (e.g. the process currently summarizing them).
+    """
+
+    @abstractmethod
+    def save_memory(self, session_id: str, memory_data: Dict[str, Any]):
+        """Unconditional write (bumps the version)."""
+        ...
+
+    @abstractmethod
+    def load_memory(self, session_id: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def load_memory_versioned(self, session_id: str) -> Tuple[Dict[str, Any], int]:
+        ...
+
+    @abstractmethod
+    def compare_and_swap_memory(self, session_id: str, memory_data: Dict[str, Any], expected_version: int) -> Optional[int]:
+        """Writes only if the stored version is still expected_version; returns the new version or None."""
+        ...
+
+    @abstractmethod
+    def acquire_lease(self, session_id: str, owner: str, ttl_seconds: float) -> bool:
+        """Takes (or renews) the session lease unless another owner holds an unexpired one."""
+        ...
+
+    @abstractmethod
+    def release_lease(self, session_id: str, owner: str):
+        ...
+
+    @abstractmethod
+    def append_messages(self, session_id: str, messages: List[Dict[str, Any]]) -> int:
+        """Appends to the log; returns the index of the first appended message."""
+        ...
+
+    @abstractmethod
+    def load_messages(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        ...
+
+    def count_messages(self, session_id: str) -> int:
+        return len(self.load_messages(session_id))
+
+    @abstractmethod
+    def list_sessions(self) -> List[str]:
+        ...
+
+    def close(self):
+        pass
+
+
+class JsonFileBackend(StorageBackend):
+    """
+    Legacy layout: one {session_id}_memory.json per session plus a
+    {session_id}_messages/ segment log with an offset index (SegmentMessageLog),
+    so appends and tail reads do not scan the history. Logs written as
+    {session_id}_messages.jsonl are imported into it on first access. Memory
+    writes go through a temp file and os.replace so readers never see a
+    half-written file. The version is stored as "_version" in the file;
+    compare-and-swap, leases and appends serialize across processes with
+    O_EXCL lock files next to the session files.
+    """
+
+    LOCK_STALE_SECONDS = 10.0
+
+    def __init__(self, session_dir: Path = Config.SESSION_DIR):
+        self.session_dir = Path(session_dir)
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _memory_path(self, session_id: str) -> Path:
+        return self.session_dir / f"{session_id}_memory.json"
+
+    def _legacy_messages_path(self, session_id: str) -> Path:
+        return self.session_dir / f"{session_id}_messages.jsonl"
+
+    def _message_log(self, session_id: str) -> SegmentMessageLog:
+        log = SegmentMessageLog(self.session_dir / f"{session_id}_messages")
+        legacy_path = self._legacy_messages_path(session_id)
+        if not log.exists() and legacy_path.exists():
+            with self._lock, self._file_lock(log.directory):
+                if not log.exists() and legacy_path.exists():
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        messages = [json.loads(line) for line in f if line.strip()]
+                    log.append(messages)
+                    os.replace(legacy_path, legacy_path.with_suffix(".jsonl.imported"))
+                    logger.info(f"Imported {len(messages)} logged messages of session {session_id}")
+        return log
+
+    @contextmanager
+    def _file_lock(self, path: Path):
+        lock_path = path.with_name(path.name + ".lock")
+        # Identifies this holder, so it never removes a lock another process took over as stale
+        token = uuid.uuid4().hex.encode()
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token)
+                break
+            except FileExistsError:
+                try:
+                    # A holder that died leaves the file behind
+                    if time.time() - lock_path.stat().st_mtime > self.LOCK_STALE_SECONDS:
+                        os.unlink(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.005)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            try:
+                with open(lock_path, 'rb') as f:
+                    held = f.read() == token
+            except FileNotFoundError:
+                held = False
+            if held:
+                os.unlink(lock_path)
+            else:
+                logger.warning(f"Lock {lock_path} was taken over as stale before it was released")
+
+    def _write_memory(self, session_id: str, memory_data: Dict[str, Any], version: int):
+        file_path = self._memory_path(session_id)
+        tmp_path = file_path.with_suffix(f".json.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**memory_data, "_version": version}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+
+    def save_memory(self, session_id: str, memory_data: Dict[str, Any]):
+        with self._file_lock(self._memory_path(session_id)):
+            _, version = self.load_memory_versioned(session_id)
+            self._write_memory(session_id, memory_data, version + 1)
+
+    def load_memory(self, session_id: str) -> Dict[str, Any]:
+        return self.load_memory_versioned(session_id)[0]
+
+    def load_memory_versioned(self, session_id: str) -> Tuple[Dict[str, Any], int]:
+        file_path = self._memory_path(session_id)
+        if file_path.exists():
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Files written before versioning count as version 1
+            return data, data.pop("_version", 1)
+        return {}, 0
+
+    def compare_and_swap_memory(self, session_id: str, memory_data: Dict[str, Any], expected_version: int) -> Optional[int]:
+        with self._file_lock(self._memory_path(session_id)):
+            _, version = self.load_memory_versioned(session_id)
+            if version != expected_version:
+                return None
+            self._write_memory(session_id, memory_data, version + 1)
+            return version + 1
+
+    def _lease_path(self, session_id: str) -> Path:
+        return self.session_dir / f"{session_id}.lease"
+
+    def acquire_lease(self, session_id: str, owner: str, ttl_seconds: float) -> bool:
+        path = self._lease_path(session_id)
+        with self._file_lock(path):
+            now = time.time()
+            if path.exists():
+                with open(path, 'r', encoding='utf-8') as f:
+                    lease = json.load(f)
+                if lease["owner"] != owner and lease["expires_at"] > now:
+                    return False
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({"owner": owner, "expires_at": now + ttl_seconds}, f)
+            return True
+
+    def release_lease(self, session_id: str, owner: str):
+        path = self._lease_path(session_id)
+        with self._file_lock(path):
+            if path.exists():
+                with open(path, 'r', encoding='utf-8') as f:
+                    if json.load(f)["owner"] != owner:
+                        return
+                os.unlink(path)
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, Any]]) -> int:
+        log = self._message_log(session_id)
+        with self._lock, self._file_lock(log.directory):
+            return log.append(messages)
+
+    def load_messages(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self._message_log(session_id).read(start, limit)
+
+    def count_messages(self, session_id: str) -> int:
+        return self._message_log(session_id).count()
+
+    def list_sessions(self) -> List[str]:
+        # A session may have a message log (or a legacy .jsonl) but no memory file yet
+        ids = {p.name[:-len("_memory.json")] for p in self.session_dir.glob("*_memory.json")}
+        ids.update(p.name[:-len("_messages")] for p in self.session_dir.glob("*_messages") if p.is_dir())
+        ids.update(p.name[:-len("_messages.jsonl")] for p in self.session_dir.glob("*_messages.jsonl"))
+        return sorted(ids)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded SQLite store in WAL mode: concurrent readers with a single writer,
+    indexed lookup by session and batched message inserts.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS session_memory (
+        session_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS session_leases (
+        session_id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (session_id, idx)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path: Path = Config.SQLITE_PATH, legacy_dir: Optional[Path] = Config.SESSION_DIR):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Legacy JSON files are imported lazily the first time a session is read
+        self.legacy_dir = Path(legacy_dir) if legacy_dir else None
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(session_memory)")}
+            if "version" not in columns:
+                # Databases created before versioning
+                conn.execute("ALTER TABLE session_memory ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def save_memory(self, session_id: str, memory_data: Dict[str, Any]):
+        self.save_memories({session_id: memory_data})
+
+    def save_memories(self, memories: Dict[str, Dict[str, Any]]):
+        """Batched upsert of several session memories in one transaction."""
+        now = datetime.now().isoformat(timespec="seconds")
+        rows = [(sid, json.dumps(data, ensure_ascii=False), now) for sid, data in memories.items()]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO session_memory (session_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at, "
+                "version = session_memory.version + 1",
+                rows,
+            )
+
+    def load_memory(self, session_id: str) -> Dict[str, Any]:
+        return self.load_memory_versioned(session_id)[0]
+
+    def load_memory_versioned(self, session_id: str) -> Tuple[Dict[str, Any], int]:
+        row = self._connect().execute(
+            "SELECT data, version FROM session_memory WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row:
+            return json.loads(row[0]), row[1]
+        data = self._import_legacy(session_id)
+        return data, 1 if data else 0
+
+    def compare_and_swap_memory(self, session_id: str, memory_data: Dict[str, Any], expected_version: int) -> Optional[int]:
+        now = datetime.now().isoformat(timespec="seconds")
+        data = json.dumps(memory_data, ensure_ascii=False)
+        with self._connect() as conn:
+            if expected_version == 0:
+                cursor = conn.execute(
+                    "INSERT INTO session_memory (session_id, data, updated_at, version) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT(session_id) DO NOTHING",
+                    (session_id, data, now),
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE session_memory SET data = ?, updated_at = ?, version = version + 1 "
+                    "WHERE session_id = ? AND version = ?",
+                    (data, now, session_id, expected_version),
+                )
+        return expected_version + 1 if cursor.rowcount == 1 else None
+
+    def acquire_lease(self, session_id: str, owner: str, ttl_seconds: float) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            # Single upsert: only overwrites an expired lease or our own
+            cursor = conn.execute(
+                "INSERT INTO session_leases (session_id, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE session_leases.expires_at < ? OR session_leases.owner = excluded.owner",
+                (session_id, owner, now + ttl_seconds, now),
+            )
+        return cursor.rowcount == 1
+
+    def release_lease(self, session_id: str, owner: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM session_leases WHERE session_id = ? AND owner = ?", (session_id, owner))
+
+    def _import_legacy(self, session_id: str) -> Dict[str, Any]:
+        if not self.legacy_dir:
+            return {}
+        legacy_path = self.legacy_dir / f"{session_id}_memory.json"
+        if not legacy_path.exists():
+            return {}
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.save_memory(session_id, data)
+        logger.info(f"Imported legacy memory file for session {session_id}")
+        return data
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, Any]]) -> int:
+        with self._connect() as conn:
+            # Take the write lock up front so concurrent appenders can't pick the same idx
+            conn.execute("BEGIN IMMEDIATE")
+            next_idx = conn.execute(
+                "SELECT COALESCE(MAX(idx) + 1, 0) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO messages (session_id, idx, role, content, data) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (session_id, next_idx + i, msg.get("role", ""), msg.get("content", ""),
+                     json.dumps(msg, ensure_ascii=False))
+                    for i, msg in enumerate(messages)
+                ],
+            )
+        return next_idx
+
+    def load_messages(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            "SELECT data FROM messages WHERE session_id = ? AND idx >= ? ORDER BY idx LIMIT ?",
+            (session_id, start, -1 if limit is None else limit),
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def count_messages(self, session_id: str) -> int:
+        return self._connect().execute(
+            "SELECT COALESCE(MAX(idx) + 1, 0) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+
+    def list_sessions(self) -> List[str]:
+        rows = self._connect().execute(
+            "SELECT session_id FROM session_memory UNION SELECT session_id FROM messages ORDER BY session_id"
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def migrate_json_sessions(source: JsonFileBackend, target: StorageBackend) -> int:
+    """Copies every legacy session (memory + message log) into another backend."""
+    migrated = 0
+    for session_id in source.list_sessions():
+        memory = source.load_memory(session_id)
+        if memory:
+            target.save_memory(session_id, memory)
+        if not target.load_messages(session_id, limit=1):
+            target.append_messages(session_id, source.load_messages(session_id))
+        migrated += 1
+    logger.info(f"Migrated {migrated} sessions")
+    return migrated
+
+
 class StorageManager:
+    _backend: Optional[StorageBackend] = None
+    _backend_lock = threading.Lock()
+
+    @staticmethod
+    def get_backend() -> StorageBackend:
+        with StorageManager._backend_lock:
+            if StorageManager._backend is None:
+                if Config.STORAGE_BACKEND == "json":
+                    StorageManager._backend = JsonFileBackend()
+                else:
+                    StorageManager._backend = SQLiteBackend()
+            return StorageManager._backend
+
+    @staticmethod
+    def set_backend(backend: StorageBackend):
+        with StorageManager._backend_lock:
+            StorageManager._backend = backend
+
     @staticmethod
     def save_session_memory(session_id: str, memory_data: Dict[str, Any]):
-        file_path = Config.SESSION_DIR / f"{session_id}_memory.json"
+        # Invalidate on write so no reader is served a stale cached copy
+        get_session_cache().invalidate(session_id)
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, indent=2, ensure_ascii=False)
+            StorageManager.get_backend().save_memory(session_id, memory_data)
             logger.info(f"Saved memory for session {session_id}")
         except Exception as e:
             logger.error(f"Failed to save session memory: {e}")
 
     @staticmethod
     def load_session_memory(session_id: str) -> Dict[str, Any]:
-        file_path = Config.SESSION_DIR / f"{session_id}_memory.json"
-        if file_path.exists():
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"Failed to load memory: {e}")
+        try:
+            return StorageManager.get_backend().load_memory(session_id)
+        except Exception as e:
+            logger.error(f"Failed to load memory: {e}")
         return {}
 
+    @staticmethod
+    def load_session_memory_versioned(session_id: str) -> Tuple[Dict[str, Any], int]:
+        try:
+            return StorageManager.get_backend().load_memory_versioned(session_id)
+        except Exception as e:
+            logger.error(f"Failed to load memory: {e}")
+        return {}, 0
+
+    @staticmethod
+    def save_session_memory_cas(session_id: str, memory_data: Dict[str, Any], expected_version: int) -> Optional[int]:
+        """Compare-and-swap write. Returns the new version, or None if another writer got there first."""
+        get_session_cache().invalidate(session_id)
+        try:
+            version = StorageManager.get_backend().compare_and_swap_memory(session_id, memory_data, expected_version)
+        except Exception as e:
+            logger.error(f"Failed to save session memory: {e}")
+            return None
+        if version is None:
+            logger.warning(f"Memory for session {session_id} changed since version {expected_version}; write rejected")
+        else:
+            logger.info(f"Saved memory for session {session_id} (version {version})")
+        return version
+
+    @staticmethod
+    def acquire_lease(session_id: str, owner: str, ttl_seconds: float = Config.SESSION_LEASE_SECONDS) -> bool:
+        try:
+            return StorageManager.get_backend().acquire_lease(session_id, owner, ttl_seconds)
+        except Exception as e:
+            logger.error(f"Failed to acquire lease: {e}")
+        return False
+
+    @staticmethod
+    def release_lease(session_id: str, owner: str):
+        try:
+            StorageManager.get_backend().release_lease(session_id, owner)
+        except Exception as e:
+            logger.error(f"Failed to release lease: {e}")
+
+    @staticmethod
+    def append_messages(session_id: str, messages: List[Dict[str, Any]]) -> Optional[int]:
+        """Returns the log index of the first appended message (None on failure)."""
+        try:
+            return StorageManager.get_backend().append_messages(session_id, messages)
+        except Exception as e:
+            logger.error(f"Failed to append messages: {e}")
+        return None
+
+    @staticmethod
+    def load_messages(session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        try:
+            return StorageManager.get_backend().load_messages(session_id, start, limit)
+        except Exception as e:
+            logger.error(f"Failed to load messages: {e}")
+        return []
+
+    @staticmethod
+    def count_messages(session_id: str) -> int:
+        try:
+            return StorageManager.get_backend().count_messages(session_id)
+        except Exception as e:
+            logger.error(f"Failed to count messages: {e}")
+        return 0
+
     @staticmethod
     def load_test_data(filename: str) -> List[Dict]:
         path = Config.TEST_DATA_DIR / filename
@@ -37,4 +507,10 @@ class StorageManager:
                 for line in f:
                     if line.strip():
                         data.append(json.loads(line))
-        return data
\ No newline at end of file
+        return data
+
+
+if __name__ == "__main__":
+    # python -m src.storage : import data/sessions/*.json into the SQLite store
+    logging.basicConfig(level=logging.INFO)
+    migrate_json_sessions(JsonFileBackend(), SQLiteBackend(legacy_dir=None))
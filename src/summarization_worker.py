@@ -0,0 +1,67 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SummarizationWorker:
+    """
+    Runs summarization jobs off the request path on a small thread pool.
+    Jobs are single-flight per session: while one is queued or running, further
+    triggers for the same session get the in-flight Future back instead of
+    launching a duplicate summary.
+    """
+
+    def __init__(self, max_workers: int = Config.SUMMARY_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+
+    def submit(self, session_id: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        with self._lock:
+            future = self._inflight.get(session_id)
+            if future is not None and not future.done():
+                self.coalesced += 1
+                logger.info(f"Summarization already in flight for session {session_id}, coalescing")
+                return future
+
+            future = self.executor.submit(self._run, session_id, fn, *args, **kwargs)
+            self._inflight[session_id] = future
+            self.submitted += 1
+            return future
+
+    def _run(self, session_id: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Background summarization failed for session {session_id}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(session_id, None)
+
+    def is_pending(self, session_id: str) -> bool:
+        with self._lock:
+            future = self._inflight.get(session_id)
+            return future is not None and not future.done()
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+_default_worker: Optional[SummarizationWorker] = None
+_default_worker_lock = threading.Lock()
+
+
+def get_summarization_worker() -> SummarizationWorker:
+    """Process-wide worker shared by every SessionMemoryManager."""
+    global _default_worker
+    with _default_worker_lock:
+        if _default_worker is None:
+            _default_worker = SummarizationWorker()
+        return _default_worker
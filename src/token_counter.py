@@ -1,24 +1,275 @@
-import tiktoken
 import logging
+import threading
+from array import array
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Approximate overhead per message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding: Optional[Any] = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """
+    Process-wide tiktoken encoding, loaded on first use (importing tiktoken and
+    reading the BPE ranks is the slow part of token counting).
+    """
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                import tiktoken
+                # Using cl100k_base as proxy for Llama 3 tokenizer in this demo environment
+                try:
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding = tiktoken.get_encoding("gpt2")
+    return _encoding
+
+
 class TokenCounter:
     def __init__(self, model_name: str = "gpt-3.5-turbo"):
-        # Using cl100k_base as proxy for Llama 3 tokenizer in this demo environment
-        try:
-            self.encoding = tiktoken.get_encoding("cl100k_base")
-        except Exception:
-            self.encoding = tiktoken.get_encoding("gpt2")
+        self.model_name = model_name
+
+    @property
+    def encoding(self):
+        return get_encoding()
 
     def count_tokens(self, text: str) -> int:
         if not text:
             return 0
         return len(self.encoding.encode(text))
 
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Counts many texts in one call (tiktoken encodes the batch in parallel)."""
+        if not texts:
+            return []
+        return [len(tokens) for tokens in self.encoding.encode_batch([t or "" for t in texts])]
+
     def count_messages(self, messages: list) -> int:
-        count = 0
-        for msg in messages:
-            count += self.count_tokens(msg.get("content", ""))
-            count += 4 # Approximate overhead per message
-        return count
\ No newline at end of file
+        if isinstance(messages, ConversationBuffer):
+            return messages.total_tokens
+        counts = self.count_tokens_batch([msg.get("content", "") for msg in messages])
+        return sum(counts) + MESSAGE_OVERHEAD_TOKENS * len(counts)
+
+
+_shared_counter: Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    """Process-wide TokenCounter so callers don't each repeat the encoding lookup."""
+    global _shared_counter
+    if _shared_counter is None:
+        _shared_counter = TokenCounter()
+    return _shared_counter
+
+
+# Message fields kept column-wise by ConversationBuffer; anything else goes to a per-message extras dict
+_ROLES = ("user", "assistant", "system")
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+_ROLE_OTHER = 255
+_FLAG_ABSENT, _FLAG_FALSE, _FLAG_TRUE = 0, 1, 2
+_NO_TIMESTAMP = -(2 ** 63)
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _encode_timestamp(value: Any) -> Optional[int]:
+    """Naive ISO timestamp -> microseconds since the epoch, if it round-trips exactly."""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None or parsed.isoformat() != value:
+        return None
+    return (parsed - _EPOCH) // _MICROSECOND
+
+
+class ConversationBuffer:
+    """
+    List-like message history that caches each message's token count on append
+    and keeps prefix sums of them, so threshold checks and tokens_in_range are
+    O(1) per turn.
+
+    Messages are stored column-wise (role codes, is_clarification flags,
+    timestamps and token counts in arrays, contents in one list) instead of a
+    dict per message; dicts are rebuilt on access, so mutating one does not
+    change the buffer. A buffer resumed from the tail of a stored log starts at
+    `offset`: indices stay absolute log positions and len() includes the
+    skipped head, but only positions >= offset can be read.
+    """
+
+    def __init__(self, messages: Optional[Iterable[Dict]] = None, token_counter: Optional[TokenCounter] = None,
+                 offset: int = 0):
+        self.token_counter = token_counter or get_token_counter()
+        self.offset = offset
+        self._reset()
+        if messages:
+            self.extend(messages)
+
+    def _reset(self):
+        self._roles = bytearray()
+        self._flags = bytearray()
+        self._timestamps = array("q")
+        self._contents: List[str] = []
+        # Local index -> fields that do not fit the columns (rare)
+        self._extras: Dict[int, Dict[str, Any]] = {}
+        self.token_counts = array("i")
+        # _prefix[i] = sum(token_counts[:i])
+        self._prefix = array("q", [0])
+        self.total_tokens = 0
+
+    def _store(self, message: Dict, count: int):
+        local = len(self._contents)
+        extras = {}
+        role = message.get("role")
+        code = _ROLE_CODES.get(role, _ROLE_OTHER)
+        if code == _ROLE_OTHER and "role" in message:
+            extras["role"] = role
+        content = message.get("content", "")
+        if not isinstance(content, str):
+            extras["content"] = content
+            content = ""
+        flag = message.get("is_clarification", None)
+        if "is_clarification" not in message:
+            flag_code = _FLAG_ABSENT
+        elif flag is True or flag is False:
+            flag_code = _FLAG_TRUE if flag else _FLAG_FALSE
+        else:
+            flag_code = _FLAG_ABSENT
+            extras["is_clarification"] = flag
+        timestamp = _NO_TIMESTAMP
+        if "timestamp" in message:
+            encoded = _encode_timestamp(message["timestamp"])
+            if encoded is None:
+                extras["timestamp"] = message["timestamp"]
+            else:
+                timestamp = encoded
+        for key, value in message.items():
+            if key not in ("role", "content", "is_clarification", "timestamp"):
+                extras[key] = value
+        self._roles.append(code)
+        self._flags.append(flag_code)
+        self._timestamps.append(timestamp)
+        self._contents.append(content)
+        if extras:
+            self._extras[local] = extras
+        self.token_counts.append(count)
+        self._prefix.append(self._prefix[-1] + count)
+
+    def _message(self, local: int) -> Dict[str, Any]:
+        extras = self._extras.get(local, {})
+        message: Dict[str, Any] = {}
+        code = self._roles[local]
+        if code != _ROLE_OTHER:
+            message["role"] = _ROLES[code]
+        elif "role" in extras:
+            message["role"] = extras["role"]
+        message["content"] = extras.get("content", self._contents[local])
+        flag = self._flags[local]
+        if flag != _FLAG_ABSENT:
+            message["is_clarification"] = flag == _FLAG_TRUE
+        elif "is_clarification" in extras:
+            message["is_clarification"] = extras["is_clarification"]
+        timestamp = self._timestamps[local]
+        if timestamp != _NO_TIMESTAMP:
+            message["timestamp"] = (_EPOCH + timestamp * _MICROSECOND).isoformat()
+        elif "timestamp" in extras:
+            message["timestamp"] = extras["timestamp"]
+        for key, value in extras.items():
+            if key not in message:
+                message[key] = value
+        return message
+
+    @staticmethod
+    def _content_text(message: Dict) -> str:
+        content = message.get("content", "")
+        return content if isinstance(content, str) else ""
+
+    def append(self, message: Dict) -> int:
+        count = self.token_counter.count_tokens(self._content_text(message)) + MESSAGE_OVERHEAD_TOKENS
+        self._store(message, count)
+        self.total_tokens += count
+        return count
+
+    def extend(self, messages: Iterable[Dict]) -> int:
+        """Bulk append using encode_batch (e.g. when loading long_conversation.jsonl)."""
+        messages = list(messages)
+        counts = [c + MESSAGE_OVERHEAD_TOKENS for c in
+                  self.token_counter.count_tokens_batch([self._content_text(m) for m in messages])]
+        for message, count in zip(messages, counts):
+            self._store(message, count)
+        added = sum(counts)
+        self.total_tokens += added
+        return added
+
+    def copy(self) -> "ConversationBuffer":
+        """Shallow snapshot that reuses the cached counts (no re-encoding)."""
+        clone = ConversationBuffer(token_counter=self.token_counter, offset=self.offset)
+        clone._roles = bytearray(self._roles)
+        clone._flags = bytearray(self._flags)
+        clone._timestamps = array("q", self._timestamps)
+        clone._contents = list(self._contents)
+        clone._extras = dict(self._extras)
+        clone.token_counts = array("i", self.token_counts)
+        clone._prefix = array("q", self._prefix)
+        clone.total_tokens = self.total_tokens
+        return clone
+
+    def _local_range(self, start: int, end: Optional[int]) -> Tuple[int, int]:
+        """Absolute [start, end) -> local positions, clamped to what is loaded."""
+        stop = len(self) if end is None else (end + len(self) if end < 0 else min(end, len(self)))
+        start = start + len(self) if start < 0 else start
+        hi = max(stop - self.offset, 0)
+        return min(max(start - self.offset, 0), hi), hi
+
+    def slice(self, start: int, end: Optional[int] = None) -> "ConversationBuffer":
+        """Standalone sub-range (indices from 0) that carries its cached counts along (no re-encoding)."""
+        lo, hi = self._local_range(start, end)
+        part = ConversationBuffer(token_counter=self.token_counter)
+        part._roles = self._roles[lo:hi]
+        part._flags = self._flags[lo:hi]
+        part._timestamps = self._timestamps[lo:hi]
+        part._contents = self._contents[lo:hi]
+        part._extras = {i - lo: extra for i, extra in self._extras.items() if lo <= i < hi}
+        part.token_counts = self.token_counts[lo:hi]
+        part._prefix = array("q", (total - self._prefix[lo] for total in self._prefix[lo:hi + 1]))
+        part.total_tokens = part._prefix[-1]
+        return part
+
+    def clear(self):
+        self.offset = 0
+        self._reset()
+
+    def tokens_in_range(self, start: int, end: Optional[int] = None) -> int:
+        lo, hi = self._local_range(start, end)
+        return self._prefix[hi] - self._prefix[lo]
+
+    def exceeds(self, threshold: int) -> bool:
+        return self.total_tokens >= threshold
+
+    def __len__(self) -> int:
+        return self.offset + len(self._contents)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return (self._message(i) for i in range(len(self._contents)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            lo, hi = self._local_range(index.start or 0, index.stop)
+            return [self._message(i) for i in range(lo, hi)]
+        position = index + len(self) if index < 0 else index
+        if not self.offset <= position < len(self):
+            raise IndexError(f"message {index} is not loaded (buffer holds {self.offset}..{len(self) - 1})")
+        return self._message(position - self.offset)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0